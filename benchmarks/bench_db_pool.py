@@ -0,0 +1,138 @@
+"""
+对比 "+100" 记账路径的数据库开销：
+
+  before: 每次查询 psycopg2.connect()（旧版 get_db_connection 的用法）
+  after : database.run() 连接池
+
+用法（请使用测试库）:
+  DATABASE_URL=postgres://... python benchmarks/bench_db_pool.py --chats 20 --messages 50
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import psycopg2
+import database
+
+
+CHAT_BASE = -900000000000
+
+
+def percentile(values, p):
+    values = sorted(values)
+    k = max(0, min(len(values) - 1, round(p / 100 * (len(values) - 1))))
+    return values[k]
+
+
+# 旧版 handle_msg 的 6 次连接：is_owner / is_operator / INSERT /
+# ensure_chat_settings / get_work_period / send_summary
+def legacy_record(chat_id, user_id):
+    opened = 0
+
+    def q(sql, params, commit=False):
+        nonlocal opened
+        opened += 1
+        conn = psycopg2.connect(database.DATABASE_URL)
+        cur = conn.cursor()
+        cur.execute(sql, params)
+        rows = cur.fetchall() if cur.description else None
+        if commit:
+            conn.commit()
+        cur.close()
+        conn.close()
+        return rows
+
+    q("SELECT expire_date FROM admins WHERE user_id=%s", (user_id,))
+    q("SELECT 1 FROM team_members WHERE member_id=%s AND chat_id=%s", (user_id, chat_id))
+    q("INSERT INTO history (chat_id, amount, user_name) VALUES (%s,%s,%s)",
+      (chat_id, 100, "bench"), commit=True)
+    q("SELECT 1 FROM chat_settings WHERE chat_id=%s", (chat_id,))
+    q("SELECT timezone, work_start FROM chat_settings WHERE chat_id=%s", (chat_id,))
+    q("SELECT amount, user_name, timestamp FROM history WHERE chat_id=%s "
+      "AND timestamp > NOW() - INTERVAL '1 day' ORDER BY timestamp", (chat_id,))
+    return opened
+
+
+async def pooled_record(chat_id, user_id):
+    await database.fetchone("SELECT expire_date FROM admins WHERE user_id=%s", (user_id,))
+    await database.fetchone("SELECT 1 FROM team_members WHERE member_id=%s AND chat_id=%s",
+                            (user_id, chat_id))
+    await database.execute("INSERT INTO history (chat_id, amount, user_name) VALUES (%s,%s,%s)",
+                           (chat_id, 100, "bench"))
+    await database.fetchone("SELECT timezone, work_start FROM chat_settings WHERE chat_id=%s",
+                            (chat_id,))
+    await database.fetchall("SELECT amount, user_name, timestamp FROM history WHERE chat_id=%s "
+                            "AND timestamp > NOW() - INTERVAL '1 day' ORDER BY timestamp",
+                            (chat_id,))
+
+
+async def run_mode(mode, chats, messages):
+    latencies = []
+    opened = 0
+
+    async def chat_loop(i):
+        nonlocal opened
+        chat_id = CHAT_BASE - i
+        for _ in range(messages):
+            t0 = time.perf_counter()
+            if mode == "before":
+                # 旧代码在 event loop 里直接阻塞
+                opened += legacy_record(chat_id, 1)
+            else:
+                await pooled_record(chat_id, 1)
+            latencies.append((time.perf_counter() - t0) * 1000)
+            await asyncio.sleep(0)
+
+    before_opened = database.connections_opened
+    t0 = time.perf_counter()
+    await asyncio.gather(*(chat_loop(i) for i in range(chats)))
+    elapsed = time.perf_counter() - t0
+
+    if mode == "after":
+        opened = database.connections_opened - before_opened
+
+    return {
+        "mode": mode,
+        "handlers": len(latencies),
+        "connections": opened,
+        "p50_ms": statistics.median(latencies),
+        "p99_ms": percentile(latencies, 99),
+        "per_sec": len(latencies) / elapsed,
+    }
+
+
+def cleanup(chats):
+    conn = database.get_db_connection()
+    cur = conn.cursor()
+    cur.execute("DELETE FROM history WHERE chat_id <= %s AND chat_id > %s",
+                (CHAT_BASE, CHAT_BASE - chats))
+    conn.commit()
+    conn.close()
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chats", type=int, default=20)
+    parser.add_argument("--messages", type=int, default=50)
+    args = parser.parse_args()
+
+    database.init_db()
+    try:
+        for mode in ("before", "after"):
+            r = await run_mode(mode, args.chats, args.messages)
+            print(f"{r['mode']:>6}: {r['handlers']} handlers | "
+                  f"connections opened {r['connections']} | "
+                  f"p50 {r['p50_ms']:.2f} ms | p99 {r['p99_ms']:.2f} ms | "
+                  f"{r['per_sec']:.0f}/s")
+    finally:
+        cleanup(args.chats)
+        database.close_pool()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
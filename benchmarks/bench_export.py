@@ -0,0 +1,94 @@
+"""
+/export 导出速度与内存：服务端游标分批读出 1M 行写成 CSV / XLSX
+
+用法（请使用测试库）:
+  DATABASE_URL=postgres://... python benchmarks/bench_export.py --rows 1000000 --format csv
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import resource
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+os.environ.setdefault("TOKEN", "bench")
+os.environ.setdefault("MASTER_ID", "0")
+
+import database
+import main
+from export import export_history, available
+
+CHAT_ID = -920000000000
+
+
+def seed(rows):
+    conn = database.get_db_connection()
+    cur = conn.cursor()
+    cur.execute("""
+        INSERT INTO history (chat_id, amount, user_name, timestamp)
+        SELECT %s, (g % 1000) + 0.5, 'bench_' || (g % 20), now() - g * interval '1 millisecond'
+        FROM generate_series(1, %s) AS g
+    """, (CHAT_ID, rows))
+    cur.execute("SELECT min(timestamp), max(timestamp) + interval '1 second' FROM history WHERE chat_id=%s",
+                (CHAT_ID,))
+    span = cur.fetchone()
+    conn.commit()
+    conn.close()
+    return span
+
+
+def cleanup():
+    conn = database.get_db_connection()
+    cur = conn.cursor()
+    cur.execute("DELETE FROM history WHERE chat_id=%s", (CHAT_ID,))
+    conn.commit()
+    conn.close()
+
+
+def max_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+async def bench():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=1000000)
+    parser.add_argument("--format", choices=["csv", "xlsx"], default="csv")
+    parser.add_argument("--batch", type=int, default=main.EXPORT_BATCH)
+    parser.add_argument("--part-rows", type=int, default=main.EXPORT_PART_ROWS)
+    args = parser.parse_args()
+
+    if not available(args.format):
+        sys.exit(f"{args.format} 不可用（需要 openpyxl）")
+
+    database.init_db()
+    try:
+        t0 = time.perf_counter()
+        start, end = seed(args.rows)
+        print(f"seed           : {args.rows} rows in {time.perf_counter() - t0:.1f}s")
+
+        written = []
+
+        async def send(file, part):
+            # 只统计大小，不上传
+            file.seek(0, os.SEEK_END)
+            written.append(file.tell())
+
+        rss_before = max_rss_mb()
+        t0 = time.perf_counter()
+        batches = database.stream(main.EXPORT_SQL, (CHAT_ID, start, end),
+                                  batch_size=args.batch, name="bench_export")
+        total, parts = await export_history(batches, 0, args.format, args.part_rows, send)
+        elapsed = time.perf_counter() - t0
+
+        print(f"export {args.format:<7} : {total} rows, {parts} files, "
+              f"{sum(written) / 1024 / 1024:.1f} MiB, {elapsed:.1f}s, {total / elapsed:.0f} rows/s")
+        print(f"max RSS        : {rss_before:.0f} MiB -> {max_rss_mb():.0f} MiB "
+              f"(batch {args.batch}, {args.part_rows} rows/file)")
+    finally:
+        cleanup()
+        database.close_pool()
+
+
+if __name__ == "__main__":
+    asyncio.run(bench())
@@ -0,0 +1,127 @@
+"""
+多进程扩展性：ingress.py + N 个 worker，对同一个数据库的吞吐量
+
+  DATABASE_URL=postgres://... python benchmarks/bench_sharding.py --workers 1,2,4 --chats 200 --updates 20000
+
+对每个 N：启动假的 Bot API（fake_bot_api.py）和 `ingress.py`（SHARD_WORKERS=N），
+每个群先发一条预热，再按轮询顺序发送 --updates 条 "+xx"，统计从第一条到最后一条回复的 updates/s。
+账单不合并（SUMMARY_DEBOUNCE_MS=0），发送限速放开，每条记账正好一条回复。
+发送者就是 MASTER_ID，不需要预先添加操作者。
+
+--backend sqlite 使用临时 SQLite 文件（写入在进程间串行，只用来在没有 Postgres 时检查流程）。
+"""
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, os.path.dirname(__file__))
+
+from fake_bot_api import FakeBotAPI, make_update
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+CHAT_BASE = -960000000000
+MASTER = 960000000
+REPLIES = ("sendMessage", "editMessageText")
+
+
+async def wait_replies(api, target, timeout):
+    deadline = time.monotonic() + timeout
+    while api.count(*REPLIES) < target:
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"{api.count(*REPLIES)}/{target} replies")
+        await asyncio.sleep(0.01)
+
+
+async def run(workers, args, env):
+    api = FakeBotAPI(port=args.port)
+    await api.start()
+
+    env = dict(
+        env,
+        TOKEN="123:bench", MASTER_ID=str(MASTER),
+        TELEGRAM_API_BASE=api.base_url,
+        SHARD_WORKERS=str(workers), SHARD_BASE_PORT=str(args.base_port),
+        SUMMARY_DEBOUNCE_MS="0",
+        OUTBOUND_GLOBAL_PER_SEC="1000000", OUTBOUND_GROUP_PER_MIN="1000000",
+        CONCURRENT_UPDATES=str(args.concurrent),
+    )
+    proc = await asyncio.create_subprocess_exec(
+        sys.executable, os.path.join(ROOT, "ingress.py"), cwd=ROOT, env=env,
+        stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL if not args.verbose else None)
+
+    try:
+        chats = [CHAT_BASE - i for i in range(args.chats)]
+
+        # 预热：worker 启动、连接池、每个群的本轮合计
+        for chat_id in chats:
+            api.push_update(make_update(api.next_update_id(), chat_id, MASTER, "+1", "warm"))
+        await wait_replies(api, len(chats), timeout=120)
+
+        before = api.count(*REPLIES)
+        t0 = time.perf_counter()
+        for i in range(args.updates):
+            api.push_update(make_update(api.next_update_id(), chats[i % len(chats)], MASTER,
+                                        f"+{random.randint(1, 5000)}", "bench"))
+            if i % 100 == 99:
+                await asyncio.sleep(0)
+        await wait_replies(api, before + args.updates, timeout=max(120, args.updates / 10))
+        elapsed = time.perf_counter() - t0
+    finally:
+        proc.terminate()
+        await proc.wait()
+        api.new_update.set()            # 结束还挂着的 getUpdates 长轮询
+        await api.stop()
+
+    return args.updates / elapsed
+
+
+def cleanup(chats):
+    import database
+
+    conn = database.get_db_connection()
+    cur = conn.cursor()
+    for table in ("history", "history_period_totals", "history_period_marks",
+                  "daily_rollup", "chat_settings"):
+        cur.execute(f"DELETE FROM {table} WHERE chat_id <= %s AND chat_id > %s",
+                    (CHAT_BASE, CHAT_BASE - chats))
+    conn.commit()
+    conn.close()
+
+
+async def bench():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", default="1,2,4")
+    parser.add_argument("--chats", type=int, default=200)
+    parser.add_argument("--updates", type=int, default=20000)
+    parser.add_argument("--concurrent", type=int, default=8)
+    parser.add_argument("--backend", choices=("postgres", "sqlite"), default="postgres")
+    parser.add_argument("--port", type=int, default=8091)
+    parser.add_argument("--base-port", type=int, default=9200)
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    tmp = tempfile.TemporaryDirectory()
+    env = dict(os.environ, STORAGE_BACKEND=args.backend)
+    if args.backend == "sqlite":
+        env["SQLITE_PATH"] = os.path.join(tmp.name, "bench.db")
+
+    results = []
+    try:
+        for workers in [int(n) for n in args.workers.split(",")]:
+            rate = await run(workers, args, env)
+            results.append((workers, rate))
+            print(f"workers {workers:>2}: {rate:8.0f} updates/s "
+                  f"(x{rate / results[0][1]:.2f})", flush=True)
+            if args.backend == "postgres":
+                cleanup(args.chats)
+    finally:
+        tmp.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(bench())
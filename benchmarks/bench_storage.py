@@ -0,0 +1,82 @@
+"""
+存储后端单次操作延迟对比（p50 / p99）
+
+  python benchmarks/bench_storage.py --ops 2000                       只测 sqlite（临时文件）
+  DATABASE_URL=postgres://... python benchmarks/bench_storage.py      sqlite + postgres（请使用测试库）
+
+每个后端依次测 record_entry / load_period / load_page / undo_last，使用专用的负数 chat_id，结束时清理。
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import tempfile
+from decimal import Decimal
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from storage import open_storage
+
+CHAT_BASE = -940000000000
+EPOCH = datetime(1970, 1, 1)
+
+
+def quantile(samples, q):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * q))]
+
+
+async def timed(results, name, coro):
+    t0 = time.perf_counter()
+    result = await coro
+    results.setdefault(name, []).append((time.perf_counter() - t0) * 1000)
+    return result
+
+
+async def bench(s, ops, chats):
+    start = datetime.utcnow() - timedelta(hours=1)
+    end = start + timedelta(days=1)
+    results = {}
+
+    for i in range(ops):
+        chat_id = CHAT_BASE - i % chats
+        await timed(results, "record_entry",
+                    s.record_entry(chat_id, 0, True, f"u{i % 5}", Decimal("1.5"), start, end, 6))
+    for i in range(ops):
+        await timed(results, "load_period", s.load_period(CHAT_BASE - i % chats, start, end))
+    for i in range(ops):
+        await timed(results, "load_page",
+                    s.load_page(CHAT_BASE - i % chats, start, end, "n", (EPOCH, 0), 30))
+    for i in range(ops):
+        await timed(results, "undo_last", s.undo_last(CHAT_BASE - i % chats, start, end))
+
+    for i in range(chats):
+        await s.clear_chat(CHAT_BASE - i)
+    return results
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ops", type=int, default=2000)
+    parser.add_argument("--chats", type=int, default=20)
+    args = parser.parse_args()
+
+    backends = ["sqlite"] + (["postgres"] if os.getenv("DATABASE_URL") else [])
+    with tempfile.TemporaryDirectory() as tmp:
+        print(f"{'backend':<10}{'operation':<14}{'p50 ms':>9}{'p99 ms':>9}")
+        for backend in backends:
+            s = open_storage(backend, os.path.join(tmp, "bench.db"))
+            await s.init()
+            try:
+                results = await bench(s, args.ops, args.chats)
+            finally:
+                await s.close()
+            for name, samples in results.items():
+                print(f"{backend:<10}{name:<14}"
+                      f"{quantile(samples, 0.5):>9.3f}{quantile(samples, 0.99):>9.3f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
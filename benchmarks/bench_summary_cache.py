@@ -0,0 +1,65 @@
+"""
+摘要渲染缓存：重复的 /report 命中缓存 vs 每次重新格式化
+
+  python benchmarks/bench_summary_cache.py --entries 50 --reads 20000
+
+使用 sqlite 临时库运行 main.py 的 render_summary / render_all_page，不需要 Postgres。
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import tempfile
+from decimal import Decimal
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+CHAT_ID = -950000000001
+
+
+async def run(entries, reads):
+    import main
+
+    await main.storage.init()
+    start_utc, end_utc, _ = await main.get_work_period(CHAT_ID)
+    for i in range(entries):
+        result = await main.storage.record_entry(CHAT_ID, 0, True, f"user{i % 7}",
+                                                 Decimal("1234.56") + i, start_utc, end_utc, 6)
+        main.ledger.replace(CHAT_ID, start_utc, *result)
+
+    for name, render in (("summary", main.render_summary), ("all page 1", main.render_all_page)):
+        await render(CHAT_ID)
+
+        t0 = time.perf_counter()
+        for _ in range(reads):
+            await render(CHAT_ID)
+        cached = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        for _ in range(reads):
+            main.ledger.bump(CHAT_ID)          # 每次都像刚有新的写入
+            await render(CHAT_ID)
+        uncached = time.perf_counter() - t0
+
+        print(f"{name:<11} cached {cached / reads * 1e6:8.1f} us/read   "
+              f"re-rendered {uncached / reads * 1e6:8.1f} us/read   "
+              f"({uncached / cached:.0f}x)")
+
+    await main.storage.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--entries", type=int, default=50)
+    parser.add_argument("--reads", type=int, default=20000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ.update(TOKEN="123:bench", MASTER_ID="0", STORAGE_BACKEND="sqlite",
+                          SQLITE_PATH=os.path.join(tmp, "bench.db"))
+        asyncio.run(run(args.entries, args.reads))
+
+
+if __name__ == "__main__":
+    main()
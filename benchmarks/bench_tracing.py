@@ -0,0 +1,87 @@
+"""
+SQL 追踪的开销：同一批查询在 tracing 开 / 关时的耗时对比
+
+  DATABASE_URL=postgres://... python benchmarks/bench_tracing.py --queries 5000
+
+--no-db 只测 tracing.record()（归一化 + 累计）本身每条语句的 CPU 开销，不需要数据库。
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+os.environ.setdefault("TOKEN", "bench")
+os.environ.setdefault("MASTER_ID", "0")
+
+import metrics
+import tracing
+
+# 与 load_recent_rows 相同形状的查询
+QUERY = """
+    SELECT id, amount, user_name, timestamp
+    FROM history
+    WHERE chat_id=%s
+    AND timestamp BETWEEN %s AND %s
+    ORDER BY timestamp DESC, id DESC
+    LIMIT %s
+"""
+
+
+class _Cursor:
+    name = None
+
+
+def bench_record(n):
+    cursor = _Cursor()
+    params = (-1, None, None, 6)
+    with metrics.track("bench"):
+        t0 = time.perf_counter()
+        for _ in range(n):
+            tracing.record(cursor, QUERY, params, 0.0001)
+        elapsed = time.perf_counter() - t0
+    print(f"tracing.record : {elapsed / n * 1e9:.0f} ns/statement")
+
+
+async def bench_db(n):
+    import database
+    from datetime import datetime, timezone
+
+    now = datetime.now(timezone.utc)
+
+    def queries(cursor, count):
+        for _ in range(count):
+            cursor.execute(QUERY, (-1, now, now, 6))
+            cursor.fetchall()
+
+    await database.run(queries, 100)          # 预热连接池和计划缓存
+
+    results = {}
+    for enabled in (False, True, False, True):
+        tracing.enabled = enabled
+        with metrics.track("bench"):
+            t0 = time.perf_counter()
+            await database.run(queries, n)
+            results.setdefault(enabled, []).append(time.perf_counter() - t0)
+    database.close_pool()
+
+    off, on = min(results[False]), min(results[True])
+    print(f"tracing off    : {off / n * 1e6:.1f} us/statement")
+    print(f"tracing on     : {on / n * 1e6:.1f} us/statement "
+          f"(+{(on - off) / n * 1e6:.1f} us, {(on / off - 1) * 100:+.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--queries", type=int, default=5000)
+    parser.add_argument("--no-db", action="store_true")
+    args = parser.parse_args()
+
+    bench_record(args.queries * 20)
+    if not args.no_db:
+        asyncio.run(bench_db(args.queries))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""
+Webhook 与 polling 的延迟对比，以及向本地 webhook 投递录制的 Update。
+
+latency: 启动假的 Bot API（fake_bot_api.py），分别以 polling / webhook 模式
+运行 main.py，逐条发送 /start，统计从投递更新到机器人回复的延迟。
+需要 DATABASE_URL（测试库）。
+
+  DATABASE_URL=postgres://... python benchmarks/bench_webhook.py latency --count 200
+
+post: 把 JSONL 文件里的 Update（每行一个）POST 到正在运行的 webhook。
+
+  python benchmarks/bench_webhook.py post updates.jsonl \\
+      --url http://127.0.0.1:8443/telegram --secret xxx
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import statistics
+from urllib.parse import urlsplit
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+from fake_bot_api import FakeBotAPI, make_update
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+SECRET = "bench-secret"
+
+
+async def post_json(url, payload, secret):
+    parts = urlsplit(url)
+    reader, writer = await asyncio.open_connection(parts.hostname, parts.port or 80)
+    body = json.dumps(payload).encode()
+    writer.write(
+        f"POST {parts.path} HTTP/1.1\r\n"
+        f"Host: {parts.netloc}\r\n"
+        "Content-Type: application/json\r\n"
+        f"X-Telegram-Bot-Api-Secret-Token: {secret}\r\n"
+        f"Content-Length: {len(body)}\r\n"
+        "Connection: close\r\n\r\n".encode() + body
+    )
+    await writer.drain()
+    status = (await reader.readline()).decode().split(" ")[1]
+    writer.close()
+    return int(status)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[max(0, min(len(values) - 1, round(p / 100 * (len(values) - 1))))]
+
+
+async def start_bot(mode, api, port):
+    env = dict(os.environ,
+               TOKEN="123:bench", MASTER_ID="1",
+               TELEGRAM_API_BASE=api.base_url)
+    if mode == "webhook":
+        env.update(WEBHOOK_URL=f"http://127.0.0.1:{port}", WEBHOOK_SECRET=SECRET,
+                   WEBHOOK_LISTEN="127.0.0.1", PORT=str(port))
+    proc = await asyncio.create_subprocess_exec(sys.executable, "main.py", cwd=ROOT, env=env)
+
+    # 等机器人准备好：webhook 等 setWebhook，polling 等第一次 getUpdates
+    ready = "setWebhook" if mode == "webhook" else "getUpdates"
+    while not api.count(ready):
+        await asyncio.sleep(0.05)
+    await asyncio.sleep(0.5)
+    return proc
+
+
+async def latency(mode, count, port):
+    api = FakeBotAPI(port=port + 1)
+    await api.start()
+    proc = await start_bot(mode, api, port)
+
+    results = []
+    try:
+        for i in range(count):
+            chat_id = 10_000 + i
+            update = make_update(api.next_update_id(), chat_id, chat_id, "/start")
+            replied = api.wait_for(chat_id)
+
+            t0 = time.monotonic()
+            if mode == "webhook":
+                await post_json(f"http://127.0.0.1:{port}/telegram", update, SECRET)
+            else:
+                api.push_update(update)
+            results.append((await asyncio.wait_for(replied, 10) - t0) * 1000)
+    finally:
+        proc.terminate()
+        await proc.wait()
+        await api.stop()
+
+    return results
+
+
+async def cmd_latency(args):
+    for mode in ("polling", "webhook"):
+        r = await latency(mode, args.count, args.port)
+        print(f"{mode:>8}: p50 {statistics.median(r):.2f} ms | "
+              f"p95 {percentile(r, 95):.2f} ms | p99 {percentile(r, 99):.2f} ms")
+
+
+async def cmd_post(args):
+    with open(args.file, encoding="utf-8") as f:
+        updates = [json.loads(line) for line in f if line.strip()]
+
+    timings = []
+    for update in updates:
+        t0 = time.perf_counter()
+        status = await post_json(args.url, update, args.secret)
+        timings.append((time.perf_counter() - t0) * 1000)
+        if status != 200:
+            print(f"update {update.get('update_id')}: HTTP {status}")
+
+    print(f"posted {len(updates)} updates | ack p50 {statistics.median(timings):.2f} ms | "
+          f"p99 {percentile(timings, 99):.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("latency")
+    p.add_argument("--count", type=int, default=200)
+    p.add_argument("--port", type=int, default=18443)
+
+    p = sub.add_parser("post")
+    p.add_argument("file")
+    p.add_argument("--url", required=True)
+    p.add_argument("--secret", required=True)
+
+    args = parser.parse_args()
+    asyncio.run(cmd_latency(args) if args.command == "latency" else cmd_post(args))
+
+
+if __name__ == "__main__":
+    main()
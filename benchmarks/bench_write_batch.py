@@ -0,0 +1,98 @@
+"""
+历史写入吞吐量：每条单独提交 vs WriteBehindQueue 批量提交
+
+用法（请使用测试库）:
+  DATABASE_URL=postgres://... python benchmarks/bench_write_batch.py --chats 50 --entries 40 --window-ms 5
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+from decimal import Decimal
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+os.environ.setdefault("TOKEN", "bench")
+os.environ.setdefault("MASTER_ID", "0")
+
+import database
+import pg_storage
+from writebehind import WriteBehindQueue
+
+CHAT_BASE = -910000000000
+PERIOD = datetime(2000, 1, 1, tzinfo=timezone.utc)
+
+
+def insert_one(cursor, chat_id, amount):
+    cursor.execute(
+        "INSERT INTO history (chat_id, amount, user_name, timestamp) VALUES (%s,%s,%s,%s) "
+        "RETURNING id, timestamp",
+        (chat_id, amount, "bench", datetime.now(timezone.utc))
+    )
+    return cursor.fetchone()
+
+
+async def per_row(chats, entries):
+    async def chat_loop(chat_id):
+        for _ in range(entries):
+            await database.run(insert_one, chat_id, Decimal("1"))
+
+    await asyncio.gather(*(chat_loop(CHAT_BASE - i) for i in range(chats)))
+
+
+async def batched(chats, entries, window_ms):
+    writer = WriteBehindQueue(lambda e: database.run(pg_storage.insert_history_batch, e),
+                              window_ms=window_ms)
+    writer.start()
+
+    async def chat_loop(chat_id):
+        for _ in range(entries):
+            await writer.submit((chat_id, PERIOD, "bench", Decimal("1"),
+                                 datetime.now(timezone.utc)))
+
+    await asyncio.gather(*(chat_loop(CHAT_BASE - i) for i in range(chats)))
+    await writer.stop()
+    return writer.batches
+
+
+def cleanup(chats):
+    conn = database.get_db_connection()
+    cur = conn.cursor()
+    cur.execute("DELETE FROM history WHERE chat_id <= %s AND chat_id > %s",
+                (CHAT_BASE, CHAT_BASE - chats))
+    cur.execute("DELETE FROM history_period_totals WHERE chat_id <= %s AND chat_id > %s",
+                (CHAT_BASE, CHAT_BASE - chats))
+    cur.execute("DELETE FROM history_period_marks WHERE chat_id <= %s AND chat_id > %s",
+                (CHAT_BASE, CHAT_BASE - chats))
+    conn.commit()
+    conn.close()
+
+
+async def bench():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chats", type=int, default=50)
+    parser.add_argument("--entries", type=int, default=40)
+    parser.add_argument("--window-ms", type=int, default=5)
+    args = parser.parse_args()
+
+    database.init_db()
+    total = args.chats * args.entries
+    try:
+        t0 = time.perf_counter()
+        await per_row(args.chats, args.entries)
+        elapsed = time.perf_counter() - t0
+        print(f"per-row commit : {total} rows, {total} commits, {total / elapsed:.0f} rows/s")
+
+        t0 = time.perf_counter()
+        batches = await batched(args.chats, args.entries, args.window_ms)
+        elapsed = time.perf_counter() - t0
+        print(f"group commit   : {total} rows, {batches} commits, {total / elapsed:.0f} rows/s "
+              f"(window {args.window_ms} ms)")
+    finally:
+        cleanup(args.chats)
+        database.close_pool()
+
+
+if __name__ == "__main__":
+    asyncio.run(bench())
@@ -0,0 +1,183 @@
+"""
+本地假的 Telegram Bot API（只用标准库），给 benchmark 用。
+
+机器人设置 TELEGRAM_API_BASE=http://127.0.0.1:<port> 后，所有请求发到这里：
+getMe / setWebhook / deleteWebhook / getUpdates（长轮询）/ sendMessage /
+editMessageText / sendDocument / getChat / answerCallbackQuery。
+每次调用记录在 calls 里，可以用 wait_for() 等某个群的回复。
+"""
+import json
+import time
+import asyncio
+import itertools
+from urllib.parse import parse_qsl
+
+
+def make_update(update_id, chat_id, user_id, text, first_name="user", reply_to=None):
+    """生成一条 Telegram Update JSON（群消息 chat_id < 0）"""
+    chat = {"id": chat_id, "type": "group" if chat_id < 0 else "private"}
+    if chat_id < 0:
+        chat["title"] = f"group {chat_id}"
+    message = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": chat,
+        "from": {"id": user_id, "is_bot": False, "first_name": first_name},
+        "text": text,
+    }
+    if text.startswith("/"):
+        command = text.split()[0]
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(command)}]
+    if reply_to:
+        message["reply_to_message"] = reply_to
+    return {"update_id": update_id, "message": message}
+
+
+class FakeBotAPI:
+    def __init__(self, host="127.0.0.1", port=8081):
+        self.host = host
+        self.port = port
+        self.server = None
+        self.updates = []
+        self.update_ids = itertools.count(1)
+        self.new_update = asyncio.Event()
+        self.message_ids = itertools.count(1)
+        self.calls = []             # (monotonic, method, params)
+        self.waiters = []           # (chat_id, methods, future)
+
+    @property
+    def base_url(self):
+        return f"http://{self.host}:{self.port}"
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._serve, self.host, self.port)
+
+    async def stop(self):
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+
+    def push_update(self, update):
+        self.updates.append(update)
+        self.new_update.set()
+
+    def next_update_id(self):
+        return next(self.update_ids)
+
+    def count(self, *methods):
+        return sum(1 for _, m, _ in self.calls if not methods or m in methods)
+
+    def wait_for(self, chat_id, methods=("sendMessage", "editMessageText", "sendDocument")):
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.append((chat_id, methods, future))
+        return future
+
+    # ==============================
+    # HTTP
+    # ==============================
+
+    async def _serve(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                _, path, _ = request_line.decode().split(" ", 2)
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    key, value = line.decode().split(":", 1)
+                    headers[key.strip().lower()] = value.strip()
+
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                method = path.rstrip("/").rsplit("/", 1)[-1]
+                params = self._parse(headers.get("content-type", ""), body)
+
+                result = await self._handle(method, params)
+                payload = json.dumps({"ok": True, "result": result}).encode()
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\n"
+                    b"Content-Type: application/json\r\n"
+                    + f"Content-Length: {len(payload)}\r\n\r\n".encode()
+                    + payload
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    def _parse(content_type, body):
+        if "json" in content_type:
+            return json.loads(body or b"{}")
+        if "multipart" in content_type:
+            # 只取普通字段（chat_id 等），文件内容忽略
+            params = {}
+            for part in body.split(b"--" + content_type.split("boundary=")[1].encode()):
+                if b'name="' not in part or b"filename=" in part:
+                    continue
+                head, _, value = part.partition(b"\r\n\r\n")
+                name = head.split(b'name="')[1].split(b'"')[0].decode()
+                params[name] = value.rstrip(b"\r\n").decode(errors="replace")
+            return params
+        return dict(parse_qsl(body.decode()))
+
+    def _message(self, chat_id, text=None):
+        chat_id = int(chat_id)
+        return {
+            "message_id": next(self.message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "group" if chat_id < 0 else "private"},
+            "text": text or "",
+        }
+
+    async def _handle(self, method, params):
+        now = time.monotonic()
+        self.calls.append((now, method, params))
+
+        chat_id = params.get("chat_id")
+        if chat_id is not None:
+            for waiter in list(self.waiters):
+                if str(waiter[0]) == str(chat_id) and method in waiter[1]:
+                    self.waiters.remove(waiter)
+                    if not waiter[2].done():
+                        waiter[2].set_result(now)
+
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        if method == "getUpdates":
+            return await self._get_updates(params)
+        if method in ("sendMessage", "sendDocument"):
+            return self._message(chat_id, params.get("text"))
+        if method == "editMessageText":
+            message = self._message(chat_id, params.get("text"))
+            message["message_id"] = int(params.get("message_id", 0))
+            return message
+        if method == "getChat":
+            chat_id = int(chat_id)
+            chat = {"id": chat_id, "accent_color_id": 0, "max_reaction_count": 11}
+            if chat_id < 0:
+                chat.update(type="group", title=f"group {chat_id}")
+            else:
+                chat.update(type="private", first_name=f"user {chat_id}")
+            return chat
+        return True
+
+    async def _get_updates(self, params):
+        offset = int(params.get("offset") or 0)
+        timeout = float(params.get("timeout") or 0)
+        self.updates = [u for u in self.updates if u["update_id"] >= offset]
+
+        if not self.updates and timeout:
+            self.new_update.clear()
+            try:
+                await asyncio.wait_for(self.new_update.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+        limit = int(params.get("limit") or 100)
+        return self.updates[:limit]
@@ -0,0 +1,198 @@
+"""
+整体压测：在本进程里运行 main.py 的 Application（polling 模式），
+连接假的 Bot API（fake_bot_api.py）和本地 Postgres，发送合成的群消息。
+
+流量：N 个群，每群 M 个操作者，按比例混合 "+xx" / /report / /undo / /all。
+输出：updates/s、handler 延迟 p50/p95/p99（总体和按类型）、
+每条更新的 SQL 语句数、每条更新的 Bot API 调用数。
+
+用法（请使用测试库，结束后会删除生成的数据）:
+  DATABASE_URL=postgres://... python benchmarks/loadtest.py \\
+      --chats 50 --operators 5 --updates 5000 --mix amount=80,report=10,undo=5,all=5
+"""
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+import statistics
+from collections import defaultdict
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, os.path.dirname(__file__))
+
+from fake_bot_api import FakeBotAPI, make_update
+
+CHAT_BASE = -970000000000
+OPERATOR_BASE = 970000000
+TEXTS = {
+    "amount": lambda: f"+{random.randint(1, 5000)}.{random.randint(0, 99):02d}",
+    "report": lambda: "/report",
+    "undo": lambda: "/undo",
+    "all": lambda: "/all",
+}
+# 不算在“每条更新的 API 调用”里的调用
+IDLE_METHODS = ("getMe", "getUpdates", "deleteWebhook", "setWebhook")
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        kind, _, weight = part.partition("=")
+        if kind not in TEXTS:
+            raise argparse.ArgumentTypeError(f"unknown kind: {kind}")
+        mix[kind] = float(weight or 1)
+    return mix
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[max(0, min(len(values) - 1, round(p / 100 * (len(values) - 1))))]
+
+
+def seed(database, chats, operators):
+    conn = database.get_db_connection()
+    cur = conn.cursor()
+    for c in range(chats):
+        for o in range(operators):
+            cur.execute(
+                "INSERT INTO team_members (member_id, chat_id, username) VALUES (%s,%s,%s) "
+                "ON CONFLICT DO NOTHING",
+                (OPERATOR_BASE + o, CHAT_BASE - c, f"op{o}")
+            )
+    conn.commit()
+    conn.close()
+
+
+def cleanup(database, chats):
+    conn = database.get_db_connection()
+    cur = conn.cursor()
+    for table, column in (("history", "chat_id"), ("history_period_totals", "chat_id"),
+                          ("history_period_marks", "chat_id"),
+                          ("daily_rollup", "chat_id"), ("team_members", "chat_id"),
+                          ("chat_settings", "chat_id"), ("chat_directory", "id")):
+        cur.execute(f"DELETE FROM {table} WHERE {column} <= %s AND {column} > %s",
+                    (CHAT_BASE, CHAT_BASE - chats))
+    conn.commit()
+    conn.close()
+
+
+async def bench():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chats", type=int, default=50)
+    parser.add_argument("--operators", type=int, default=5)
+    parser.add_argument("--updates", type=int, default=5000)
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("amount=80,report=10,undo=5,all=5"))
+    parser.add_argument("--rate", type=float, default=0, help="每秒发送多少条，0 = 尽快")
+    parser.add_argument("--concurrent", type=int, default=int(os.getenv("CONCURRENT_UPDATES", "8")))
+    parser.add_argument("--group-per-min", type=int, default=int(os.getenv("OUTBOUND_GROUP_PER_MIN", "20")))
+    parser.add_argument("--port", type=int, default=18081)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    api = FakeBotAPI(port=args.port)
+    await api.start()
+
+    # main.py 在导入时读取配置
+    os.environ.update(
+        TOKEN="123:bench", MASTER_ID="1",
+        TELEGRAM_API_BASE=api.base_url,
+        CONCURRENT_UPDATES=str(args.concurrent),
+        OUTBOUND_GROUP_PER_MIN=str(args.group_per_min),
+    )
+    import database
+    import main
+    from telegram import Update
+    from telegram.ext import TypeHandler
+
+    database.init_db()
+    seed(database, args.chats, args.operators)
+
+    started = {}
+    latencies = defaultdict(list)       # kind -> [ms]
+    kinds = {}                          # update_id -> kind
+    done = asyncio.Event()
+
+    async def stamp_start(update, context):
+        started[update.update_id] = time.perf_counter()
+
+    async def stamp_end(update, context):
+        t0 = started.pop(update.update_id, None)
+        if t0 is not None:
+            latencies[kinds[update.update_id]].append((time.perf_counter() - t0) * 1000)
+        if sum(len(v) for v in latencies.values()) >= args.updates:
+            done.set()
+
+    app = main.build_app()
+    app.add_handler(TypeHandler(Update, stamp_start), group=-1)
+    app.add_handler(TypeHandler(Update, stamp_end), group=1)
+
+    population = list(args.mix)
+    weights = [args.mix[k] for k in population]
+
+    try:
+        await app.initialize()
+        await main.on_startup(app)
+        await app.updater.start_polling(poll_interval=0, timeout=10)
+        await app.start()
+
+        api_before = len(api.calls)
+        statements_before = database.statements_executed
+        t_start = time.perf_counter()
+
+        for i in range(args.updates):
+            kind = random.choices(population, weights)[0]
+            chat_id = CHAT_BASE - random.randrange(args.chats)
+            operator = random.randrange(args.operators)
+            update = make_update(api.next_update_id(), chat_id, OPERATOR_BASE + operator,
+                                 TEXTS[kind](), first_name=f"op{operator}")
+            kinds[update["update_id"]] = kind
+            api.push_update(update)
+
+            if args.rate:
+                await asyncio.sleep(max(0.0, t_start + (i + 1) / args.rate - time.perf_counter()))
+            elif i % 100 == 99:
+                await asyncio.sleep(0)
+
+        await asyncio.wait_for(done.wait(), timeout=max(60, args.updates / 10))
+        elapsed = time.perf_counter() - t_start
+        statements = database.statements_executed - statements_before
+
+        # 等合并后的账单发完再统计 API 调用
+        await asyncio.sleep(main.SUMMARY_DEBOUNCE_MS / 1000 + 1)
+        api_calls = defaultdict(int)
+        for _, method, _ in api.calls[api_before:]:
+            if method not in IDLE_METHODS:
+                api_calls[method] += 1
+    finally:
+        if app.updater.running:
+            await app.updater.stop()
+        if app.running:
+            await app.stop()
+        await main.on_stop(app)
+        await main.on_shutdown(app)
+        await app.shutdown()
+        await api.stop()
+        cleanup(database, args.chats)
+
+    total = sum(len(v) for v in latencies.values())
+    everything = [ms for v in latencies.values() for ms in v]
+    print(f"updates        : {total} in {elapsed:.2f}s = {total / elapsed:.0f} updates/s "
+          f"({args.chats} chats x {args.operators} operators, concurrent {args.concurrent})")
+    print(f"handler        : p50 {statistics.median(everything):.2f} ms | "
+          f"p95 {percentile(everything, 95):.2f} ms | p99 {percentile(everything, 99):.2f} ms")
+    for kind in population:
+        v = latencies.get(kind)
+        if v:
+            print(f"  {kind:<12} : {len(v):>6} | p50 {statistics.median(v):.2f} ms | "
+                  f"p95 {percentile(v, 95):.2f} ms | p99 {percentile(v, 99):.2f} ms")
+    print(f"DB statements  : {statements / total:.2f} per update ({statements} total)")
+    calls = sum(api_calls.values())
+    detail = ", ".join(f"{m} {n}" for m, n in sorted(api_calls.items()))
+    print(f"Bot API calls  : {calls / total:.2f} per update ({detail})")
+
+
+if __name__ == "__main__":
+    asyncio.run(bench())
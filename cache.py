@@ -0,0 +1,151 @@
+import time
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+
+logger = logging.getLogger(__name__)
+
+
+def utc_naive(dt):
+    """数据库 TIMESTAMPTZ → 与 datetime.utcnow() 可比较的 naive UTC"""
+    if dt is not None and dt.tzinfo is not None:
+        return dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return dt
+
+
+def utc_aware(dt):
+    """naive UTC → 带时区的 UTC。传给 Postgres 的 TIMESTAMPTZ 参数不依赖会话的 TimeZone"""
+    if dt is not None and dt.tzinfo is None:
+        return dt.replace(tzinfo=timezone.utc)
+    return dt
+
+
+# ==============================
+# 权限缓存
+# ==============================
+
+class PermissionCache:
+    """
+    进程内的 Owner / 操作者 缓存。
+
+    启动时整表读取 admins / team_members，之后 add/remove/renew 直接写入，
+    查询不访问数据库。每 ttl 秒在后台重新整表读取一次，用来同步其他进程的修改。
+    """
+
+    def __init__(self, loader, ttl=300):
+        self.loader = loader
+        self.ttl = ttl
+        self.owners = {}        # user_id -> expire_date (naive UTC)
+        self.members = set()    # (member_id, chat_id)
+        self.loaded_at = None
+        self._refreshing = None
+        self._writes = 0
+
+    def load(self, owners, members):
+        self.owners = {uid: utc_naive(exp) for uid, exp in owners}
+        self.members = {(mid, cid) for mid, cid in members}
+        self.loaded_at = time.monotonic()
+
+    async def refresh(self):
+        writes = self._writes
+        owners, members = await self.loader()
+        # 读取期间本进程有写入 → 这份快照可能已过时，保留当前数据等下次刷新
+        if self.loaded_at is None or writes == self._writes:
+            self.load(owners, members)
+
+    async def ensure(self):
+        if self.loaded_at is None:
+            await self.refresh()
+        elif time.monotonic() - self.loaded_at > self.ttl and not self._refreshing:
+            self._refreshing = asyncio.create_task(self._background_refresh())
+
+    async def _background_refresh(self):
+        try:
+            await self.refresh()
+        except Exception:
+            logger.exception("权限缓存刷新失败")
+        finally:
+            self._refreshing = None
+
+    def owner_expire(self, user_id):
+        return self.owners.get(user_id)
+
+    def is_owner(self, user_id, now=None):
+        expire = self.owners.get(user_id)
+        return expire is not None and expire > (now or datetime.utcnow())
+
+    def is_operator(self, user_id, chat_id):
+        return (user_id, chat_id) in self.members
+
+    def set_owner(self, user_id, expire):
+        self._writes += 1
+        self.owners[user_id] = utc_naive(expire)
+
+    def add_member(self, user_id, chat_id):
+        self._writes += 1
+        self.members.add((user_id, chat_id))
+
+    def remove_member(self, user_id, chat_id):
+        self._writes += 1
+        self.members.discard((user_id, chat_id))
+
+
+# ==============================
+# 群组设置缓存 / 工作时间段
+# ==============================
+
+def compute_work_period(tz, work_start, now_utc):
+    """纯计算：返回 now_utc 所在工作轮次 (start_utc, end_utc, tz)"""
+    now_local = now_utc + timedelta(hours=tz)
+
+    today_start = datetime.combine(now_local.date(), work_start)
+    if now_local < today_start:
+        today_start -= timedelta(days=1)
+
+    start_utc = today_start - timedelta(hours=tz)
+    end_utc = start_utc + timedelta(days=1)
+
+    return start_utc, end_utc, tz
+
+
+class ChatSettingsCache:
+    """
+    chat_id -> (timezone, work_start)。
+
+    set_timezone / set_worktime 直接写入；当前工作轮次算一次后
+    一直用到轮次结束。超过 ttl 秒的设置下次使用时重新读取。
+    """
+
+    def __init__(self, loader, ttl=300):
+        self.loader = loader
+        self.ttl = ttl
+        self.settings = {}      # chat_id -> (tz, work_start, loaded_at)
+        self.periods = {}       # chat_id -> (start_utc, end_utc, tz)
+
+    async def get(self, chat_id):
+        entry = self.settings.get(chat_id)
+        if entry is None or time.monotonic() - entry[2] > self.ttl:
+            tz, work_start = await self.loader(chat_id)
+            self.set(chat_id, tz, work_start)
+            entry = self.settings[chat_id]
+        return entry[0], entry[1]
+
+    def set(self, chat_id, tz, work_start):
+        old = self.settings.get(chat_id)
+        self.settings[chat_id] = (tz, work_start, time.monotonic())
+        if old is None or old[:2] != (tz, work_start):
+            self.periods.pop(chat_id, None)
+
+    async def work_period(self, chat_id, now=None):
+        now = now or datetime.utcnow()
+
+        entry = self.settings.get(chat_id)
+        period = self.periods.get(chat_id)
+        if (period and period[0] <= now < period[1]
+                and entry and time.monotonic() - entry[2] <= self.ttl):
+            return period
+
+        tz, work_start = await self.get(chat_id)
+        period = compute_work_period(tz, work_start, now)
+        self.periods[chat_id] = period
+        return period
@@ -0,0 +1,140 @@
+import time
+import asyncio
+import logging
+
+from telegram.error import BadRequest
+
+logger = logging.getLogger(__name__)
+
+
+# ==============================
+# 账单合并发送
+# ==============================
+
+class SummaryCoalescer:
+    """
+    记账 / 撤销 / 重置后的账单回复合并发送。
+
+    一个群第一次请求后等 debounce_ms，期间的请求只保留最新一次，
+    到时渲染一次：如果该群上一条账单消息发出不到 edit_window 秒，
+    就用 edit_message_text 原地更新，否则发新消息。
+    同一个群同时只有一次发送：发送期间来的请求只记下最新的 render，
+    发送完成后再开始下一次计时，这样下一次能编辑刚发出的那条消息。
+    debounce_ms <= 0 时关闭合并，每次都发新消息。
+
+    超过 edit_window 的消息记录不再有用，会被清理，不活跃的群不占内存。
+    """
+
+    def __init__(self, debounce_ms=1000, edit_window=60, parse_mode="Markdown"):
+        self.debounce = debounce_ms / 1000
+        self.edit_window = edit_window
+        self.parse_mode = parse_mode
+        self.timers = {}    # chat_id -> asyncio.Task
+        self.renders = {}   # chat_id -> (bot, render)
+        self.last = {}      # chat_id -> (message_id, sent_at, text)
+        self.locks = {}     # chat_id -> [asyncio.Lock, 引用数]，串行化同一个群的发送
+        self.publishing = {}    # chat_id -> 正在发送的 _fire 任务
+        self.closing = False
+        self.prune_at = 1000
+        self.requested = 0
+        self.published = 0
+
+    async def request(self, bot, chat_id, render):
+        """render: async () -> text"""
+        self.requested += 1
+
+        if self.debounce <= 0:
+            await self._publish(bot, chat_id, render, edit=False)
+            return
+
+        self.renders[chat_id] = (bot, render)
+        if chat_id not in self.timers and chat_id not in self.publishing:
+            self.timers[chat_id] = asyncio.create_task(self._fire(chat_id))
+
+    async def flush(self, bot, chat_id, render):
+        """立即发一条新的账单（/report），取消该群待发送的合并"""
+        timer = self.timers.pop(chat_id, None)
+        if timer:
+            timer.cancel()
+        self.renders.pop(chat_id, None)
+        await self._publish(bot, chat_id, render, edit=False)
+
+    async def close(self):
+        """停止前把所有待发送的账单发出去，并等正在发送的完成"""
+        self.closing = True
+        for chat_id in list(self.renders):
+            timer = self.timers.pop(chat_id, None)
+            if timer:
+                timer.cancel()
+            bot, render = self.renders.pop(chat_id)
+            try:
+                await self._publish(bot, chat_id, render, edit=True)
+            except Exception:
+                logger.exception("账单发送失败 chat=%s", chat_id)
+
+        if self.publishing:
+            await asyncio.gather(*self.publishing.values(), return_exceptions=True)
+
+    async def _fire(self, chat_id):
+        try:
+            await asyncio.sleep(self.debounce)
+        except asyncio.CancelledError:
+            return
+
+        self.timers.pop(chat_id, None)
+        bot, render = self.renders.pop(chat_id)
+        self.publishing[chat_id] = asyncio.current_task()
+        try:
+            await self._publish(bot, chat_id, render, edit=True)
+        except Exception:
+            logger.exception("账单发送失败 chat=%s", chat_id)
+        finally:
+            del self.publishing[chat_id]
+            # 发送期间又有请求 → 现在再开始一次计时（停止时由 close 发出）
+            if chat_id in self.renders and chat_id not in self.timers and not self.closing:
+                self.timers[chat_id] = asyncio.create_task(self._fire(chat_id))
+
+    async def _publish(self, bot, chat_id, render, edit):
+        entry = self.locks.get(chat_id)
+        if entry is None:
+            entry = self.locks[chat_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await self._send(bot, chat_id, render, edit)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.locks[chat_id]
+
+    def _prune(self, now):
+        """去掉已经超过 edit_window、不会再编辑的消息记录"""
+        if len(self.last) < self.prune_at:
+            return
+        for chat_id in [c for c, last in self.last.items() if now - last[1] > self.edit_window]:
+            del self.last[chat_id]
+        self.prune_at = max(1000, len(self.last) * 2)
+
+    async def _send(self, bot, chat_id, render, edit):
+        text = await render()
+        self.published += 1
+
+        last = self.last.get(chat_id)
+        if edit and last and time.monotonic() - last[1] <= self.edit_window:
+            if last[2] == text:
+                return
+            try:
+                await bot.edit_message_text(
+                    text, chat_id=chat_id, message_id=last[0], parse_mode=self.parse_mode
+                )
+                self.last[chat_id] = (last[0], last[1], text)
+                return
+            except BadRequest as e:
+                if "not modified" in str(e).lower():
+                    return
+                # 原消息已删除等 → 发新消息
+
+        message = await bot.send_message(chat_id, text, parse_mode=self.parse_mode)
+        now = time.monotonic()
+        self.last[chat_id] = (message.message_id, now, text)
+        self._prune(now)
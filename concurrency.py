@@ -0,0 +1,49 @@
+import asyncio
+
+from telegram.ext import BaseUpdateProcessor
+
+
+# ==============================
+# 并发处理更新（同一个群保持顺序）
+# ==============================
+
+class ChatOrderedProcessor(BaseUpdateProcessor):
+    """
+    不同群的更新并行处理，同一个群的更新按到达顺序一条一条处理
+    （撤销 / 重置依赖这个顺序）。
+
+    workers 限制同时运行的 handler 数；max_pending 限制已接收、
+    还在排队的更新数。排队等自己群的更新不占 worker。
+    """
+
+    def __init__(self, workers, max_pending=None):
+        super().__init__(max_pending or workers * 100)
+        self.workers = asyncio.Semaphore(workers)
+        self.worker_count = workers
+        self.chat_locks = {}    # chat_id -> [asyncio.Lock, 引用数]
+
+    async def do_process_update(self, update, coroutine):
+        chat = getattr(update, "effective_chat", None)
+        if chat is None:
+            async with self.workers:
+                await coroutine
+            return
+
+        entry = self.chat_locks.get(chat.id)
+        if entry is None:
+            entry = self.chat_locks[chat.id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                async with self.workers:
+                    await coroutine
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.chat_locks[chat.id]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
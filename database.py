@@ -1,107 +1,1003 @@
 import os
+import time
+import asyncio
+import logging
+import threading
+from contextlib import contextmanager
+
 import psycopg2
+import psycopg2.errors
+from psycopg2 import pool, sql
+
+import metrics
+import tracing
 
 DATABASE_URL = os.getenv("DATABASE_URL")
 
-if not DATABASE_URL:
+# sqlite 后端不连接 Postgres
+if not DATABASE_URL and os.getenv("STORAGE_BACKEND", "postgres") == "postgres":
     raise ValueError("DATABASE_URL not set")
 
+# ==============================
+# 连接池配置
+# ==============================
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+# 获取连接最多等待多少秒
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+# 连接空闲超过多少秒，取出时先 SELECT 1 检查
+DB_HEALTH_CHECK_IDLE = float(os.getenv("DB_HEALTH_CHECK_IDLE", "30"))
+
+# ==============================
+# history 分区 / 保留策略
+# ==============================
+# 提前建好几个月的分区
+HISTORY_PARTITIONS_AHEAD = int(os.getenv("HISTORY_PARTITIONS_AHEAD", "3"))
+# 保留几个月（0 = 永久保留）
+HISTORY_RETENTION_MONTHS = int(os.getenv("HISTORY_RETENTION_MONTHS", "0"))
+# 过期分区：archive = 分离成独立表保留，drop = 直接删除
+HISTORY_RETENTION_MODE = os.getenv("HISTORY_RETENTION_MODE", "archive")
+
+# 启动时结构版本落后：1 = 自动迁移，0 = 报错退出（用 migrate.py 升级）
+DB_AUTO_MIGRATE = os.getenv("DB_AUTO_MIGRATE", "1") == "1"
+
+logger = logging.getLogger(__name__)
+
+
+class PoolTimeout(Exception):
+    """在 DB_POOL_TIMEOUT 内拿不到连接"""
+
+
+# 累计打开过的物理连接数（benchmark / 监控用）
+connections_opened = 0
+
+
+class _CountingPool(pool.ThreadedConnectionPool):
+    def _connect(self, key=None):
+        global connections_opened
+        connections_opened += 1
+        return super()._connect(key)
+
+
+# 累计执行过的 SQL 语句数（benchmark / 监控用）
+statements_executed = 0
+
+
+class _CountingCursor(psycopg2.extensions.cursor):
+    """所有连接的游标：计数；tracing.enabled 时计时并交给 tracing 记录"""
+
+    def execute(self, query, vars=None):
+        global statements_executed
+        statements_executed += 1
+        metrics.record_statement()
+        if not tracing.enabled:
+            return super().execute(query, vars)
+
+        t0 = time.perf_counter()
+        try:
+            result = super().execute(query, vars)
+        except BaseException:
+            tracing.record(self, query, vars, time.perf_counter() - t0, failed=True)
+            raise
+        tracing.record(self, query, vars, time.perf_counter() - t0)
+        return result
+
+    def executemany(self, query, vars_list):
+        global statements_executed
+        statements_executed += 1
+        metrics.record_statement()
+        if not tracing.enabled:
+            return super().executemany(query, vars_list)
+
+        t0 = time.perf_counter()
+        try:
+            result = super().executemany(query, vars_list)
+        except BaseException:
+            tracing.record(self, query, None, time.perf_counter() - t0, failed=True)
+            raise
+        tracing.record(self, query, None, time.perf_counter() - t0)
+        return result
+
+
+_pool = None
+_pool_lock = threading.Lock()
+_slots = threading.BoundedSemaphore(DB_POOL_MAX)
+_last_used = {}
+
 
 def get_db_connection():
-    return psycopg2.connect(DATABASE_URL)
+    global connections_opened
+    connections_opened += 1
+    return psycopg2.connect(DATABASE_URL, cursor_factory=_CountingCursor)
 
 
-def init_db():
-    conn = get_db_connection()
+def _get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = _CountingPool(DB_POOL_MIN, DB_POOL_MAX, DATABASE_URL,
+                                      cursor_factory=_CountingCursor)
+    return _pool
+
+
+def _checkout():
+    p = _get_pool()
+    conn = p.getconn()
+
+    # 健康检查：已断开 或 空闲太久 SELECT 1 失败 → 丢弃并重新取一个
+    idle = time.monotonic() - _last_used.get(id(conn), time.monotonic())
+    if conn.closed or idle > DB_HEALTH_CHECK_IDLE:
+        try:
+            if conn.closed:
+                raise psycopg2.InterfaceError("connection already closed")
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+        except psycopg2.Error:
+            logger.warning("丢弃失效的数据库连接")
+            _last_used.pop(id(conn), None)
+            p.putconn(conn, close=True)
+            conn = p.getconn()
+
+    return conn
+
+
+@contextmanager
+def pooled_connection(timeout=None):
+    """从连接池借出一个连接，正常退出时 commit，异常时 rollback"""
+    wait = DB_POOL_TIMEOUT if timeout is None else timeout
+    if not _slots.acquire(timeout=wait):
+        raise PoolTimeout(f"{wait}s 内没有可用的数据库连接")
+
     try:
-        cursor = conn.cursor()
+        conn = _checkout()
+    except Exception:
+        _slots.release()
+        raise
+    metrics.record_connection()
 
-        # ==============================
-        # 群组设置
-        # ==============================
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS chat_settings (
-            chat_id BIGINT PRIMARY KEY,
-            timezone INTEGER DEFAULT 0,
-            work_start TIME DEFAULT '00:00'
-        );
-        """)
+    try:
+        yield conn
+        conn.commit()
+    except BaseException:
+        if not conn.closed:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                pass
+        raise
+    finally:
+        _last_used[id(conn)] = time.monotonic()
+        if conn.closed:
+            _last_used.pop(id(conn), None)
+        _get_pool().putconn(conn, close=bool(conn.closed))
+        _slots.release()
 
-        # 自动补充旧字段（防止旧版本缺失）
-        cursor.execute("""
-        ALTER TABLE chat_settings
-        ADD COLUMN IF NOT EXISTS timezone INTEGER DEFAULT 0;
-        """)
 
-        cursor.execute("""
-        ALTER TABLE chat_settings
-        ADD COLUMN IF NOT EXISTS work_start TIME DEFAULT '00:00';
-        """)
+def close_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+            _last_used.clear()
+
+
+def pool_stats():
+    p = _pool
+    return {
+        "opened": connections_opened,
+        "statements": statements_executed,
+        "in_use": len(p._used) if p else 0,
+        "idle": len(p._pool) if p else 0,
+        "max": DB_POOL_MAX,
+    }
+
 
-        # ==============================
-        # 账单记录（支持小数）
-        # ==============================
+# ==============================
+# 异步接口（在线程里执行，不阻塞 event loop）
+# ==============================
+
+async def run(fn, *args):
+    """用一个池化连接执行 fn(cursor, *args)，整个函数是一个事务"""
+    def job():
+        t0 = time.perf_counter()
+        try:
+            with pooled_connection() as conn:
+                with conn.cursor() as cursor:
+                    return fn(cursor, *args)
+        finally:
+            metrics.record_db(time.perf_counter() - t0)
+
+    return await asyncio.to_thread(job)
+
+
+async def _timed(fn, *args):
+    """在线程里执行一步数据库操作并计入数据库耗时（stream 用）"""
+    t0 = time.perf_counter()
+    try:
+        return await asyncio.to_thread(fn, *args)
+    finally:
+        metrics.record_db(time.perf_counter() - t0)
+
+
+async def fetchone(sql, params=None):
+    def job(cursor):
+        cursor.execute(sql, params)
+        return cursor.fetchone()
+
+    return await run(job)
+
+
+async def fetchall(sql, params=None):
+    def job(cursor):
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+
+    return await run(job)
+
+
+async def execute(sql, params=None):
+    def job(cursor):
+        cursor.execute(sql, params)
+        return cursor.rowcount
+
+    return await run(job)
+
+
+async def stream(sql, params=None, batch_size=1000, name="stream"):
+    """
+    服务端游标分批读取，内存只保留一批：
+
+        async for rows in stream("SELECT ...", (...,)):
+            ...
+
+    整个读取过程占用一个池化连接（同一个事务）。
+    """
+    ctx = pooled_connection()
+    conn = await _timed(ctx.__enter__)
+    try:
+        cursor = conn.cursor(name=name)
+        cursor.itersize = batch_size
+        await _timed(cursor.execute, sql, params)
+        while True:
+            rows = await _timed(cursor.fetchmany, batch_size)
+            if not rows:
+                break
+            yield rows
+        await _timed(cursor.close)
+    except BaseException as e:
+        await _timed(ctx.__exit__, type(e), e, e.__traceback__)
+        raise
+    else:
+        await _timed(ctx.__exit__, None, None, None)
+
+# ==============================
+# history 分区维护
+# ==============================
+
+def maintain_history_partitions(cursor, months_ahead=HISTORY_PARTITIONS_AHEAD,
+                                retention_months=0, mode=HISTORY_RETENTION_MODE):
+    """建好本月起 months_ahead 个月的分区；按保留策略分离 / 删除旧分区。返回处理掉的分区名"""
+    # 多个进程同时维护时排队
+    cursor.execute("SELECT pg_advisory_xact_lock(hashtext('history_partitions'))")
+
+    cursor.execute("""
+        SELECT ensure_history_partition((date_trunc('month', NOW()) + n * INTERVAL '1 month')::DATE)
+        FROM generate_series(0, %s) n
+    """, (months_ahead,))
+
+    if retention_months <= 0:
+        return []
+
+    cursor.execute("""
+        SELECT c.relname
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'history'::regclass
+        AND c.relname ~ '^history_y[0-9]{4}m[0-9]{2}$'
+        AND to_date(substr(c.relname, 10), 'YYYY"m"MM')
+            < date_trunc('month', NOW()) - %s * INTERVAL '1 month'
+        ORDER BY 1
+    """, (retention_months,))
+    expired = [name for (name,) in cursor.fetchall()]
+
+    for name in expired:
+        cursor.execute(sql.SQL("ALTER TABLE history DETACH PARTITION {}").format(sql.Identifier(name)))
+        if mode == "drop":
+            cursor.execute(sql.SQL("DROP TABLE {}").format(sql.Identifier(name)))
+        else:
+            archived = name.replace("history_", "history_archive_", 1)
+            cursor.execute(sql.SQL("ALTER TABLE {} RENAME TO {}").format(
+                sql.Identifier(name), sql.Identifier(archived)))
+
+    if expired:
+        cursor.execute("""
+            DELETE FROM history_period_totals
+            WHERE period_start < date_trunc('month', NOW()) - %s * INTERVAL '1 month'
+        """, (retention_months,))
         cursor.execute("""
-        CREATE TABLE IF NOT EXISTS history (
-            id SERIAL PRIMARY KEY,
-            chat_id BIGINT NOT NULL,
-            amount NUMERIC(15,2) NOT NULL,
-            user_name TEXT,
-            timestamp TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+            DELETE FROM history_period_marks
+            WHERE period_start < date_trunc('month', NOW()) - %s * INTERVAL '1 month'
+        """, (retention_months,))
+
+    return expired
+
+# ==============================
+# 每日汇总（daily_rollup）
+# ==============================
+
+# 按轮次汇总：一个轮次 (chat_id, period_start) 一组行，work_day 是汇总时按群设置算出的工作日。
+# 改过时区 / 上班时间后，同一个工作日可能有新旧两个轮次，报表只取最新的那个。
+# 已经结束的轮次才会汇总；修正 / 删除 / 清空 history 后用 rollup_period 重新汇总该轮次。
+
+ROLLUP_SELECT = """
+    SELECT t.chat_id, t.period_start,
+           work_day(t.period_start, COALESCE(s.timezone, 0), COALESCE(s.work_start, '00:00')),
+           t.user_name, t.entry_count, t.total
+    FROM history_period_totals t
+    LEFT JOIN chat_settings s ON s.chat_id = t.chat_id
+    WHERE t.period_start + INTERVAL '1 day' <= NOW()
+"""
+
+ROLLUP_UPSERT = """
+    ON CONFLICT (chat_id, period_start, user_name) DO UPDATE SET
+        work_day = EXCLUDED.work_day,
+        entry_count = EXCLUDED.entry_count,
+        total = EXCLUDED.total
+"""
+
+
+def rollup_closed_periods(cursor, chat_id=None):
+    """
+    把已经结束、还没有汇总的轮次从 history_period_totals 汇总进 daily_rollup。
+    重复执行没有副作用。
+    """
+    cursor.execute(f"""
+        INSERT INTO daily_rollup (chat_id, period_start, work_day, user_name, entry_count, total)
+        {ROLLUP_SELECT}
+        AND (%(chat_id)s::BIGINT IS NULL OR t.chat_id = %(chat_id)s)
+        AND NOT EXISTS (
+            SELECT 1 FROM daily_rollup r
+            WHERE r.chat_id = t.chat_id AND r.period_start = t.period_start
+        )
+        {ROLLUP_UPSERT}
+    """, {"chat_id": chat_id})
+    return cursor.rowcount
+
+
+def rollup_period(cursor, chat_id, period_start):
+    """history_period_totals 的这一轮变了：重新汇总（还没结束的轮次只删除旧的汇总）"""
+    cursor.execute("""
+        DELETE FROM daily_rollup WHERE chat_id=%s AND period_start=%s
+    """, (chat_id, period_start))
+    cursor.execute(f"""
+        INSERT INTO daily_rollup (chat_id, period_start, work_day, user_name, entry_count, total)
+        {ROLLUP_SELECT}
+        AND t.chat_id = %s AND t.period_start = %s
+        {ROLLUP_UPSERT}
+    """, (chat_id, period_start))
+    return cursor.rowcount
+
+
+def backfill_daily_rollup(cursor, chat_id=None):
+    """从 history 按当前设置划分轮次，重新计算所有已结束轮次的汇总（覆盖已有的行）"""
+    cursor.execute(f"""
+        INSERT INTO daily_rollup (chat_id, period_start, work_day, user_name, entry_count, total)
+        SELECT h.chat_id, p.period_start, d.work_day, COALESCE(h.user_name, ''), COUNT(*), SUM(h.amount)
+        FROM history h
+        LEFT JOIN chat_settings s ON s.chat_id = h.chat_id
+        CROSS JOIN LATERAL (
+            SELECT work_day(h.timestamp, COALESCE(s.timezone, 0), COALESCE(s.work_start, '00:00')) AS work_day
+        ) d
+        CROSS JOIN LATERAL (
+            SELECT ((d.work_day + COALESCE(s.work_start, '00:00'))
+                    - make_interval(hours => COALESCE(s.timezone, 0))) AT TIME ZONE 'UTC' AS period_start
+        ) p
+        WHERE (%(chat_id)s::BIGINT IS NULL OR h.chat_id = %(chat_id)s)
+        AND p.period_start + INTERVAL '1 day' <= NOW()
+        GROUP BY h.chat_id, p.period_start, d.work_day, COALESCE(h.user_name, '')
+        {ROLLUP_UPSERT}
+    """, {"chat_id": chat_id})
+    return cursor.rowcount
+
+
+def _backfill_daily_rollup_by_day(cursor, chat_id=None):
+    """版本 7 的按工作日汇总（当时的表结构），只给版本 7 的迁移使用"""
+    cursor.execute("""
+        INSERT INTO daily_rollup (chat_id, work_day, user_name, entry_count, total)
+        SELECT h.chat_id, d.work_day, COALESCE(h.user_name, ''), COUNT(*), SUM(h.amount)
+        FROM history h
+        LEFT JOIN chat_settings s ON s.chat_id = h.chat_id
+        CROSS JOIN LATERAL (
+            SELECT work_day(h.timestamp, COALESCE(s.timezone, 0), COALESCE(s.work_start, '00:00')) AS work_day,
+                   work_day(NOW(), COALESCE(s.timezone, 0), COALESCE(s.work_start, '00:00')) AS today
+        ) d
+        WHERE (%(chat_id)s::BIGINT IS NULL OR h.chat_id = %(chat_id)s)
+        AND d.work_day < d.today
+        GROUP BY h.chat_id, d.work_day, COALESCE(h.user_name, '')
+        ON CONFLICT (chat_id, work_day, user_name) DO UPDATE SET
+            entry_count = EXCLUDED.entry_count,
+            total = EXCLUDED.total
+    """, {"chat_id": chat_id})
+    return cursor.rowcount
+
+
+# ==============================
+# 结构迁移（schema_version）
+# ==============================
+# 每一步都是幂等的（IF NOT EXISTS / CREATE OR REPLACE），旧库第一次运行时
+# 全部执行一遍即可补上版本号。已发布的步骤不要再改：改表结构或函数请在末尾追加新版本。
+
+def _migrate_chat_settings(cursor):
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS chat_settings (
+        chat_id BIGINT PRIMARY KEY,
+        timezone INTEGER DEFAULT 0,
+        work_start TIME DEFAULT '00:00'
+    );
+    """)
+
+    # 自动补充旧字段（防止旧版本缺失）
+    cursor.execute("""
+    ALTER TABLE chat_settings
+    ADD COLUMN IF NOT EXISTS timezone INTEGER DEFAULT 0;
+    """)
+
+    cursor.execute("""
+    ALTER TABLE chat_settings
+    ADD COLUMN IF NOT EXISTS work_start TIME DEFAULT '00:00';
+    """)
+
+
+def _migrate_members(cursor):
+    # ==============================
+    # 操作者
+    # ==============================
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS team_members (
+        member_id BIGINT,
+        chat_id BIGINT,
+        username TEXT,
+        PRIMARY KEY (member_id, chat_id)
+    );
+    """)
+
+    # ==============================
+    # Owner（有期限）
+    # ==============================
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS admins (
+        user_id BIGINT PRIMARY KEY,
+        expire_date TIMESTAMP WITH TIME ZONE NOT NULL
+    );
+    """)
+
+    cursor.execute("""
+    CREATE INDEX IF NOT EXISTS idx_admin_expire
+    ON admins(expire_date);
+    """)
+
+
+def _migrate_history_partitioned(cursor):
+    # 旧版普通表 → 改名，下一步把数据搬进按月分区表。
+    # 旧表 amount 是 INTEGER 时不再整表 ALTER TYPE：搬运时写进 NUMERIC 列自动转换
+    cursor.execute("""
+    DO $$
+    BEGIN
+        IF EXISTS (
+            SELECT 1 FROM pg_class
+            WHERE oid = to_regclass('history') AND relkind = 'r'
+        ) THEN
+            ALTER TABLE history RENAME TO history_legacy;
+            ALTER INDEX IF EXISTS history_pkey RENAME TO history_legacy_pkey;
+            ALTER INDEX IF EXISTS idx_history_chat_time RENAME TO idx_history_legacy_chat_time;
+            ALTER SEQUENCE IF EXISTS history_id_seq OWNED BY NONE;
+        END IF;
+    END$$;
+    """)
+
+    cursor.execute("CREATE SEQUENCE IF NOT EXISTS history_id_seq;")
+
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS history (
+        id INTEGER NOT NULL DEFAULT nextval('history_id_seq'),
+        chat_id BIGINT NOT NULL,
+        amount NUMERIC(15,2) NOT NULL,
+        user_name TEXT,
+        timestamp TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW(),
+        PRIMARY KEY (id, timestamp)
+    ) PARTITION BY RANGE (timestamp);
+    """)
+
+    cursor.execute("ALTER SEQUENCE history_id_seq OWNED BY history.id;")
+
+    # 不在任何月份分区内的数据（正常应为空）
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS history_default
+    PARTITION OF history DEFAULT;
+    """)
+
+    # 建某个月的分区；default 分区里已有该月数据时先搬出来
+    cursor.execute("""
+    CREATE OR REPLACE FUNCTION ensure_history_partition(p_month DATE)
+    RETURNS VOID AS $$
+    DECLARE
+        v_start DATE := date_trunc('month', p_month)::DATE;
+        v_end DATE := (date_trunc('month', p_month) + INTERVAL '1 month')::DATE;
+        v_name TEXT := 'history_y' || to_char(p_month, 'YYYY') || 'm' || to_char(p_month, 'MM');
+    BEGIN
+        IF to_regclass(v_name) IS NOT NULL THEN
+            RETURN;
+        END IF;
+
+        DROP TABLE IF EXISTS pg_temp.history_moving;
+        CREATE TEMP TABLE history_moving ON COMMIT DROP AS
+            SELECT * FROM history_default
+            WHERE timestamp >= v_start AND timestamp < v_end;
+        DELETE FROM history_default
+            WHERE timestamp >= v_start AND timestamp < v_end;
+
+        EXECUTE format(
+            'CREATE TABLE %I PARTITION OF history FOR VALUES FROM (%L) TO (%L)',
+            v_name, v_start, v_end
         );
-        """)
 
-        # 🔥 如果旧数据库是 INTEGER → 自动升级为 NUMERIC
-        cursor.execute("""
-        DO $$
-        BEGIN
-            IF EXISTS (
-                SELECT 1
-                FROM information_schema.columns
-                WHERE table_name='history'
-                AND column_name='amount'
-                AND data_type='integer'
-            ) THEN
-                ALTER TABLE history
-                ALTER COLUMN amount TYPE NUMERIC(15,2)
-                USING amount::NUMERIC(15,2);
-            END IF;
-        END$$;
-        """)
+        INSERT INTO history SELECT * FROM pg_temp.history_moving;
+        DROP TABLE pg_temp.history_moving;
+    END;
+    $$ LANGUAGE plpgsql;
+    """)
+
+    maintain_history_partitions(cursor, HISTORY_PARTITIONS_AHEAD)
+
+    cursor.execute("""
+    CREATE INDEX IF NOT EXISTS idx_history_chat_time
+    ON history(chat_id, timestamp);
+    """)
+
+
+def _legacy_partitions(cursor):
+    """旧表涉及的月份先建好分区"""
+    cursor.execute("""
+        SELECT ensure_history_partition(m::DATE)
+        FROM generate_series(
+            date_trunc('month', (SELECT MIN(timestamp) FROM history_legacy)),
+            date_trunc('month', NOW()),
+            INTERVAL '1 month'
+        ) m
+    """)
 
-        cursor.execute("""
-        CREATE INDEX IF NOT EXISTS idx_history_chat_time
-        ON history(chat_id, timestamp);
-        """)
 
-        # ==============================
-        # 操作者
-        # ==============================
+def _migrate_history_legacy(cursor):
+    # 旧表数据一次性搬进分区表（数据多时用 migrate.py --online 分批搬）
+    cursor.execute("SELECT to_regclass('history_legacy') IS NOT NULL")
+    if not cursor.fetchone()[0]:
+        return
+
+    _legacy_partitions(cursor)
+    cursor.execute("""
+        INSERT INTO history (id, chat_id, amount, user_name, timestamp)
+        SELECT id, chat_id, amount, user_name, COALESCE(timestamp, 'epoch')
+        FROM history_legacy
+    """)
+    cursor.execute("DROP TABLE history_legacy")
+
+
+def _migrate_history_legacy_online(conn, batch_size):
+    """分批搬运，每批一个事务；搬运期间机器人可以照常写入新表"""
+    cursor = conn.cursor()
+    cursor.execute("SELECT to_regclass('history_legacy') IS NOT NULL")
+    if not cursor.fetchone()[0]:
+        return
+
+    _legacy_partitions(cursor)
+    conn.commit()
+
+    moved = 0
+    while True:
         cursor.execute("""
-        CREATE TABLE IF NOT EXISTS team_members (
-            member_id BIGINT,
-            chat_id BIGINT,
-            username TEXT,
-            PRIMARY KEY (member_id, chat_id)
-        );
-        """)
+            WITH batch AS (
+                DELETE FROM history_legacy
+                WHERE id IN (SELECT id FROM history_legacy ORDER BY id LIMIT %s)
+                RETURNING id, chat_id, amount, user_name, timestamp
+            )
+            INSERT INTO history (id, chat_id, amount, user_name, timestamp)
+            SELECT id, chat_id, amount, user_name, COALESCE(timestamp, 'epoch')
+            FROM batch
+        """, (batch_size,))
+        count = cursor.rowcount
+        conn.commit()
+        moved += count
+        logger.info("history_legacy: 已搬运 %d 行", moved)
+        if count < batch_size:
+            break
+
+    cursor.execute("DROP TABLE history_legacy")
+    conn.commit()
+
+
+def _migrate_period_totals(cursor):
+    # ==============================
+    # 每轮按人合计（与 history 同一事务维护）
+    # ==============================
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS history_period_totals (
+        chat_id BIGINT NOT NULL,
+        period_start TIMESTAMP WITH TIME ZONE NOT NULL,
+        user_name TEXT NOT NULL DEFAULT '',
+        entry_count INTEGER NOT NULL DEFAULT 0,
+        total NUMERIC(15,2) NOT NULL DEFAULT 0,
+        PRIMARY KEY (chat_id, period_start, user_name)
+    );
+    """)
+
+    # ==============================
+    # 记账 + 权限检查 + 返回合计（一次往返）
+    # ==============================
+    cursor.execute("""
+    CREATE OR REPLACE FUNCTION record_entry(
+        p_chat_id BIGINT,
+        p_user_id BIGINT,
+        p_is_master BOOLEAN,
+        p_user_name TEXT,
+        p_amount NUMERIC,
+        p_period_start TIMESTAMP WITH TIME ZONE,
+        p_period_end TIMESTAMP WITH TIME ZONE,
+        p_recent INTEGER
+    ) RETURNS TEXT AS $$
+    DECLARE
+        v_id INTEGER;
+        v_ts TIMESTAMP WITH TIME ZONE;
+    BEGIN
+        IF NOT p_is_master
+           AND NOT EXISTS (SELECT 1 FROM admins
+                           WHERE user_id = p_user_id AND expire_date > NOW())
+           AND NOT EXISTS (SELECT 1 FROM team_members
+                           WHERE member_id = p_user_id AND chat_id = p_chat_id)
+        THEN
+            RETURN NULL;
+        END IF;
+
+        INSERT INTO history (chat_id, amount, user_name)
+        VALUES (p_chat_id, p_amount, p_user_name)
+        RETURNING id, timestamp INTO v_id, v_ts;
+
+        INSERT INTO history_period_totals
+            (chat_id, period_start, user_name, entry_count, total)
+        VALUES (p_chat_id, p_period_start, COALESCE(p_user_name, ''), 1, p_amount)
+        ON CONFLICT (chat_id, period_start, user_name)
+        DO UPDATE SET
+            entry_count = history_period_totals.entry_count + 1,
+            total = history_period_totals.total + EXCLUDED.total;
+
+        RETURN json_build_object(
+            'id', v_id,
+            'timestamp', v_ts,
+            'people', (
+                SELECT COALESCE(json_agg(json_build_array(user_name, entry_count, total)), '[]')
+                FROM history_period_totals
+                WHERE chat_id = p_chat_id AND period_start = p_period_start
+            ),
+            'recent', (
+                SELECT COALESCE(json_agg(json_build_array(id, amount, user_name, timestamp)
+                                         ORDER BY timestamp DESC, id DESC), '[]')
+                FROM (
+                    SELECT id, amount, user_name, timestamp
+                    FROM history
+                    WHERE chat_id = p_chat_id
+                    AND timestamp BETWEEN p_period_start AND p_period_end
+                    ORDER BY timestamp DESC, id DESC
+                    LIMIT p_recent
+                ) r
+            )
+        )::TEXT;
+    END;
+    $$ LANGUAGE plpgsql;
+    """)
+
+
+def _migrate_chat_directory(cursor):
+    # ==============================
+    # 群名 / 用户名目录（管理命令显示用）
+    # ==============================
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS chat_directory (
+        id BIGINT PRIMARY KEY,
+        name TEXT,
+        updated_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW()
+    );
+    """)
+
+
+def _create_daily_rollup(cursor):
+    """建 daily_rollup；返回这次是否新建（新建的需要补数据）"""
+    # 工作日 = 本地时间减去上班时间后的日期
+    cursor.execute("""
+    CREATE OR REPLACE FUNCTION work_day(ts TIMESTAMPTZ, tz INTEGER, work_start TIME)
+    RETURNS DATE LANGUAGE sql IMMUTABLE AS $$
+        SELECT ((ts AT TIME ZONE 'UTC') + make_interval(hours => tz) - work_start)::DATE
+    $$;
+    """)
+
+    cursor.execute("SELECT to_regclass('daily_rollup') IS NULL")
+    missing = cursor.fetchone()[0]
+
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS daily_rollup (
+        chat_id BIGINT NOT NULL,
+        work_day DATE NOT NULL,
+        user_name TEXT NOT NULL DEFAULT '',
+        entry_count INTEGER NOT NULL DEFAULT 0,
+        total NUMERIC(15,2) NOT NULL DEFAULT 0,
+        PRIMARY KEY (chat_id, work_day, user_name)
+    );
+    """)
+    return missing
+
 
-        # ==============================
-        # Owner（有期限）
-        # ==============================
+def _migrate_daily_rollup(cursor):
+    # 第一次建表：用已有的 history 补齐
+    if _create_daily_rollup(cursor):
+        _backfill_daily_rollup_by_day(cursor)
+
+
+def _migrate_daily_rollup_online(conn, batch_size):
+    """按群逐个补齐，每个群一个事务"""
+    cursor = conn.cursor()
+    missing = _create_daily_rollup(cursor)
+    conn.commit()
+    if not missing:
+        return
+
+    cursor.execute("SELECT DISTINCT chat_id FROM history")
+    for (chat_id,) in cursor.fetchall():
+        _backfill_daily_rollup_by_day(cursor, chat_id)
+        conn.commit()
+
+
+def _migrate_period_marks(cursor):
+    # ==============================
+    # 已物化的轮次：合计表里有这一轮的完整合计
+    # ==============================
+    # 不能用“合计表里没有这一轮的行”来判断：在一轮中途上线合计表时，
+    # 第一笔写入会建出只含这一笔的合计行，之前的 history 永远不会被算进去。
+    # 没有标记的轮次在第一次读 / 写时按 history 重建一次并打上标记。
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS history_period_marks (
+        chat_id BIGINT NOT NULL,
+        period_start TIMESTAMP WITH TIME ZONE NOT NULL,
+        PRIMARY KEY (chat_id, period_start)
+    );
+    """)
+
+    cursor.execute("""
+    CREATE OR REPLACE FUNCTION materialize_period(
+        p_chat_id BIGINT,
+        p_period_start TIMESTAMP WITH TIME ZONE,
+        p_period_end TIMESTAMP WITH TIME ZONE
+    ) RETURNS BOOLEAN AS $$
+    BEGIN
+        INSERT INTO history_period_marks (chat_id, period_start)
+        VALUES (p_chat_id, p_period_start)
+        ON CONFLICT DO NOTHING;
+        IF NOT FOUND THEN
+            RETURN FALSE;
+        END IF;
+
+        DELETE FROM history_period_totals
+        WHERE chat_id = p_chat_id AND period_start = p_period_start;
+        INSERT INTO history_period_totals
+            (chat_id, period_start, user_name, entry_count, total)
+        SELECT p_chat_id, p_period_start, COALESCE(user_name,''), COUNT(*), SUM(amount)
+        FROM history
+        WHERE chat_id = p_chat_id
+        AND timestamp BETWEEN p_period_start AND p_period_end
+        GROUP BY COALESCE(user_name,'');
+        RETURN TRUE;
+    END;
+    $$ LANGUAGE plpgsql;
+    """)
+
+    # record_entry：写入前先确保这一轮已物化
+    cursor.execute("""
+    CREATE OR REPLACE FUNCTION record_entry(
+        p_chat_id BIGINT,
+        p_user_id BIGINT,
+        p_is_master BOOLEAN,
+        p_user_name TEXT,
+        p_amount NUMERIC,
+        p_period_start TIMESTAMP WITH TIME ZONE,
+        p_period_end TIMESTAMP WITH TIME ZONE,
+        p_recent INTEGER
+    ) RETURNS TEXT AS $$
+    DECLARE
+        v_id INTEGER;
+        v_ts TIMESTAMP WITH TIME ZONE;
+    BEGIN
+        IF NOT p_is_master
+           AND NOT EXISTS (SELECT 1 FROM admins
+                           WHERE user_id = p_user_id AND expire_date > NOW())
+           AND NOT EXISTS (SELECT 1 FROM team_members
+                           WHERE member_id = p_user_id AND chat_id = p_chat_id)
+        THEN
+            RETURN NULL;
+        END IF;
+
+        PERFORM materialize_period(p_chat_id, p_period_start, p_period_end);
+
+        INSERT INTO history (chat_id, amount, user_name)
+        VALUES (p_chat_id, p_amount, p_user_name)
+        RETURNING id, timestamp INTO v_id, v_ts;
+
+        INSERT INTO history_period_totals
+            (chat_id, period_start, user_name, entry_count, total)
+        VALUES (p_chat_id, p_period_start, COALESCE(p_user_name, ''), 1, p_amount)
+        ON CONFLICT (chat_id, period_start, user_name)
+        DO UPDATE SET
+            entry_count = history_period_totals.entry_count + 1,
+            total = history_period_totals.total + EXCLUDED.total;
+
+        RETURN json_build_object(
+            'id', v_id,
+            'timestamp', v_ts,
+            'people', (
+                SELECT COALESCE(json_agg(json_build_array(user_name, entry_count, total)), '[]')
+                FROM history_period_totals
+                WHERE chat_id = p_chat_id AND period_start = p_period_start
+            ),
+            'recent', (
+                SELECT COALESCE(json_agg(json_build_array(id, amount, user_name, timestamp)
+                                         ORDER BY timestamp DESC, id DESC), '[]')
+                FROM (
+                    SELECT id, amount, user_name, timestamp
+                    FROM history
+                    WHERE chat_id = p_chat_id
+                    AND timestamp BETWEEN p_period_start AND p_period_end
+                    ORDER BY timestamp DESC, id DESC
+                    LIMIT p_recent
+                ) r
+            )
+        )::TEXT;
+    END;
+    $$ LANGUAGE plpgsql;
+    """)
+
+
+def _rekey_daily_rollup(cursor):
+    """daily_rollup 改为按轮次 (chat_id, period_start, user_name) 汇总；返回这次是否改了结构"""
+    cursor.execute("""
+        SELECT 1 FROM information_schema.columns
+        WHERE table_name = 'daily_rollup' AND column_name = 'period_start'
+    """)
+    if cursor.fetchone():
+        return False
+
+    # 按工作日汇总的旧数据在改过时区后可能重复计算，直接清空后从 history 重新汇总
+    cursor.execute("TRUNCATE daily_rollup")
+    cursor.execute("ALTER TABLE daily_rollup ADD COLUMN period_start TIMESTAMP WITH TIME ZONE NOT NULL")
+    cursor.execute("ALTER TABLE daily_rollup DROP CONSTRAINT daily_rollup_pkey")
+    cursor.execute("ALTER TABLE daily_rollup ADD PRIMARY KEY (chat_id, period_start, user_name)")
+    cursor.execute("""
+    CREATE INDEX IF NOT EXISTS idx_daily_rollup_day
+    ON daily_rollup(chat_id, work_day);
+    """)
+    return True
+
+
+def _migrate_daily_rollup_periods(cursor):
+    if _rekey_daily_rollup(cursor):
+        backfill_daily_rollup(cursor)
+
+
+def _migrate_daily_rollup_periods_online(conn, batch_size):
+    """改结构是一个短事务；之后按群逐个补齐，每个群一个事务"""
+    cursor = conn.cursor()
+    rekeyed = _rekey_daily_rollup(cursor)
+    conn.commit()
+    if not rekeyed:
+        return
+
+    cursor.execute("SELECT DISTINCT chat_id FROM history")
+    for (chat_id,) in cursor.fetchall():
+        backfill_daily_rollup(cursor, chat_id)
+        conn.commit()
+
+
+# (版本, 名称, 执行函数(cursor), 分批在线执行的函数(conn, batch_size) 或 None)
+MIGRATIONS = [
+    (1, "chat_settings", _migrate_chat_settings, None),
+    (2, "team_members_admins", _migrate_members, None),
+    (3, "history_partitioned", _migrate_history_partitioned, None),
+    (4, "history_legacy_copy", _migrate_history_legacy, _migrate_history_legacy_online),
+    (5, "period_totals_record_entry", _migrate_period_totals, None),
+    (6, "chat_directory", _migrate_chat_directory, None),
+    (7, "daily_rollup", _migrate_daily_rollup, _migrate_daily_rollup_online),
+    (8, "period_marks", _migrate_period_marks, None),
+    (9, "daily_rollup_periods", _migrate_daily_rollup_periods, _migrate_daily_rollup_periods_online),
+]
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+class SchemaOutdated(Exception):
+    """数据库结构版本低于代码需要的版本"""
+
+
+def schema_version(cursor):
+    """一条查询取得当前结构版本（还没有 schema_version 表时为 0）"""
+    try:
+        cursor.execute("SELECT MAX(version) FROM schema_version")
+        return cursor.fetchone()[0] or 0
+    except psycopg2.errors.UndefinedTable:
+        cursor.connection.rollback()
+        return 0
+
+
+def migrate(conn, target=None, online=False, batch_size=10000):
+    """
+    按版本顺序执行缺少的迁移，每步完成后记录到 schema_version。
+    online=True 时有分批实现的步骤分批执行（每批一个事务）。
+    多个进程同时迁移时用 advisory lock 排队。返回执行过的 [(版本, 名称, 秒数)]。
+    """
+    cursor = conn.cursor()
+    cursor.execute("SELECT pg_advisory_lock(hashtext('schema_migrations'))")
+    try:
         cursor.execute("""
-        CREATE TABLE IF NOT EXISTS admins (
-            user_id BIGINT PRIMARY KEY,
-            expire_date TIMESTAMP WITH TIME ZONE NOT NULL
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW()
         );
         """)
+        conn.commit()
 
-        cursor.execute("""
-        CREATE INDEX IF NOT EXISTS idx_admin_expire
-        ON admins(expire_date);
-        """)
+        # 拿到锁之后再读一次：可能别的进程刚迁移完
+        current = schema_version(cursor)
+        applied = []
+        for version, name, step, online_step in MIGRATIONS:
+            if version <= current or (target is not None and version > target):
+                continue
+
+            t0 = time.monotonic()
+            if online and online_step:
+                online_step(conn, batch_size)
+            else:
+                step(cursor)
+            cursor.execute("INSERT INTO schema_version (version, name) VALUES (%s, %s)",
+                           (version, name))
+            conn.commit()
 
+            elapsed = time.monotonic() - t0
+            logger.info("schema 迁移 %d %s 完成（%.1fs）", version, name, elapsed)
+            applied.append((version, name, elapsed))
+        return applied
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        cursor.execute("SELECT pg_advisory_unlock(hashtext('schema_migrations'))")
         conn.commit()
 
+
+def init_db():
+    """
+    启动检查：结构已是最新时只执行一条查询，不加任何表锁。
+    落后时 DB_AUTO_MIGRATE=1 直接迁移；=0 时报错，请先运行 python migrate.py。
+    """
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        current = schema_version(cursor)
+        conn.rollback()
+        if current >= LATEST_VERSION:
+            return
+
+        if not DB_AUTO_MIGRATE:
+            raise SchemaOutdated(
+                f"schema version {current} < {LATEST_VERSION}, run: python migrate.py"
+            )
+        migrate(conn)
+
     finally:
         conn.close()
@@ -0,0 +1,83 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta
+
+from cache import utc_naive
+from outbound import BULK
+
+logger = logging.getLogger(__name__)
+
+
+# ==============================
+# 群名 / 用户名目录
+# ==============================
+
+class ChatDirectory:
+    """
+    chat_id / user_id -> 显示名，存在 chat_directory 表并缓存在内存。
+
+    管理命令只读本地数据；缺少或超过 ttl 秒的条目交给后台任务，
+    最多 concurrency 个 get_chat 并发刷新，然后写回数据库。
+    """
+
+    def __init__(self, loader, saver, ttl=86400, concurrency=8):
+        self.loader = loader
+        self.saver = saver
+        self.ttl = timedelta(seconds=ttl)
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.entries = {}       # id -> (name, updated_at)
+        self.refreshing = set()
+        self.tasks = set()
+
+    async def load(self):
+        self.entries = {
+            entry_id: (name, utc_naive(updated_at))
+            for entry_id, name, updated_at in await self.loader()
+        }
+
+    def name(self, entry_id, default=None):
+        entry = self.entries.get(int(entry_id))
+        if entry and entry[0]:
+            return entry[0]
+        return default if default is not None else str(entry_id)
+
+    def stale(self, ids, now=None):
+        now = now or datetime.utcnow()
+        return [
+            i for i in ids
+            if i not in self.refreshing
+            and (i not in self.entries or now - self.entries[i][1] > self.ttl)
+        ]
+
+    def refresh_in_background(self, bot, ids):
+        ids = self.stale({int(i) for i in ids})
+        if not ids:
+            return None
+        self.refreshing.update(ids)
+        task = asyncio.create_task(self.refresh(bot, ids))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def refresh(self, bot, ids):
+        async def fetch(entry_id):
+            async with self.semaphore:
+                try:
+                    chat = await bot.get_chat(entry_id, rate_limit_args={"priority": BULK})
+                    name = chat.title or chat.full_name or chat.username
+                except Exception:
+                    # 机器人已不在群 / 用户不可见：保留旧名字，ttl 后再试
+                    old = self.entries.get(entry_id)
+                    name = old[0] if old else None
+            return entry_id, name
+
+        try:
+            results = await asyncio.gather(*(fetch(i) for i in ids))
+            now = datetime.utcnow()
+            for entry_id, name in results:
+                self.entries[entry_id] = (name, now)
+            await self.saver([(entry_id, name, now) for entry_id, name in results])
+        except Exception:
+            logger.exception("目录刷新失败")
+        finally:
+            self.refreshing.difference_update(ids)
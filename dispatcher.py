@@ -0,0 +1,72 @@
+import re
+
+import metrics
+
+# +xx / -xx（支持千分位和两位小数）
+AMOUNT_RE = re.compile(r'^([+-])\s*([\d,]+(?:\.\d{1,2})?)$')
+
+
+# ==============================
+# 消息分发
+# ==============================
+
+class CommandDispatcher:
+    """
+    所有文本消息只经过一次分类：
+
+    - "/" 开头：取第一个词（去掉 @机器人名）查命令表，其余词作为 context.args
+    - "+" / "-" 开头：用预编译的 AMOUNT_RE 匹配，结果放在 context.matches
+    - 其他聊天内容直接忽略，不查数据库
+    """
+
+    def __init__(self):
+        self.commands = {}
+        self.amount_callback = None
+
+    def command(self, names, callback):
+        for name in names:
+            self.commands[name.lstrip("/")] = callback
+
+    def amount(self, callback):
+        self.amount_callback = callback
+
+    def classify(self, text, bot_username=None):
+        """返回 (callback, args, match)，不需要处理时返回 None"""
+        if not text:
+            return None
+
+        first = text[0]
+        if first == "/":
+            parts = text[1:].split()
+            if not parts:
+                return None
+            name, _, mention = parts[0].partition("@")
+            if mention and bot_username and mention.lower() != bot_username.lower():
+                return None
+            callback = self.commands.get(name)
+            if callback is None:
+                return None
+            return callback, parts[1:], None
+
+        if (first == "+" or first == "-") and self.amount_callback:
+            match = AMOUNT_RE.match(text)
+            if match:
+                return self.amount_callback, None, match
+
+        return None
+
+    async def __call__(self, update, context):
+        message = update.message
+        if message is None or not message.text:
+            return
+
+        route = self.classify(message.text.strip(), context.bot.username)
+        if route is None:
+            return
+
+        callback, args, match = route
+        context.args = args
+        if match:
+            context.matches = [match]
+        with metrics.track(callback.__name__):
+            await callback(update, context)
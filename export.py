@@ -0,0 +1,120 @@
+"""
+账单导出：服务端游标分批读出，逐批写进 CSV（或 XLSX）文件。
+
+每个文件最多 part_rows 行，写满就换一个新文件（写满的文件留在磁盘临时文件里），
+内存占用只和一批 / 一个文件有关，与总行数无关。
+全部读完、数据库连接归还以后才开始上传，上传慢不会占着连接池。
+XLSX 需要安装 openpyxl，没有安装时只能导出 CSV。
+"""
+import io
+import csv
+import tempfile
+from datetime import timedelta
+
+try:
+    import openpyxl
+except ImportError:
+    openpyxl = None
+
+HEADER = ["ID", "时间", "操作人", "金额"]
+# CSV 超过这个大小才落到磁盘临时文件
+SPOOL_BYTES = 4 * 1024 * 1024
+
+
+class CsvPart:
+    extension = "csv"
+
+    def __init__(self):
+        self.file = tempfile.SpooledTemporaryFile(max_size=SPOOL_BYTES)
+        self.rows = 0
+        # utf-8-sig：Excel 打开中文不乱码
+        self._write_lines([HEADER], "utf-8-sig")
+
+    def _write_lines(self, lines, encoding="utf-8"):
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(lines)
+        self.file.write(buffer.getvalue().encode(encoding))
+
+    def write(self, rows, tz):
+        self._write_lines(
+            (r[0], (r[3] + timedelta(hours=tz)).strftime("%Y-%m-%d %H:%M:%S"), r[2], r[1])
+            for r in rows
+        )
+        self.rows += len(rows)
+
+    def finish(self):
+        self.file.seek(0)
+        return self.file
+
+
+class XlsxPart:
+    extension = "xlsx"
+
+    def __init__(self):
+        # write_only：行写入临时文件，不在内存里保留整张表
+        self.book = openpyxl.Workbook(write_only=True)
+        self.sheet = self.book.create_sheet("history")
+        self.sheet.append(HEADER)
+        self.rows = 0
+
+    def write(self, rows, tz):
+        for r in rows:
+            local_time = (r[3] + timedelta(hours=tz)).replace(tzinfo=None)
+            self.sheet.append([r[0], local_time, r[2], r[1]])
+        self.rows += len(rows)
+
+    def finish(self):
+        file = tempfile.TemporaryFile()
+        self.book.save(file)
+        file.seek(0)
+        return file
+
+
+FORMATS = {"csv": CsvPart, "xlsx": XlsxPart}
+
+
+def available(fmt):
+    return fmt == "csv" or (fmt == "xlsx" and openpyxl is not None)
+
+
+async def export_history(batches, tz, fmt, part_rows, send):
+    """
+    batches: 异步迭代，每次给出一批 (id, amount, user_name, timestamp)
+    send(file, part_no): 上传一个写好的文件，在 batches 读完之后才调用
+
+    返回 (总行数, 文件数)。没有数据时也会发送一个只有表头的文件。
+    """
+    make_part = FORMATS[fmt]
+    part = make_part()
+    total = 0
+    files = []
+
+    try:
+        async for rows in batches:
+            total += len(rows)
+            while rows:
+                take = rows[:part_rows - part.rows]
+                rows = rows[len(take):]
+                part.write(take, tz)
+
+                if part.rows >= part_rows:
+                    files.append(_spill(part.finish()))
+                    part = make_part()
+
+        if part.rows or not files:
+            files.append(part.finish())
+
+        for number, file in enumerate(files, 1):
+            await send(file, number)
+    finally:
+        for file in files:
+            file.close()
+
+    return total, len(files)
+
+
+def _spill(file):
+    """等待上传的文件不留在内存里"""
+    if isinstance(file, tempfile.SpooledTemporaryFile):
+        file.rollover()
+    return file
@@ -0,0 +1,241 @@
+"""
+多进程部署：本进程接收 Telegram 更新，按 chat_id 一致性哈希转发给 N 个 worker（main.py）
+
+  SHARD_WORKERS=4 python ingress.py
+
+- 同一个群总是同一个 worker，并且按到达顺序转发，群内顺序和单进程一样
+- Master 命令（/users /clearall /checktotals /续费 /metrics /trace 和清空按钮）
+  都交给 0 号 worker；历史分区维护也只在 0 号 worker 运行
+- 清空 / 续费 / 重建合计后，0 号 worker 通知其他 worker 让本地缓存失效
+- 全局发送限速 OUTBOUND_GLOBAL_PER_SEC 平分给各 worker，每群限速不变
+
+接收方式和 main.py 相同：设置 WEBHOOK_URL 时用 webhook，否则长轮询。
+默认由本进程启动 worker（SHARD_BASE_PORT 起连续端口）；
+SHARD_WORKER_URLS=http://host:port,... 时转发给已经在运行的 worker，不再启动子进程，
+这时需要设置和 worker 相同的 SHARD_TOKEN；自己启动的 worker 没有设置时随机生成。
+"""
+import os
+import sys
+import hmac
+import json
+import signal
+import secrets
+import asyncio
+import logging
+
+import httpx
+
+import shard
+
+TOKEN = os.getenv("TOKEN")
+
+if not TOKEN:
+    raise ValueError("TOKEN not set")
+
+SHARD_WORKERS = int(os.getenv("SHARD_WORKERS", "2"))
+SHARD_HOST = os.getenv("SHARD_HOST", "127.0.0.1")
+SHARD_BASE_PORT = int(os.getenv("SHARD_BASE_PORT", "9100"))
+SHARD_WORKER_URLS = os.getenv("SHARD_WORKER_URLS")
+SHARD_TOKEN = os.getenv("SHARD_TOKEN") or (None if SHARD_WORKER_URLS else secrets.token_hex(32))
+# 每次转发给一个 worker 的最多更新数
+SHARD_FORWARD_BATCH = int(os.getenv("SHARD_FORWARD_BATCH", "100"))
+# 每个 worker 等待转发的最多更新数，满了以后暂停接收
+SHARD_QUEUE_SIZE = int(os.getenv("SHARD_QUEUE_SIZE", "1000"))
+
+OUTBOUND_GLOBAL_PER_SEC = int(os.getenv("OUTBOUND_GLOBAL_PER_SEC", "30"))
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+
+if not SHARD_TOKEN:
+    raise ValueError("SHARD_TOKEN not set")
+if WEBHOOK_URL and not WEBHOOK_SECRET:
+    raise ValueError("WEBHOOK_SECRET not set")
+
+TELEGRAM_API_BASE = os.getenv("TELEGRAM_API_BASE", "https://api.telegram.org")
+POLL_TIMEOUT = 30
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger("ingress")
+
+
+# ==============================
+# 转发给 worker
+# ==============================
+
+class WorkerLink:
+    """一个 worker 一个队列，按顺序批量 POST /update；失败时重试同一批，不打乱顺序"""
+
+    def __init__(self, index, url, client):
+        self.index = index
+        self.url = url
+        self.client = client
+        self.queue = asyncio.Queue(maxsize=SHARD_QUEUE_SIZE)
+        self.forwarded = 0
+
+    async def run(self):
+        while True:
+            batch = [await self.queue.get()]
+            while len(batch) < SHARD_FORWARD_BATCH and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+
+            delay = 0.1
+            while True:
+                try:
+                    response = await self.client.post(f"{self.url}/update", json=batch,
+                                                      headers={shard.TOKEN_HEADER: SHARD_TOKEN})
+                    response.raise_for_status()
+                    break
+                except httpx.HTTPError as e:
+                    logger.warning("转发到 worker %s 失败（%s），%.1fs 后重试", self.index, e, delay)
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, 5)
+            self.forwarded += len(batch)
+
+
+class Router:
+    def __init__(self, urls, client):
+        self.ring = shard.ShardRing(len(urls))
+        self.links = [WorkerLink(i, url, client) for i, url in enumerate(urls)]
+        self.received = 0
+
+    async def dispatch(self, update):
+        self.received += 1
+        await self.links[shard.route(self.ring, update)].queue.put(update)
+
+# ==============================
+# 接收更新
+# ==============================
+
+async def api_call(client, method, **params):
+    response = await client.post(f"{TELEGRAM_API_BASE}/bot{TOKEN}/{method}", json=params)
+    response.raise_for_status()
+    return response.json()["result"]
+
+
+async def poll(client, router):
+    await api_call(client, "deleteWebhook")
+    offset = None
+    while True:
+        try:
+            updates = await api_call(client, "getUpdates", offset=offset, timeout=POLL_TIMEOUT)
+        except httpx.HTTPError as e:
+            logger.warning("getUpdates 失败: %s", e)
+            await asyncio.sleep(1)
+            continue
+
+        for update in updates:
+            await router.dispatch(update)
+            offset = update["update_id"] + 1
+
+
+async def serve_webhook(client, router):
+    async def handle(reader, writer):
+        try:
+            while True:
+                request = await shard.read_request(reader)
+                if request is None:
+                    break
+                method, path, headers, body = request
+
+                if method != "POST" or path.strip("/") != WEBHOOK_PATH:
+                    shard.write_response(writer, "404 Not Found", b"not found\n")
+                elif not hmac.compare_digest(
+                        headers.get("x-telegram-bot-api-secret-token", "").encode(),
+                        WEBHOOK_SECRET.encode()):
+                    shard.write_response(writer, "403 Forbidden", b"forbidden\n")
+                else:
+                    try:
+                        update = json.loads(body)
+                    except ValueError:
+                        update = None
+                    if not isinstance(update, dict):
+                        shard.write_response(writer, "400 Bad Request", b"bad request\n")
+                    else:
+                        await router.dispatch(update)
+                        shard.write_response(writer, "200 OK")
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, WEBHOOK_LISTEN, WEBHOOK_PORT)
+    await api_call(client, "setWebhook", url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+                   secret_token=WEBHOOK_SECRET)
+    async with server:
+        await server.serve_forever()
+
+# ==============================
+# 启动 worker
+# ==============================
+
+async def spawn_workers(n):
+    urls = [f"http://{SHARD_HOST}:{SHARD_BASE_PORT + i}" for i in range(n)]
+    procs = []
+    for i in range(n):
+        env = dict(
+            os.environ,
+            SHARD_INDEX=str(i),
+            SHARD_HOST=SHARD_HOST,
+            SHARD_PORT=str(SHARD_BASE_PORT + i),
+            SHARD_PEERS=",".join(urls),
+            SHARD_TOKEN=SHARD_TOKEN,
+            OUTBOUND_GLOBAL_PER_SEC=str(max(1, OUTBOUND_GLOBAL_PER_SEC // n)),
+        )
+        if METRICS_PORT:
+            env["METRICS_PORT"] = str(METRICS_PORT + i)
+        procs.append(await asyncio.create_subprocess_exec(
+            sys.executable, os.path.join(ROOT, "main.py"), cwd=ROOT, env=env))
+    return urls, procs
+
+
+async def main():
+    procs = []
+    if SHARD_WORKER_URLS:
+        urls = [url.strip().rstrip("/") for url in SHARD_WORKER_URLS.split(",")]
+    else:
+        urls, procs = await spawn_workers(SHARD_WORKERS)
+    logger.info("%d 个 worker: %s", len(urls), ", ".join(urls))
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    async with httpx.AsyncClient(timeout=POLL_TIMEOUT + 10) as client:
+        router = Router(urls, client)
+        tasks = [asyncio.create_task(link.run()) for link in router.links]
+        tasks.append(asyncio.create_task(
+            serve_webhook(client, router) if WEBHOOK_URL else poll(client, router)))
+        # 任一 worker 退出时整体退出，由部署平台重启
+        tasks += [asyncio.create_task(proc.wait()) for proc in procs]
+        waiter = asyncio.create_task(stop.wait())
+
+        done, _ = await asyncio.wait(tasks + [waiter], return_when=asyncio.FIRST_COMPLETED)
+        exit_code = 0 if waiter in done else 1
+        for task in done:
+            if task is not waiter and task.exception():
+                logger.error("ingress 任务失败", exc_info=task.exception())
+
+        for task in tasks + [waiter]:
+            task.cancel()
+        for proc in procs:
+            if proc.returncode is None:
+                proc.terminate()
+        for proc in procs:
+            await proc.wait()
+
+    logger.info("已接收 %d 条更新，转发: %s", router.received,
+                ", ".join(f"#{link.index} {link.forwarded}" for link in router.links))
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
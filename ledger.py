@@ -0,0 +1,163 @@
+from collections import deque
+from decimal import Decimal
+
+# 每个群在内存里保留的最近记录数（/report 只显示最后 6 条）
+RECENT_KEEP = 50
+
+
+# ==============================
+# 当前轮次的累计数据
+# ==============================
+
+class PeriodAggregate:
+    """一个群在一个工作轮次内的合计、笔数、按人统计和最近记录"""
+
+    def __init__(self, start_utc):
+        self.start_utc = start_utc
+        self.total = Decimal("0")
+        self.count = 0
+        self.people = {}                        # user_name -> [count, total]
+        self.recent = deque(maxlen=RECENT_KEEP)  # (id, amount, user_name, timestamp)
+
+    def add(self, row_id, amount, user_name, timestamp):
+        amount = Decimal(amount)
+        self.total += amount
+        self.count += 1
+
+        person = self.people.setdefault(user_name, [0, Decimal("0")])
+        person[0] += 1
+        person[1] += amount
+
+        self.recent.append((row_id, amount, user_name, timestamp))
+
+    def remove(self, row_id, amount, user_name):
+        amount = Decimal(amount)
+        self.total -= amount
+        self.count -= 1
+
+        person = self.people.get(user_name)
+        if person:
+            person[0] -= 1
+            person[1] -= amount
+            if person[0] <= 0:
+                del self.people[user_name]
+
+        # 撤销的几乎总是最后一条
+        if self.recent and self.recent[-1][0] == row_id:
+            self.recent.pop()
+        else:
+            self.recent = deque((r for r in self.recent if r[0] != row_id), maxlen=RECENT_KEEP)
+
+    def needs_recent(self, n):
+        return len(self.recent) < min(self.count, n)
+
+    def last(self, n):
+        return list(self.recent)[-n:] if n else []
+
+    def sorted_people(self):
+        return sorted(self.people.items(), key=lambda x: x[1][1], reverse=True)
+
+
+class PeriodLedger:
+    """
+    chat_id -> 当前轮次 PeriodAggregate。
+
+    记账 / 撤销 / 重置直接更新内存；第一次访问或轮次切换时，
+    用 loader(chat_id, start_utc, end_utc) 从 history 重建。
+
+    每次修改都把该群的数据版本 +1；render() 按 (chat_id, 变体, 轮次, 版本)
+    缓存渲染好的文本，版本不变时重复的 /report 不再格式化。
+    """
+
+    def __init__(self, loader, recent_loader):
+        self.loader = loader
+        self.recent_loader = recent_loader
+        self.periods = {}
+        self.versions = {}      # chat_id -> 数据版本
+        self.rendered = {}      # (chat_id, variant) -> ((period, version), 渲染结果)
+        self.render_hits = 0
+        self.render_misses = 0
+
+    async def get(self, chat_id, start_utc, end_utc, recent=6):
+        # 加载期间有 record / undo / reset（例如批量写入模式下刚提交的一条），
+        # 读到的快照可能不包含它，而内存里没有 agg 时那次修改会被丢掉 → 重新加载
+        while True:
+            version = self.versions.get(chat_id, 0)
+            agg = self.periods.get(chat_id)
+            if agg is None or agg.start_utc != start_utc:
+                people, rows = await self.loader(chat_id, start_utc, end_utc)
+                if self.versions.get(chat_id, 0) != version:
+                    continue
+                return self.replace(chat_id, start_utc, people, rows)
+
+            if agg.needs_recent(recent):
+                rows = await self.recent_loader(chat_id, start_utc, end_utc)
+                if self.versions.get(chat_id, 0) != version:
+                    continue
+                agg.recent.clear()
+                agg.recent.extend(reversed(rows))
+
+            return agg
+
+    def replace(self, chat_id, start_utc, people, rows):
+        """people: (user_name, count, total)；rows: 最近记录，新 → 旧"""
+        agg = PeriodAggregate(start_utc)
+        for user_name, count, total in people:
+            agg.people[user_name] = [count, Decimal(total)]
+            agg.count += count
+            agg.total += Decimal(total)
+        agg.recent.extend(reversed(rows))
+        self.periods[chat_id] = agg
+        self.bump(chat_id)
+        return agg
+
+    def current(self, chat_id, start_utc):
+        agg = self.periods.get(chat_id)
+        if agg is not None and agg.start_utc == start_utc:
+            return agg
+        return None
+
+    def record(self, chat_id, start_utc, row_id, amount, user_name, timestamp):
+        self.bump(chat_id)
+        agg = self.current(chat_id, start_utc)
+        if agg is not None:
+            agg.add(row_id, amount, user_name, timestamp)
+
+    def undo(self, chat_id, start_utc, row_id, amount, user_name):
+        self.bump(chat_id)
+        agg = self.current(chat_id, start_utc)
+        if agg is not None:
+            agg.remove(row_id, amount, user_name)
+
+    def reset(self, chat_id, start_utc):
+        self.bump(chat_id)
+        self.periods[chat_id] = PeriodAggregate(start_utc)
+
+    def invalidate(self, chat_id=None):
+        if chat_id is None:
+            self.periods.clear()
+            self.rendered.clear()
+        else:
+            self.bump(chat_id)
+            self.periods.pop(chat_id, None)
+
+    # ===== 渲染缓存 =====
+
+    def bump(self, chat_id):
+        self.versions[chat_id] = self.versions.get(chat_id, 0) + 1
+
+    async def render(self, chat_id, period, variant, build):
+        """
+        period: (start_utc, end_utc, tz)，时区变化也会换键；
+        版本在 build() 之前读取，渲染期间有新的写入时结果只会被当作过期
+        """
+        key = (period, self.versions.get(chat_id, 0))
+        entry = self.rendered.get((chat_id, variant))
+        if entry is not None and entry[0] == key:
+            self.render_hits += 1
+            return entry[1]
+
+        self.render_misses += 1
+        value = await build()
+        self.rendered[(chat_id, variant)] = (key, value)
+        return value
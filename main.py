@@ -1,22 +1,94 @@
 import os
-import re
+import signal
+import asyncio
 import logging
-import tempfile
+import io
 from decimal import Decimal
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from telegram import Update
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
-from database import get_db_connection, init_db
+from telegram.ext import Application, MessageHandler, CallbackQueryHandler, filters, ContextTypes
+from database import run, stream
+from database import maintain_history_partitions, HISTORY_RETENTION_MONTHS
+from database import rollup_closed_periods, pool_stats
+from cache import PermissionCache, ChatSettingsCache, utc_naive, utc_aware
+from ledger import PeriodLedger
+from writebehind import WriteBehindQueue
+from coalescer import SummaryCoalescer
+from outbound import OutboundLimiter, BULK
+from concurrency import ChatOrderedProcessor
+from dispatcher import CommandDispatcher, AMOUNT_RE
+from directory import ChatDirectory
+from export import export_history, available, FORMATS
+from storage import open_storage
+import metrics
+import tracing
+import shard
 from telegram import InlineKeyboardMarkup, InlineKeyboardButton
 
 
 TOKEN = os.getenv("TOKEN")
 MASTER_ID = os.getenv("MASTER_ID")
 
+# postgres（默认）或 sqlite（单机，不需要数据库服务器）
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "postgres")
+SQLITE_PATH = os.getenv("SQLITE_PATH", "tg_bot.db")
+# 权限缓存整表重新读取间隔（秒）
+PERMISSION_CACHE_TTL = int(os.getenv("PERMISSION_CACHE_TTL", "300"))
+# 群组设置缓存有效期（秒）
+SETTINGS_CACHE_TTL = int(os.getenv("SETTINGS_CACHE_TTL", "300"))
+# 批量写入窗口（毫秒），0 = 每条单独提交
+WRITE_BATCH_MS = int(os.getenv("WRITE_BATCH_MS", "0"))
+# 账单合并：等待毫秒数（0 = 每次发新消息）/ 多少秒内的账单消息原地编辑
+SUMMARY_DEBOUNCE_MS = int(os.getenv("SUMMARY_DEBOUNCE_MS", "1000"))
+SUMMARY_EDIT_WINDOW = int(os.getenv("SUMMARY_EDIT_WINDOW", "60"))
+# Telegram 出站限速
+OUTBOUND_GLOBAL_PER_SEC = int(os.getenv("OUTBOUND_GLOBAL_PER_SEC", "30"))
+OUTBOUND_GROUP_PER_MIN = int(os.getenv("OUTBOUND_GROUP_PER_MIN", "20"))
+# 同时处理的更新数（不同群并行，同群按顺序）；<= 1 为逐条处理
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "1"))
+# 群名 / 用户名目录：多少秒后刷新，刷新时最多并发几个 get_chat
+DIRECTORY_TTL = int(os.getenv("DIRECTORY_TTL", "86400"))
+DIRECTORY_CONCURRENCY = int(os.getenv("DIRECTORY_CONCURRENCY", "8"))
+# /users 每个文件最多多少行
+USERS_PAGE_LINES = int(os.getenv("USERS_PAGE_LINES", "5000"))
+# /all 每页条数
+ALL_PAGE_SIZE = int(os.getenv("ALL_PAGE_SIZE", "30"))
+# /export 每批读取行数、每个文件最多行数
+EXPORT_BATCH = int(os.getenv("EXPORT_BATCH", "5000"))
+EXPORT_PART_ROWS = int(os.getenv("EXPORT_PART_ROWS", "200000"))
+# /history 最多查询多少天
+HISTORY_REPORT_MAX_DAYS = int(os.getenv("HISTORY_REPORT_MAX_DAYS", "366"))
+# Prometheus 指标端口（0 = 不开启），默认只监听本机
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+
+# Webhook 模式：设置 WEBHOOK_URL 后不再使用 polling
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+# 接收与处理之间的队列长度（满了接收端会等待）
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", "1000"))
+# 本地测试可指向假的 Bot API，例如 http://127.0.0.1:8081
+TELEGRAM_API_BASE = os.getenv("TELEGRAM_API_BASE")
+
+# 多进程模式（由 ingress.py 启动并设置）：不直接接收更新，只处理转发来的
+SHARD_PORT = int(os.getenv("SHARD_PORT", "0"))
+SHARD_HOST = os.getenv("SHARD_HOST", "127.0.0.1")
+SHARD_INDEX = int(os.getenv("SHARD_INDEX", "0"))
+SHARD_PEERS = [url for url in os.getenv("SHARD_PEERS", "").split(",") if url]
+# ingress 和 worker 之间的共享口令（ingress 启动 worker 时自动生成）
+SHARD_TOKEN = os.getenv("SHARD_TOKEN")
+
 if not TOKEN:
     raise ValueError("TOKEN not set")
 if not MASTER_ID:
     raise ValueError("MASTER_ID not set")
+if WEBHOOK_URL and not WEBHOOK_SECRET:
+    raise ValueError("WEBHOOK_SECRET not set")
+if SHARD_PORT and not SHARD_TOKEN:
+    raise ValueError("SHARD_TOKEN not set")
 
 logging.basicConfig(level=logging.INFO)
 # ==============================
@@ -50,45 +122,22 @@ async def start_bot(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def starts_bot(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
 
-    ensure_chat_settings(chat_id)
-
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    # 读取时区和工作时间
-    cursor.execute("""
-        SELECT timezone, work_start
-        FROM chat_settings
-        WHERE chat_id=%s
-    """, (chat_id,))
-    tz, work_start = cursor.fetchone()
+    # 当前工作轮次（含时区）
+    start_utc, end_utc, tz = await get_work_period(chat_id)
 
     # 当前时间
     now_utc = datetime.utcnow()
     now_local = now_utc + timedelta(hours=tz)
 
-    # 当前工作轮次
-    start_utc, end_utc, _ = get_work_period(chat_id)
     start_local = start_utc + timedelta(hours=tz)
     end_local = end_utc + timedelta(hours=tz)
 
     # 操作者数量
-    cursor.execute("""
-        SELECT COUNT(*) FROM team_members
-        WHERE chat_id=%s
-    """, (chat_id,))
-    operator_count = cursor.fetchone()[0]
+    operator_count = sum(1 for _, cid in permissions.members if cid == chat_id)
 
     # 本轮记录数量
-    cursor.execute("""
-        SELECT COUNT(*) FROM history
-        WHERE chat_id=%s
-        AND timestamp BETWEEN %s AND %s
-    """, (chat_id, start_utc, end_utc))
-    record_count = cursor.fetchone()[0]
-
-    cursor.close()
-    conn.close()
+    agg = await ledger.get(chat_id, start_utc, end_utc)
+    record_count = agg.count
 
     record_status = "有记录 📊" if record_count > 0 else "暂无记录 📭"
 
@@ -120,6 +169,8 @@ async def help_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "/all 或 /全部 - 查看全部记录\n"
         "/undo 或 /撤销 - 撤销上一条\n"
         "/reset 或 /重置 - 重置当前轮次\n"
+        "/export 或 /导出 - 导出账单 例如：/export 2024-05-01 2024-05-31 xlsx\n"
+        "/history 或 /历史账单 - 按天汇总 例如：/history 2024-05-01 2024-05-31\n"
         "\n"
         "👥 Owner 功能\n"
         "/add 或 /添加 - 用回复的方式来回复需要增加的操纵人\n"
@@ -130,9 +181,26 @@ async def help_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     await update.message.reply_text(text)
 # ==============================
+# 存储
+# ==============================
+
+storage = open_storage(STORAGE_BACKEND, SQLITE_PATH)
+
+
+async def postgres_only(update: Update):
+    """报表类功能直接查询 Postgres，sqlite 后端下提示不可用"""
+    if storage.name == "postgres":
+        return True
+    await update.message.reply_text("⚠️ 该功能需要 STORAGE_BACKEND=postgres")
+    return False
+
+# ==============================
 # 权限系统
 # ==============================
 
+permissions = PermissionCache(storage.load_permissions, ttl=PERMISSION_CACHE_TTL)
+
+
 async def is_master(update: Update):
     return str(update.effective_user.id) == str(MASTER_ID)
 
@@ -141,157 +209,373 @@ async def is_owner(update: Update):
     if await is_master(update):
         return True
 
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT expire_date FROM admins WHERE user_id=%s",
-                   (update.effective_user.id,))
-    row = cursor.fetchone()
-    cursor.close()
-    conn.close()
-
-    return row and row[0] > datetime.utcnow()
+    await permissions.ensure()
+    return permissions.is_owner(update.effective_user.id)
 
 
 async def is_operator(update: Update):
     if await is_owner(update):
         return True
 
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("""
-        SELECT 1 FROM team_members
-        WHERE member_id=%s AND chat_id=%s
-    """, (update.effective_user.id, update.effective_chat.id))
-    row = cursor.fetchone()
-    cursor.close()
-    conn.close()
-
-    return bool(row)
+    return permissions.is_operator(update.effective_user.id, update.effective_chat.id)
 
 # ==============================
 # 工作时间段
 # ==============================
 
-def ensure_chat_settings(chat_id):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT 1 FROM chat_settings WHERE chat_id=%s", (chat_id,))
-    if not cursor.fetchone():
-        cursor.execute("INSERT INTO chat_settings (chat_id) VALUES (%s)", (chat_id,))
-        conn.commit()
-    cursor.close()
-    conn.close()
+chat_settings = ChatSettingsCache(storage.load_chat_settings,
+                                  ttl=SETTINGS_CACHE_TTL)
 
 
-def get_work_period(chat_id):
-    ensure_chat_settings(chat_id)
+async def get_work_period(chat_id):
+    return await chat_settings.work_period(chat_id)
 
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT timezone, work_start FROM chat_settings WHERE chat_id=%s",
-                   (chat_id,))
-    tz, work_start = cursor.fetchone()
-    cursor.close()
-    conn.close()
+# ==============================
+# 当前轮次累计（内存）
+# ==============================
+
+ledger = PeriodLedger(storage.load_period, storage.load_recent)
+
+
+history_writer = (
+    WriteBehindQueue(storage.insert_history_batch,
+                     window_ms=WRITE_BATCH_MS)
+    if WRITE_BATCH_MS > 0 else None
+)
 
-    now_utc = datetime.utcnow()
-    now_local = now_utc + timedelta(hours=tz)
 
-    today_start = datetime.combine(now_local.date(), work_start)
-    if now_local < today_start:
-        today_start -= timedelta(days=1)
+async def refresh_period_totals(chat_id):
+    """时区 / 工作时间改变后，按新的轮次重建合计"""
+    start_utc, end_utc, _ = await get_work_period(chat_id)
+    await storage.rebuild_period_totals(chat_id, start_utc, end_utc)
+    ledger.invalidate(chat_id)
 
-    start_utc = today_start - timedelta(hours=tz)
-    end_utc = start_utc + timedelta(days=1)
 
-    return start_utc, end_utc, tz
+async def get_period_aggregate(chat_id):
+    start_utc, end_utc, tz = await get_work_period(chat_id)
+    agg = await ledger.get(chat_id, start_utc, end_utc)
+    return agg, start_utc, end_utc, tz
 
 # ==============================
 # 账单显示
 # ==============================
 
-async def send_summary(update: Update, context: ContextTypes.DEFAULT_TYPE, show_all=False):
+summaries = SummaryCoalescer(debounce_ms=SUMMARY_DEBOUNCE_MS, edit_window=SUMMARY_EDIT_WINDOW)
+
+
+def fmt(n: Decimal):
+    return f"{n:,.2f}".rstrip("0").rstrip(".")
+
+
+def render_rows(display, start_index, tz):
+    text = ""
+    for i, r in enumerate(display):
+        local_time = r[3] + timedelta(hours=tz)
+        # แสดงลำดับที่ + เวลา | จำนวนเงิน
+        text += f"{start_index + i}. {local_time.strftime('%H:%M')} | {fmt(Decimal(r[1]))}  ({r[2]}) \n" 
+        #text += f"{start_index + i}. {local_time.strftime('%H:%M')} | {fmt(Decimal(r[1]))} ({r[2]})\n"
+    return text
+
+
+def render_totals(agg):
+    text = "━━━━━━━━━━━━━━━\n"
+    text += f"**合计: {fmt(agg.total)}**\n\n"
+
+    # ====== สรุปแยกตามคน ======
+    # ⭐ เรียงจากยอดรวมมาก → น้อย
+    sorted_people = agg.sorted_people()
+
+    text += "👤 按人统计:\n"
+    for name, (count, person_total) in sorted_people:
+        text += f"{name} | {count} 笔 | {fmt(person_total)}\n"
+    return text
+
+
+async def render_summary(chat_id):
+    # 数据版本不变时直接返回上次渲染的文本
+    period = await get_work_period(chat_id)
+    return await ledger.render(chat_id, period, "summary", lambda: build_summary(chat_id))
+
+
+async def build_summary(chat_id):
+    agg, start_utc, end_utc, tz = await get_period_aggregate(chat_id)
+
+    if agg.count == 0:
+        return "📋 今天没有记录"
+
+    display = agg.last(6)
+    start_index = agg.count - len(display) + 1
+
+    text = "📋 今天记录:\n━━━━━━━━━━━━━━━\n"
+    # เพิ่มส่วนนี้: ถ้าจำนวนแถวมีมากกว่า 6 ให้ใส่ ...
+    if agg.count > 6:
+        text += "  ...\n"
+    text += render_rows(display, start_index, tz)
+    text += render_totals(agg)
+
+    return text
+
+# ==============================
+# 全部记录（分页）
+# ==============================
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def page_button(label, direction, row, page):
+    """callback_data: page:<n|p>:<时间戳微秒>:<id>:<页码>（不超过 64 字节）"""
+    micros = (row[3] - EPOCH) // timedelta(microseconds=1)
+    return InlineKeyboardButton(label, callback_data=f"page:{direction}:{micros}:{row[0]}:{page}")
+
+
+async def render_all_page(chat_id, direction="n", after=None, page=1):
+    if after is not None:
+        return await build_all_page(chat_id, direction, after, page)
+
+    # /all 的第一页与摘要一样按数据版本缓存，翻页按需查询
+    period = await get_work_period(chat_id)
+    return await ledger.render(chat_id, period, "all",
+                               lambda: build_all_page(chat_id, "n", None, 1))
+
+
+async def build_all_page(chat_id, direction, after, page):
+    agg, start_utc, end_utc, tz = await get_period_aggregate(chat_id)
+
+    if agg.count == 0:
+        return "📋 今天没有记录", None
+
+    after = after or (EPOCH, 0)
+    rows, has_next = await storage.load_page(chat_id, start_utc, end_utc,
+                                             direction, after, ALL_PAGE_SIZE)
+    if not rows:
+        return "📋 没有更多记录", None
+
+    pages = (agg.count + ALL_PAGE_SIZE - 1) // ALL_PAGE_SIZE
+    text = f"📋 今天全部记录（{page}/{pages}）:\n━━━━━━━━━━━━━━━\n"
+    text += render_rows(rows, (page - 1) * ALL_PAGE_SIZE + 1, tz)
+    text += render_totals(agg)
+
+    buttons = []
+    if page > 1:
+        buttons.append(page_button("◀", "p", rows[0], page - 1))
+    if has_next:
+        buttons.append(page_button("▶", "n", rows[-1], page + 1))
+
+    return text, InlineKeyboardMarkup([buttons]) if buttons else None
+
+
+async def send_all(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    text, markup = await render_all_page(update.effective_chat.id)
+    await update.message.reply_text(text, parse_mode='Markdown', reply_markup=markup)
+
+
+async def all_page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+
+    try:
+        _, direction, micros, row_id, page = query.data.split(":")
+        after = (EPOCH + timedelta(microseconds=int(micros)), int(row_id))
+        page = int(page)
+    except ValueError:
+        return
+
+    text, markup = await render_all_page(query.message.chat.id, direction, after, page)
+    await query.edit_message_text(text, parse_mode='Markdown', reply_markup=markup)
+
+
+async def send_summary(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
+
+    # /report：立即发新账单，取消待合并的更新
+    await summaries.flush(context.bot, chat_id, lambda: render_summary(chat_id))
+
+
+async def post_summary(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """记账 / 撤销 / 重置之后的账单：合并连续更新，尽量原地编辑"""
+    chat_id = update.effective_chat.id
+    await summaries.request(context.bot, chat_id, lambda: render_summary(chat_id))
+
+# ==============================
+# 导出
+# ==============================
+
+EXPORT_SQL = """
+    SELECT id, amount, user_name, timestamp
+    FROM history
+    WHERE chat_id=%s
+    AND timestamp >= %s AND timestamp < %s
+    ORDER BY timestamp ASC, id ASC
+"""
+
+
+def parse_export_args(args, tz, work_start):
+    """
+    /export [开始日期 [结束日期]] [csv|xlsx]，日期格式 YYYY-MM-DD（本地工作日）。
+    返回 (start_utc, end_utc, 格式)；没有日期时返回 None，表示当前轮次。
+    """
+    out_format = "csv"
+    days = []
+    for arg in args or []:
+        if arg.lower() in FORMATS:
+            out_format = arg.lower()
+        else:
+            days.append(datetime.strptime(arg, "%Y-%m-%d").date())
+
+    if len(days) > 2:
+        raise ValueError("too many dates")
+    if not days:
+        return None, None, out_format
+
+    first, last = days[0], days[-1]
+    if last < first:
+        raise ValueError("end before start")
+
+    start_utc = datetime.combine(first, work_start) - timedelta(hours=tz)
+    end_utc = datetime.combine(last + timedelta(days=1), work_start) - timedelta(hours=tz)
+    return start_utc, end_utc, out_format
+
+
+async def export_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not await is_operator(update):
+        return
+    if not await postgres_only(update):
+        return
+
     chat_id = update.effective_chat.id
-    start_utc, end_utc, tz = get_work_period(chat_id)
+    tz, work_start = await chat_settings.get(chat_id)
+
+    try:
+        start_utc, end_utc, out_format = parse_export_args(context.args, tz, work_start)
+    except ValueError:
+        await update.message.reply_text(
+            "用法: /export [开始日期 [结束日期]] [csv|xlsx]\n例如：/export 2024-05-01 2024-05-31"
+        )
+        return
 
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    if not available(out_format):
+        await update.message.reply_text("❌ 服务器未安装 openpyxl，只能导出 csv")
+        return
+
+    if start_utc is None:
+        start_utc, end_utc, tz = await get_work_period(chat_id)
+
+    first = (start_utc + timedelta(hours=tz)).strftime("%Y%m%d")
+    last = (end_utc + timedelta(hours=tz) - timedelta(seconds=1)).strftime("%Y%m%d")
+    label = first if first == last else f"{first}-{last}"
+
+    async def send(file, part):
+        suffix = f"_{part}" if part > 1 else ""
+        await update.message.reply_document(
+            document=file,
+            filename=f"history_{label}{suffix}.{out_format}",
+            caption="📤 账单导出" if part == 1 else f"📤 账单导出（续 {part}）",
+            rate_limit_args={"priority": BULK},
+        )
+
+    batches = stream(EXPORT_SQL, (chat_id, utc_aware(start_utc), utc_aware(end_utc)),
+                     batch_size=EXPORT_BATCH, name="history_export")
+    total, parts = await export_history(batches, tz, out_format, EXPORT_PART_ROWS, send)
+
+    if parts > 1:
+        await update.message.reply_text(f"✅ 共导出 {total} 条，分 {parts} 个文件")
+
+# ==============================
+# 多日报表（daily_rollup）
+# ==============================
+
+def load_daily_rollup(cursor, chat_id, first, last):
+    # 先把这个群刚结束的工作日补进汇总表
+    rollup_closed_periods(cursor, chat_id)
+    # 改过时区 / 上班时间的那天可能有两个轮次，只取最新的，不重复计算
     cursor.execute("""
-        SELECT amount, user_name, timestamp
-        FROM history
-        WHERE chat_id=%s
-        AND timestamp BETWEEN %s AND %s
-        ORDER BY timestamp ASC
-    """, (chat_id, start_utc, end_utc))
-    rows = cursor.fetchall()
-    cursor.close()
-    conn.close()
+        SELECT work_day, user_name, entry_count, total
+        FROM daily_rollup r
+        WHERE chat_id=%s AND work_day BETWEEN %s AND %s
+        AND period_start = (
+            SELECT MAX(x.period_start) FROM daily_rollup x
+            WHERE x.chat_id = r.chat_id AND x.work_day = r.work_day
+        )
+        ORDER BY work_day
+    """, (chat_id, first, last))
+    return cursor.fetchall()
 
-    if not rows:
-        await update.message.reply_text("📋 今天没有记录")
+
+async def history_report(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/history <开始日期> <结束日期>：按天、按人汇总"""
+    if not await is_operator(update):
+        return
+    if not await postgres_only(update):
         return
 
-    total = sum(Decimal(r[0]) for r in rows)
+    chat_id = update.effective_chat.id
 
-    display = rows if show_all else rows[-6:]
-    start_index = len(rows) - len(display) + 1
+    try:
+        first, last = (datetime.strptime(arg, "%Y-%m-%d").date() for arg in context.args)
+        if last < first or (last - first).days >= HISTORY_REPORT_MAX_DAYS:
+            raise ValueError
+    except ValueError:
+        await update.message.reply_text(
+            f"用法: /history 开始日期 结束日期（最多 {HISTORY_REPORT_MAX_DAYS} 天）\n"
+            "例如：/history 2024-05-01 2024-05-31"
+        )
+        return
 
-    def fmt(n: Decimal):
-        return f"{n:,.2f}".rstrip("0").rstrip(".")
+    rows = await run(load_daily_rollup, chat_id, first, last)
 
-    text = "📋 今天记录:\n━━━━━━━━━━━━━━━\n"
-    # เพิ่มส่วนนี้: ถ้าไม่ได้โชว์ทั้งหมด และจำนวนแถวมีมากกว่า 6 ให้ใส่ ...
-    if not show_all and len(rows) > 6:
-        text += "  ...\n"
-    for i, r in enumerate(display):
-        local_time = r[2] + timedelta(hours=tz)
-        # แสดงลำดับที่ + เวลา | จำนวนเงิน
-        text += f"{start_index + i}. {local_time.strftime('%H:%M')} | {fmt(Decimal(r[0]))}  ({r[1]}) \n" 
-        #text += f"{start_index + i}. {local_time.strftime('%H:%M')} | {fmt(Decimal(r[0]))} ({r[1]})\n"
+    days = {}       # work_day -> [count, total]
+    people = {}     # user_name -> [count, total]
 
+    def add(day, name, count, total):
+        for bucket, key in ((days, day), (people, name)):
+            entry = bucket.setdefault(key, [0, Decimal(0)])
+            entry[0] += count
+            entry[1] += Decimal(total)
 
+    for day, name, count, total in rows:
+        add(day, name, count, total)
 
-    text += "━━━━━━━━━━━━━━━\n"
-    text += f"**合计: {fmt(total)}**\n\n"
+    # 当前工作日还没汇总，直接用内存里的合计
+    agg, start_utc, end_utc, tz = await get_period_aggregate(chat_id)
+    today = (start_utc + timedelta(hours=tz)).date()
+    if first <= today <= last:
+        for name, (count, total) in agg.sorted_people():
+            add(today, name, count, total)
 
-    
-   
-    # ====== สรุปแยกตามคน ======
-    person_summary = {}
-    for amount, user_name, _ in rows:
-        amount = Decimal(amount)
-        if user_name not in person_summary:
-            person_summary[user_name] = {"count": 0, "total": Decimal("0")}
-        person_summary[user_name]["count"] += 1
-        person_summary[user_name]["total"] += amount
+    if not days:
+        await update.message.reply_text("📅 这段时间没有记录")
+        return
 
-    # ⭐ เรียงจากยอดรวมมาก → น้อย
-    sorted_people = sorted(
-        person_summary.items(),
-        key=lambda x: x[1]["total"],
-        reverse=True
-    )
+    text = f"📅 {first} ~ {last}\n━━━━━━━━━━━━━━━\n"
+    for day in sorted(days):
+        count, total = days[day]
+        text += f"{day} | {count} 笔 | {fmt(total)}\n"
+
+    text += "━━━━━━━━━━━━━━━\n"
+    grand_total = sum(total for _, total in days.values())
+    grand_count = sum(count for count, _ in days.values())
+    text += f"**合计: {fmt(grand_total)}**（{grand_count} 笔）\n\n"
 
     text += "👤 按人统计:\n"
-    for name, data in sorted_people:
-        text += f"{name} | {data['count']} 笔 | {fmt(data['total'])}\n"
+    for name, (count, total) in sorted(people.items(), key=lambda x: x[1][1], reverse=True):
+        text += f"{name} | {count} 笔 | {fmt(total)}\n"
 
-     # ส่งข้อความ
     await update.message.reply_text(text, parse_mode='Markdown')
-    #await update.message.reply_text(text)
+
 # ==============================
 # 记账
 # ==============================
 
 async def handle_msg(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not await is_operator(update):
+    # รับเฉพาะ +xx หรือ -xx（dispatcher 已经匹配过）
+    if context.matches:
+        match = context.matches[0]
+    else:
+        match = AMOUNT_RE.match(update.message.text.strip())
+    if not match:
         return
 
-    text = update.message.text.strip()
-
-    # รับเฉพาะ +xx หรือ -xx
-    match = re.match(r'^([+-])\s*([\d,]+(?:\.\d{1,2})?)$', text)
-    if not match:
+    if not await is_operator(update):
         return
 
     sign = match.group(1)
@@ -308,18 +592,31 @@ async def handle_msg(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         user_name = update.message.from_user.first_name
 
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute(
-        "INSERT INTO history (chat_id, amount, user_name) VALUES (%s,%s,%s)",
-        (update.effective_chat.id, amount, user_name)
-    )
-    conn.commit()
-    cursor.close()
-    conn.close()
+    chat_id = update.effective_chat.id
+    start_utc, end_utc, _ = await get_work_period(chat_id)
+
+    if history_writer is not None:
+        # 批量模式：和其他群的写入一起提交，提交后才回复
+        row = await history_writer.submit(
+            (chat_id, start_utc, user_name, amount, datetime.now(timezone.utc))
+        )
+        ledger.record(chat_id, start_utc, row[0], amount, user_name, row[1])
+    else:
+        # 一次往返：权限检查 + 写入 + 合计 + 最近 6 条
+        result = await storage.record_entry(
+            chat_id, update.effective_user.id, await is_master(update),
+            user_name, amount, start_utc, end_utc, 6
+        )
+        if result is None:
+            # 其他进程已撤销权限，本地缓存过期
+            await permissions.refresh()
+            return
+
+        people, recent = result
+        ledger.replace(chat_id, start_utc, people, recent)
 
     # ส่งกลับเฉพาะ summary
-    await send_summary(update, context)
+    await post_summary(update, context)
 
 # ==============================
 # 撤销
@@ -330,30 +627,18 @@ async def undo_last(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     chat_id = update.effective_chat.id
-    start_utc, end_utc, _ = get_work_period(chat_id)
+    start_utc, end_utc, _ = await get_work_period(chat_id)
 
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("""
-        SELECT id, amount FROM history
-        WHERE chat_id=%s
-        AND timestamp BETWEEN %s AND %s
-        ORDER BY timestamp DESC LIMIT 1
-    """, (chat_id, start_utc, end_utc))
-    row = cursor.fetchone()
+    row = await storage.undo_last(chat_id, start_utc, end_utc)
 
     if not row:
         await update.message.reply_text("⚠️ 当前没有可撤销的记录")
-        cursor.close(); conn.close()
         return
 
-    cursor.execute("DELETE FROM history WHERE id=%s", (row[0],))
-    conn.commit()
-    cursor.close()
-    conn.close()
+    ledger.undo(chat_id, start_utc, row[0], row[1], row[2])
 
     await update.message.reply_text(f"↩️ 已撤销记录: {row[1]}")
-    await send_summary(update, context)
+    await post_summary(update, context)
 
 # ==============================
 # 重置
@@ -364,21 +649,13 @@ async def reset_current(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     chat_id = update.effective_chat.id
-    start_utc, end_utc, _ = get_work_period(chat_id)
+    start_utc, end_utc, _ = await get_work_period(chat_id)
 
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("""
-        DELETE FROM history
-        WHERE chat_id=%s
-        AND timestamp BETWEEN %s AND %s
-    """, (chat_id, start_utc, end_utc))
-    conn.commit()
-    cursor.close()
-    conn.close()
+    await storage.reset_period(chat_id, start_utc, end_utc)
+    ledger.reset(chat_id, start_utc)
 
     await update.message.reply_text("🗑️ 今天已清空")
-    await send_summary(update, context)
+    await post_summary(update, context)
 
 # ==============================
 # 添加操作者
@@ -398,16 +675,7 @@ async def add_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif context.args:
         username = context.args[0].lstrip("@")
 
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT member_id, username
-            FROM team_members
-            WHERE chat_id=%s AND username=%s
-        """, (update.effective_chat.id, username))
-        row = cursor.fetchone()
-        cursor.close()
-        conn.close()
+        row = await storage.find_member(update.effective_chat.id, username)
 
         if not row:
             await update.message.reply_text("⚠️ 找不到该用户，请先让他在群里说话一次")
@@ -425,18 +693,8 @@ async def add_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("⚠️ 请回复用户 或 使用: /添加 @username")
         return
 
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("""
-        INSERT INTO team_members (member_id, chat_id, username)
-        VALUES (%s,%s,%s)
-        ON CONFLICT (member_id, chat_id)
-        DO UPDATE SET username=%s
-    """, (target.id, update.effective_chat.id,
-          target.first_name, target.first_name))
-    conn.commit()
-    cursor.close()
-    conn.close()
+    await storage.add_member(target.id, update.effective_chat.id, target.first_name)
+    permissions.add_member(target.id, update.effective_chat.id)
 
     await update.message.reply_text(f"✅ 已添加操作人: {target.first_name}")
 # ==============================
@@ -460,16 +718,7 @@ async def remove_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif context.args:
         username = context.args[0].lstrip("@")
 
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT member_id, username
-            FROM team_members
-            WHERE chat_id=%s AND username=%s
-        """, (update.effective_chat.id, username))
-        row = cursor.fetchone()
-        cursor.close()
-        conn.close()
+        row = await storage.find_member(update.effective_chat.id, username)
 
         if not row:
             await update.message.reply_text("⚠️ 找不到该用户，或该用户不是操作者")
@@ -482,15 +731,8 @@ async def remove_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("⚠️ 请回复用户 或 使用: /删除 @username")
         return
 
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("""
-        DELETE FROM team_members
-        WHERE member_id=%s AND chat_id=%s
-    """, (target_id, update.effective_chat.id))
-    conn.commit()
-    cursor.close()
-    conn.close()
+    await storage.remove_member(target_id, update.effective_chat.id)
+    permissions.remove_member(target_id, update.effective_chat.id)
 
     await update.message.reply_text(f"🗑️ 已删除操作人: {target_name}")
 
@@ -519,17 +761,9 @@ async def set_timezone(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("用法: /设置时区 +8")
         return
 
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("""
-        INSERT INTO chat_settings (chat_id, timezone)
-        VALUES (%s,%s)
-        ON CONFLICT (chat_id)
-        DO UPDATE SET timezone=%s
-    """, (update.effective_chat.id, tz, tz))
-    conn.commit()
-    cursor.close()
-    conn.close()
+    row = await storage.set_timezone(update.effective_chat.id, tz)
+    chat_settings.set(update.effective_chat.id, row[0], row[1])
+    await refresh_period_totals(update.effective_chat.id)
 
     # ====== เพิ่ม 目前时间 ======
     now_utc = datetime.utcnow()
@@ -565,23 +799,11 @@ async def set_worktime(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("用法: /设置时间 14:00")
         return
 
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("""
-        INSERT INTO chat_settings (chat_id, work_start)
-        VALUES (%s,%s)
-        ON CONFLICT (chat_id)
-        DO UPDATE SET work_start=%s
-    """, (update.effective_chat.id, time_str, time_str))
-    conn.commit()
-
-    # 取出当前时区
-    cursor.execute("SELECT timezone FROM chat_settings WHERE chat_id=%s",
-                   (update.effective_chat.id,))
-    tz = cursor.fetchone()[0]
-
-    cursor.close()
-    conn.close()
+    # 写入并取出当前时区
+    row = await storage.set_worktime(update.effective_chat.id, time_str)
+    tz = row[0]
+    chat_settings.set(update.effective_chat.id, row[0], row[1])
+    await refresh_period_totals(update.effective_chat.id)
 
     # 计算目前时间
     now_utc = datetime.utcnow()
@@ -616,18 +838,12 @@ async def check_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
     # Owner
-    cursor.execute(
-        "SELECT expire_date FROM admins WHERE user_id=%s",
-        (user_id,)
-    )
-    row = cursor.fetchone()
+    await permissions.ensure()
+    expire = permissions.owner_expire(user_id)
 
-    if row and row[0] > datetime.utcnow():
-        remaining = row[0] - datetime.utcnow()
+    if permissions.is_owner(user_id):
+        remaining = expire - datetime.utcnow()
 
         total_seconds = int(remaining.total_seconds())
 
@@ -635,9 +851,6 @@ async def check_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
         hours = (total_seconds % 86400) // 3600
         minutes = (total_seconds % 3600) // 60
 
-        cursor.close()
-        conn.close()
-
         await update.message.reply_text(
             f"🆔 ID: {user_id}\n"
             "👑 身份: Owner\n"
@@ -646,24 +859,13 @@ async def check_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     # Operator
-    cursor.execute("""
-        SELECT 1 FROM team_members
-        WHERE member_id=%s AND chat_id=%s
-    """, (user_id, update.effective_chat.id))
-
-    if cursor.fetchone():
-        cursor.close()
-        conn.close()
-
+    if permissions.is_operator(user_id, update.effective_chat.id):
         await update.message.reply_text(
             f"🆔 ID: {user_id}\n"
             "👥 身份: 操作者"
         )
         return
 
-    cursor.close()
-    conn.close()
-
     # 普通成员
     await update.message.reply_text(
         f"🆔 ID: {user_id}\n"
@@ -690,32 +892,25 @@ async def renew_owner(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("用法: /续费 用户ID 天数 或 回复用户 /续费 天数")
         return
 
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT expire_date FROM admins WHERE user_id=%s", (target_id,))
-    row = cursor.fetchone()
-
-    now = datetime.utcnow()
-    if row and row[0] > now:
-        new_expire = row[0] + timedelta(days=days)
-    else:
-        new_expire = now + timedelta(days=days)
-
-    cursor.execute("""
-        INSERT INTO admins (user_id, expire_date)
-        VALUES (%s,%s)
-        ON CONFLICT (user_id)
-        DO UPDATE SET expire_date=%s
-    """, (target_id, new_expire, new_expire))
-
-    conn.commit()
-    cursor.close()
-    conn.close()
+    new_expire = await storage.extend_owner(target_id, days)
+    permissions.set_owner(target_id, new_expire)
+    await shard.broadcast(SHARD_PEERS, SHARD_TOKEN, {"permissions": True})
 
     await update.message.reply_text(
         f"✅ 已续费 {days} 天\n到期时间: {new_expire.strftime('%Y-%m-%d %H:%M')}"
     )
 
+# ==============================
+# 群名 / 用户名目录
+# ==============================
+
+directory = ChatDirectory(
+    storage.load_directory,
+    storage.save_directory,
+    ttl=DIRECTORY_TTL,
+    concurrency=DIRECTORY_CONCURRENCY,
+)
+
 # ==============================
 # 查看用户列表（按群名，仅 Master）
 # ==============================
@@ -724,99 +919,178 @@ async def renew_owner(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # 查看用户列表（按群显示 Owners + Operators，仅 Master）
 # ==============================
 
+USERS_REPORT_SQL = """
+    SELECT section, chat_id, chat_name, user_id, name, expire_date, is_stale,
+           sort_chat, sort_expire
+    FROM (
+        SELECT 0 AS section, NULL::BIGINT AS chat_id, NULL AS chat_name,
+               a.user_id, d.name, a.expire_date,
+               d.updated_at IS NULL OR d.updated_at < NOW() - %(ttl)s * INTERVAL '1 second' AS is_stale,
+               0::BIGINT AS sort_chat,
+               -EXTRACT(EPOCH FROM a.expire_date)::FLOAT8 AS sort_expire
+        FROM admins a
+        LEFT JOIN chat_directory d ON d.id = a.user_id
+        WHERE %(owners)s
+        AND (%(expiring)s::INTEGER IS NULL
+             OR a.expire_date < NOW() + %(expiring)s * INTERVAL '1 day')
+
+        UNION ALL
+
+        SELECT 1, m.chat_id, g.name,
+               m.member_id, m.username, NULL,
+               g.updated_at IS NULL OR g.updated_at < NOW() - %(ttl)s * INTERVAL '1 second',
+               m.chat_id, 0
+        FROM team_members m
+        LEFT JOIN chat_directory g ON g.id = m.chat_id
+        WHERE %(operators)s
+        AND (%(chat_id)s::BIGINT IS NULL OR m.chat_id = %(chat_id)s)
+    ) r
+    WHERE (section, sort_chat, sort_expire, user_id) > %(after)s
+    ORDER BY section, sort_chat, sort_expire, user_id
+    LIMIT %(limit)s
+"""
+
+# 键集分页的起点，排在所有行之前
+USERS_REPORT_START = (-1, 0, 0.0, 0)
+
+
+def load_users_batch(cursor, params, after, limit):
+    cursor.execute(USERS_REPORT_SQL, dict(params, after=after, limit=limit))
+    return cursor.fetchall()
+
+
+async def users_report_batches(params, batch_size):
+    """
+    按 (部分, 群, 到期时间倒序, 用户) 键集分页读取。
+    每批读完就归还连接，发送文件期间不占用连接池。
+    """
+    after = USERS_REPORT_START
+    while True:
+        rows = await run(load_users_batch, params, after, batch_size)
+        if not rows:
+            return
+        yield [row[:7] for row in rows]
+        after = (rows[-1][0], rows[-1][7], rows[-1][8], rows[-1][3])
+
+
+def parse_users_args(args):
+    """/users [chat <群ID>] [expiring <天数>] [page <行数>]"""
+    options = {"chat_id": None, "expiring": None, "page": USERS_PAGE_LINES}
+    it = iter(args or [])
+    for key in it:
+        value = next(it, None)
+        if key == "chat":
+            options["chat_id"] = int(value)
+        elif key == "expiring":
+            options["expiring"] = int(value)
+        elif key == "page":
+            options["page"] = max(100, int(value))
+        else:
+            raise ValueError(key)
+    return options
+
+
 async def list_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await is_master(update):
         return
+    if not await postgres_only(update):
+        return
 
-    bot = context.bot
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    try:
+        options = parse_users_args(context.args)
+    except (TypeError, ValueError):
+        await update.message.reply_text(
+            "用法: /users [chat 群ID] [expiring 天数] [page 每个文件行数]"
+        )
+        return
 
+    bot = context.bot
     now = datetime.utcnow()
 
-    lines = []
-    lines.append("用户列表（按群）")
-    lines.append("━━━━━━━━━━━━━━━")
-
-    # ===== Owners =====
-    cursor.execute("SELECT user_id, expire_date FROM admins ORDER BY expire_date DESC")
-    owners = cursor.fetchall()
-
-    owners_info = []
-    for uid, exp in owners:
-        try:
-            user = await bot.get_chat(uid)
-            name = user.first_name or str(uid)
-        except:
-            name = str(uid)
-
-        if exp > now:
-            remain = exp - now
-            days = remain.days
-            hours = remain.seconds // 3600
-            status = f"🟢 剩余: {days}天 {hours}小时"
-        else:
-            status = "🔴 已过期"
-
-        owners_info.append((name, uid, status))
-
-    # ===== Operators 按群 =====
-    cursor.execute("""
-        SELECT chat_id, member_id, username
-        FROM team_members
-        ORDER BY chat_id
-    """)
-    rows = cursor.fetchall()
-
-    groups = {}
-    for chat_id, member_id, username in rows:
-        if chat_id not in groups:
-            groups[chat_id] = []
-        groups[chat_id].append((member_id, username))
-
-    # ===== 生成文本 =====
-    for chat_id, members in groups.items():
-        try:
-            chat = await bot.get_chat(chat_id)
-            group_name = chat.title or str(chat_id)
-        except:
-            group_name = "未知群"
-
-        lines.append(f"\n群: {group_name}")
-        lines.append(f"群ID: {chat_id}")
-
-        lines.append("Owners:")
-        if owners_info:
-            for name, uid, status in owners_info:
-                lines.append(f"  {name} ({uid}) | {status}")
-        else:
-            lines.append("  （无）")
-
-        lines.append("Operators:")
-        if members:
-            for mid, uname in members:
-                lines.append(f"  {uname} ({mid})")
-        else:
-            lines.append("  （无）")
-
-    cursor.close()
-    conn.close()
-
-    content = "\n".join(lines)
-
-    # ===== 写入临时文件 =====
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".txt", mode="w", encoding="utf-8") as f:
-        f.write(content)
-        file_path = f.name
-
-    # ===== 发送文件 =====
-    await update.message.reply_document(
-        document=open(file_path, "rb"),
-        filename="users.txt",
-        caption="📄 用户列表（按群）"
-    )
-
-    os.remove(file_path)
+    # 只给一个筛选条件时，只显示对应的部分
+    params = {
+        "ttl": DIRECTORY_TTL,
+        "owners": options["chat_id"] is None,
+        "operators": options["expiring"] is None,
+        "expiring": options["expiring"],
+        "chat_id": options["chat_id"],
+    }
+
+    buffer = io.BytesIO()
+    lines = 0
+    pages = 0
+    stale = set()
+
+    async def send_page():
+        nonlocal buffer, lines, pages
+        pages += 1
+        buffer.seek(0)
+        await update.message.reply_document(
+            document=buffer,
+            filename=f"users_{pages}.txt" if pages > 1 else "users.txt",
+            caption="📄 用户列表（按群）" if pages == 1 else f"📄 用户列表（续 {pages}）",
+            rate_limit_args={"priority": BULK},
+        )
+        buffer = io.BytesIO()
+        lines = 0
+
+    def write(line):
+        nonlocal lines
+        buffer.write(line.encode("utf-8") + b"\n")
+        lines += 1
+
+    write("用户列表（按群）")
+    write("━━━━━━━━━━━━━━━")
+
+    current_section = None
+    current_chat = None
+
+    async for rows in users_report_batches(params, options["page"]):
+        for section, chat_id, chat_name, uid, name, exp, is_stale in rows:
+            if is_stale:
+                stale.add(chat_id if section else uid)
+
+            # 满一页先发送，新文件重新写标题
+            if lines >= options["page"]:
+                await send_page()
+                current_section = None
+                current_chat = None
+
+            # ===== Owners =====
+            if section == 0:
+                if current_section != 0:
+                    write("Owners:")
+                    current_section = 0
+
+                exp = utc_naive(exp)
+                if exp > now:
+                    remain = exp - now
+                    days = remain.days
+                    hours = remain.seconds // 3600
+                    status = f"🟢 剩余: {days}天 {hours}小时"
+                else:
+                    status = "🔴 已过期"
+
+                write(f"  {name or uid} ({uid}) | {status}")
+
+            # ===== Operators 按群 =====
+            else:
+                if chat_id != current_chat:
+                    write(f"\n群: {chat_name or '未知群'}")
+                    write(f"群ID: {chat_id}")
+                    write("Operators:")
+                    current_chat = chat_id
+                    current_section = 1
+
+                write(f"  {name} ({uid})")
+
+    if current_section is None:
+        write("（无）")
+
+    # 名字缺失或过期的交给后台刷新
+    directory.refresh_in_background(bot, stale)
+
+    await send_page()
 
 # ==============================
 # Master 选择要清空的群（显示群名，不在群则显示 chat_id）
@@ -826,26 +1100,17 @@ async def clearall_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await is_master(update):
         return
 
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    cursor.execute("SELECT DISTINCT chat_id FROM history ORDER BY chat_id")
-    rows = cursor.fetchall()
-    cursor.close()
-    conn.close()
+    rows = await storage.history_chats()
 
     if not rows:
         await update.message.reply_text("📭 当前没有任何历史数据")
         return
 
     keyboard = []
+    directory.refresh_in_background(context.bot, rows)
 
-    for (chat_id,) in rows:
-        try:
-            chat = await context.bot.get_chat(chat_id)
-            title = chat.title if chat.title else str(chat_id)
-        except:
-            title = str(chat_id)
+    for chat_id in rows:
+        title = directory.name(chat_id)
 
         keyboard.append([
             InlineKeyboardButton(f"🗑️ {title}", callback_data=f"ask:{chat_id}")
@@ -874,24 +1139,16 @@ async def clearall_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     data = query.data
 
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
     # ❎ ยกเลิก
     if data == "cancel":
         await query.edit_message_text("❎ 已取消操作")
-        cursor.close(); conn.close()
         return
 
     # ====== ขอ CONFIRM สำหรับกลุ่มเดียว ======
     if data.startswith("ask:"):
         chat_id = data.split(":")[1]
 
-        try:
-            chat = await context.bot.get_chat(chat_id)
-            title = chat.title if chat.title else chat_id
-        except:
-            title = chat_id
+        title = directory.name(chat_id)
 
         keyboard = [
             [
@@ -904,7 +1161,6 @@ async def clearall_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"⚠️ 确认要清空该群的历史记录吗？\n\n{title}",
             reply_markup=InlineKeyboardMarkup(keyboard)
         )
-        cursor.close(); conn.close()
         return
 
     # ====== ขอ CONFIRM สำหรับ全部 ======
@@ -919,96 +1175,387 @@ async def clearall_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "⚠️ 确认要清空【所有群】的历史记录吗？",
             reply_markup=InlineKeyboardMarkup(keyboard)
         )
-        cursor.close(); conn.close()
         return
 
     # ====== ลบจริง (กลุ่มเดียว) ======
     if data.startswith("confirm:"):
         chat_id = data.split(":")[1]
-        cursor.execute("DELETE FROM history WHERE chat_id=%s", (chat_id,))
-        conn.commit()
+
+        await storage.clear_chat(int(chat_id))
+        ledger.invalidate(int(chat_id))
+        await shard.broadcast(SHARD_PEERS, SHARD_TOKEN, {"invalidate": int(chat_id)})
         await query.edit_message_text("🗑️ 已清空该群的历史记录")
-        cursor.close(); conn.close()
         return
 
     # ====== ลบจริง (ทั้งหมด) ======
     if data == "confirm_all":
-        cursor.execute("DELETE FROM history")
-        conn.commit()
+        await storage.clear_all()
+        ledger.invalidate()
+        await shard.broadcast(SHARD_PEERS, SHARD_TOKEN, {"invalidate": None})
         await query.edit_message_text("🔥 已清空【全部群】的历史记录")
-        cursor.close(); conn.close()
         return
 
 # ==============================
-# 启动
+# Master 核对合计表（与 history 重新计算对比）
 # ==============================
 
-if __name__ == "__main__":
-    init_db()
+def find_total_drift(cursor):
+    """
+    合计表与 history 重新计算的差异。轮次按 [开始, 开始 + 1 天) 计算；
+    改过时区 / 上班时间后新旧轮次互相重叠，各自的合计本来就不等于整天的 history，
+    这些轮次不比较也不重建。period_start 返回带时区的 UTC。
+    """
+    cursor.execute("""
+        WITH periods AS (
+            SELECT chat_id, period_start FROM history_period_totals
+            UNION
+            SELECT chat_id, period_start FROM history_period_marks
+        ),
+        checked AS (
+            SELECT p.chat_id, p.period_start
+            FROM periods p
+            WHERE NOT EXISTS (
+                SELECT 1 FROM periods q
+                WHERE q.chat_id = p.chat_id
+                AND q.period_start <> p.period_start
+                AND q.period_start > p.period_start - INTERVAL '1 day'
+                AND q.period_start < p.period_start + INTERVAL '1 day'
+            )
+        ),
+        actual AS (
+            SELECT t.chat_id, t.period_start, t.user_name, t.entry_count, t.total
+            FROM history_period_totals t
+            JOIN checked c ON c.chat_id = t.chat_id AND c.period_start = t.period_start
+        ),
+        expected AS (
+            SELECT c.chat_id, c.period_start,
+                   COALESCE(h.user_name,'') AS user_name,
+                   COUNT(*) AS entry_count, SUM(h.amount) AS total
+            FROM checked c
+            JOIN history h
+              ON h.chat_id = c.chat_id
+             AND h.timestamp >= c.period_start
+             AND h.timestamp < c.period_start + INTERVAL '1 day'
+            GROUP BY 1, 2, 3
+        )
+        SELECT COALESCE(t.chat_id, e.chat_id),
+               COALESCE(t.period_start, e.period_start) AT TIME ZONE 'UTC',
+               COALESCE(t.user_name, e.user_name),
+               COALESCE(t.entry_count, 0), COALESCE(e.entry_count, 0),
+               COALESCE(t.total, 0), COALESCE(e.total, 0)
+        FROM actual t
+        FULL JOIN expected e
+          ON e.chat_id = t.chat_id
+         AND e.period_start = t.period_start
+         AND e.user_name = t.user_name
+        WHERE COALESCE(t.entry_count, 0) <> COALESCE(e.entry_count, 0)
+           OR COALESCE(t.total, 0) <> COALESCE(e.total, 0)
+        ORDER BY 1, 2, 3
+    """)
+    return [(row[0], row[1].replace(tzinfo=timezone.utc)) + tuple(row[2:])
+            for row in cursor.fetchall()]
 
-    app = Application.builder().token(TOKEN).build()
 
-    # 中文命令处理
-    # ==============================
-    # 开始
-    app.add_handler(CommandHandler("start", start_bot))
-    # 状态
-    app.add_handler(CommandHandler("starts", starts_bot))
-    app.add_handler(MessageHandler(filters.Regex(r"^/开始$"), starts_bot))
+async def check_totals(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not await is_master(update):
+        return
+    if not await postgres_only(update):
+        return
 
-    # 帮助
-    app.add_handler(CommandHandler("help", help_menu))
-    app.add_handler(MessageHandler(filters.Regex(r"^/帮助$"), help_menu))
-    
-    # 检查
-    app.add_handler(CommandHandler("check", check_status))
-    app.add_handler(MessageHandler(filters.Regex(r"^/权限检查$"), check_status))
+    fix = bool(context.args) and context.args[0] == "fix"
+    drift = await run(find_total_drift)
 
-    # 账单
-    app.add_handler(CommandHandler("report", send_summary))
-    app.add_handler(MessageHandler(filters.Regex(r"^/目前账单$"), send_summary))
+    if not drift:
+        await update.message.reply_text("✅ 合计表与 history 一致")
+        return
 
-    # 全部
-    app.add_handler(CommandHandler("all", lambda u, c: send_summary(u, c, show_all=True)))
-    app.add_handler(MessageHandler(filters.Regex(r"^/全部账单$"), lambda u, c: send_summary(u, c, show_all=True)))
+    lines = [f"⚠️ 发现 {len(drift)} 处不一致:"]
+    for chat_id, period_start, name, count, real_count, total, real_total in drift[:30]:
+        lines.append(
+            f"{chat_id} {period_start.strftime('%Y-%m-%d %H:%M')} {name or '-'}: "
+            f"{count}笔/{total} → {real_count}笔/{real_total}"
+        )
+    if len(drift) > 30:
+        lines.append("...")
+
+    if fix:
+        for chat_id, start_utc in sorted({(d[0], d[1]) for d in drift}):
+            await storage.rebuild_period_totals(chat_id, start_utc, start_utc + timedelta(days=1))
+            ledger.invalidate(chat_id)
+            await shard.broadcast(SHARD_PEERS, SHARD_TOKEN, {"invalidate": chat_id})
+        lines.append("🔧 已按 history 重建")
+    else:
+        lines.append("使用 /checktotals fix 按 history 重建")
 
-    # 撤销
-    app.add_handler(CommandHandler("undo", undo_last))
-    app.add_handler(MessageHandler(filters.Regex(r"^/撤销$"), undo_last))
+    await update.message.reply_text("\n".join(lines))
 
-    # 重置
-    app.add_handler(CommandHandler("reset", reset_current))
-    app.add_handler(MessageHandler(filters.Regex(r"^/清空所有记录$"), reset_current))
 
-    # 添加操作者
-    app.add_handler(CommandHandler("add", add_member))
-    app.add_handler(MessageHandler(filters.Regex(r"^/添加$"), add_member))
+async def show_metrics(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not await is_master(update):
+        return
 
-    # 删除操作者
-    app.add_handler(CommandHandler("remove", remove_member))
-    app.add_handler(MessageHandler(filters.Regex(r"^/删除$"), remove_member))
+    await update.message.reply_text(metrics.summary())
 
-    # 设置时区
-    app.add_handler(CommandHandler("timezone", set_timezone))
-    app.add_handler(MessageHandler(filters.Regex(r"^/设置时区"), set_timezone))
 
-    # 设置工作时间
-    app.add_handler(CommandHandler("worktime", set_worktime))
-    app.add_handler(MessageHandler(filters.Regex(r"^/设置时间"), set_worktime))
+def render_trace():
+    lines = [
+        f"🔍 SQL 追踪: {'开启' if tracing.enabled else '关闭'} | 慢查询阈值 {tracing.slow_ms:.0f} ms",
+    ]
+    if tracing.armed():
+        lines.append("待采样 EXPLAIN: " + ", ".join(f"{h} x{n}" for h, n in tracing.armed().items()))
 
-    # 续费
-    app.add_handler(CommandHandler("renew", renew_owner))
-    app.add_handler(MessageHandler(filters.Regex(r"^/续费"), renew_owner))
-    
-    # 用户列表
-    app.add_handler(CommandHandler("users", list_users))
-    app.add_handler(MessageHandler(filters.Regex(r"^/用户列表$"), list_users))
+    lines.append("")
+    lines.append("总耗时最多的语句（次数 | 平均/最大 ms | 参数个数）:")
+    for (handler, text), (count, total, worst, nparams) in tracing.top(10):
+        lines.append(f"[{handler}] {count} | {total / count * 1000:.1f}/{worst * 1000:.1f} | {nparams}")
+        lines.append(f"  {text[:300]}")
+
+    if tracing.slow:
+        lines.append("")
+        lines.append("最近的慢查询:")
+        for ts, handler, ms, nparams, text in list(tracing.slow)[-10:]:
+            when = datetime.fromtimestamp(ts, timezone.utc).strftime("%m-%d %H:%M:%S")
+            lines.append(f"{when} [{handler}] {ms:.0f} ms | {nparams} 参数 | {text[:300]}")
 
-    # Master 清空菜单
-    app.add_handler(CommandHandler("clearall", clearall_menu))
-    app.add_handler(CallbackQueryHandler(clearall_callback))
+    for ts, handler, text, plan in tracing.plans:
+        lines.append("")
+        lines.append(f"EXPLAIN ANALYZE [{handler}] {text[:300]}")
+        lines.append(plan)
 
-    # 普通文本记账
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_msg))
+    return "\n".join(lines)
 
-    app.run_polling()
+
+async def trace_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/trace [on|off|slow <毫秒>|explain <handler> [次数]|reset]"""
+    if not await is_master(update):
+        return
+    if not await postgres_only(update):
+        return
+
+    args = context.args or []
+    action = args[0] if args else ""
+
+    try:
+        if action == "on":
+            tracing.enabled = True
+        elif action == "off":
+            tracing.enabled = False
+        elif action == "slow":
+            tracing.slow_ms = float(args[1])
+        elif action == "explain":
+            # 例如 /trace explain undo_last；send_summary 只有账单不在内存里时才会查库
+            tracing.explain(args[1], int(args[2]) if len(args) > 2 else 1)
+        elif action == "reset":
+            tracing.reset()
+        elif action:
+            raise ValueError(action)
+    except (IndexError, ValueError):
+        await update.message.reply_text(
+            "用法: /trace [on|off|slow 毫秒|explain handler名 [次数]|reset]\n"
+            "例如：/trace explain undo_last 3"
+        )
+        return
+
+    text = render_trace()
+    if len(text) <= 4000:
+        await update.message.reply_text(text)
+        return
+
+    await update.message.reply_document(
+        document=io.BytesIO(text.encode("utf-8")),
+        filename="trace.txt",
+        caption="🔍 SQL 追踪"
+    )
+
+# ==============================
+# 命令表
+# ==============================
+
+dispatcher = CommandDispatcher()
+
+# 开始
+dispatcher.command(["/start"], start_bot)
+# 状态
+dispatcher.command(["/starts", "/开始"], starts_bot)
+# 帮助
+dispatcher.command(["/help", "/帮助"], help_menu)
+# 检查
+dispatcher.command(["/check", "/权限检查"], check_status)
+# 账单
+dispatcher.command(["/report", "/目前账单"], send_summary)
+# 全部
+dispatcher.command(["/all", "/全部账单"], send_all)
+# 导出
+dispatcher.command(["/export", "/导出"], export_cmd)
+# 多日报表
+dispatcher.command(["/history", "/历史账单"], history_report)
+# 撤销
+dispatcher.command(["/undo", "/撤销"], undo_last)
+# 重置
+dispatcher.command(["/reset", "/清空所有记录"], reset_current)
+# 添加操作者
+dispatcher.command(["/add", "/添加"], add_member)
+# 删除操作者
+dispatcher.command(["/remove", "/删除"], remove_member)
+# 设置时区
+dispatcher.command(["/timezone", "/设置时区"], set_timezone)
+# 设置工作时间
+dispatcher.command(["/worktime", "/设置时间"], set_worktime)
+# 续费
+dispatcher.command(["/renew", "/续费"], renew_owner)
+# 用户列表
+dispatcher.command(["/users", "/用户列表"], list_users)
+# Master 清空菜单
+dispatcher.command(["/clearall"], clearall_menu)
+# Master 核对合计
+dispatcher.command(["/checktotals", "/核对合计"], check_totals)
+# Master 运行指标
+dispatcher.command(["/metrics", "/指标"], show_metrics)
+# Master SQL 追踪 / 慢查询 / EXPLAIN 采样
+dispatcher.command(["/trace", "/追踪"], trace_cmd)
+# 普通文本记账
+dispatcher.amount(handle_msg)
+
+# ==============================
+# 启动
+# ==============================
+
+async def history_maintenance():
+    """每天汇总已结束的工作日，建好后面几个月的分区，并按保留策略处理旧分区"""
+    while True:
+        try:
+            # 先汇总，再按保留策略删除旧的每轮合计
+            await run(rollup_closed_periods)
+            removed = await run(maintain_history_partitions,
+                                retention_months=HISTORY_RETENTION_MONTHS)
+            if removed:
+                logging.info("history 分区已按保留策略处理: %s", ", ".join(removed))
+        except Exception:
+            logging.exception("history 分区维护失败")
+        await asyncio.sleep(86400)
+
+
+def register_gauges(app):
+    limiter = app.bot.rate_limiter
+    metrics.register_gauge("tgbot_update_queue", "Updates waiting to be processed",
+                           app.update_queue.qsize)
+    metrics.register_gauge("tgbot_outbound_queued", "Bot API requests waiting for a global slot",
+                           lambda: limiter.stats()["queued"])
+    metrics.register_gauge("tgbot_outbound_group_waiting", "Bot API requests waiting for a group slot",
+                           lambda: limiter.stats()["group_waiting"])
+    metrics.register_gauge("tgbot_db_pool_in_use", "Pooled connections checked out",
+                           lambda: pool_stats()["in_use"])
+    metrics.register_gauge("tgbot_db_pool_idle", "Idle pooled connections",
+                           lambda: pool_stats()["idle"])
+    metrics.register_gauge("tgbot_summary_cache_hits", "Summaries served from the render cache",
+                           lambda: ledger.render_hits)
+    metrics.register_gauge("tgbot_summary_cache_misses", "Summaries rendered from the ledger",
+                           lambda: ledger.render_misses)
+    if history_writer is not None:
+        metrics.register_gauge("tgbot_write_queue", "History rows waiting for group commit",
+                               history_writer.queue.qsize)
+
+
+async def on_startup(app):
+    await storage.init()
+    await permissions.refresh()
+    await directory.load()
+    # 多进程时只有 Master worker 做分区维护
+    if storage.name == "postgres" and SHARD_INDEX == shard.MASTER_SHARD:
+        app.bot_data["maintenance"] = asyncio.create_task(history_maintenance())
+    if history_writer is not None:
+        history_writer.start()
+
+    register_gauges(app)
+    if METRICS_PORT:
+        app.bot_data["metrics_server"] = await metrics.serve(METRICS_HOST, METRICS_PORT)
+
+
+async def on_stop(app):
+    maintenance = app.bot_data.pop("maintenance", None)
+    if maintenance:
+        maintenance.cancel()
+    server = app.bot_data.pop("metrics_server", None)
+    if server:
+        server.close()
+        await server.wait_closed()
+    await summaries.close()
+
+
+async def on_shutdown(app):
+    if history_writer is not None:
+        await history_writer.stop()
+    await storage.close()
+
+
+def build_app():
+    builder = (
+        Application.builder()
+        .token(TOKEN)
+        .update_queue(asyncio.Queue(maxsize=UPDATE_QUEUE_SIZE))
+        .rate_limiter(OutboundLimiter(OUTBOUND_GLOBAL_PER_SEC, OUTBOUND_GROUP_PER_MIN))
+        .post_init(on_startup)
+        .post_stop(on_stop)
+        .post_shutdown(on_shutdown)
+    )
+    if CONCURRENT_UPDATES > 1:
+        builder = builder.concurrent_updates(ChatOrderedProcessor(CONCURRENT_UPDATES))
+    if SHARD_PORT:
+        builder = builder.updater(None)
+    if TELEGRAM_API_BASE:
+        builder = builder.base_url(f"{TELEGRAM_API_BASE}/bot").base_file_url(f"{TELEGRAM_API_BASE}/file/bot")
+    app = builder.build()
+
+    # 所有文本消息（含中文命令、记账）由 dispatcher 一次分类
+    app.add_handler(MessageHandler(filters.UpdateType.MESSAGE & filters.TEXT, dispatcher))
+    app.add_handler(CallbackQueryHandler(metrics.instrumented(all_page_callback), pattern=r"^page:"))
+    app.add_handler(CallbackQueryHandler(metrics.instrumented(clearall_callback),
+                                         pattern=r"^(ask|confirm|cancel)"))
+    return app
+
+
+async def shard_control(message):
+    """其他 worker 清空 / 重建合计 / 续费后的通知"""
+    if "invalidate" in message:
+        ledger.invalidate(message["invalidate"])
+    if message.get("permissions"):
+        await permissions.refresh()
+
+
+async def run_shard_worker(app):
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    await app.initialize()
+    await on_startup(app)
+    await app.start()
+    server = await shard.serve_worker(app, SHARD_HOST, SHARD_PORT, SHARD_TOKEN, shard_control)
+    logging.info("worker %d 已启动 %s:%d", SHARD_INDEX, SHARD_HOST, SHARD_PORT)
+    try:
+        await stop.wait()
+    finally:
+        server.close()
+        await server.wait_closed()
+        await app.stop()
+        await on_stop(app)
+        await on_shutdown(app)
+        await app.shutdown()
+
+
+if __name__ == "__main__":
+    app = build_app()
+
+    if SHARD_PORT:
+        asyncio.run(run_shard_worker(app))
+    elif WEBHOOK_URL:
+        app.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+        )
+    else:
+        app.run_polling()
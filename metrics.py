@@ -0,0 +1,273 @@
+"""
+进程内指标（只用标准库）：
+
+- 每个 handler 的延迟直方图
+- 每条更新花在数据库 / Bot API 上的时间，执行的 SQL 语句数、借用的连接数
+- 队列长度等瞬时值（register_gauge 注册取值函数）
+
+with track("handle_msg"): ... 期间的数据库 / API 调用都记到这条更新上
+（contextvars 会跟着 asyncio.to_thread 进入线程）。
+render() 输出 Prometheus 文本格式，serve() 在本地端口提供 GET /metrics。
+"""
+import time
+import asyncio
+import functools
+import contextvars
+from contextlib import contextmanager
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)     # 最后一格是 +Inf
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                break
+        else:
+            i = len(self.buckets)
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """按桶估算：返回包含第 q 分位的桶上限（超出最大桶返回 inf）"""
+        target = q * self.count
+        seen = 0
+        for bound, n in zip(self.buckets + (float("inf"),), self.counts):
+            seen += n
+            if seen >= target:
+                return bound
+        return float("inf")
+
+
+class UpdateStats:
+    __slots__ = ("handler", "db_seconds", "api_seconds", "statements", "connections")
+
+    def __init__(self, handler=None):
+        self.handler = handler
+        self.db_seconds = 0.0
+        self.api_seconds = 0.0
+        self.statements = 0
+        self.connections = 0
+
+
+class HandlerMetrics:
+    def __init__(self):
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.statements = Histogram(COUNT_BUCKETS)
+        self.connections = Histogram(COUNT_BUCKETS)
+        self.db_seconds = 0.0
+        self.api_seconds = 0.0
+        self.errors = 0
+
+
+_current = contextvars.ContextVar("update_stats", default=None)
+
+handlers = {}           # handler 名 -> HandlerMetrics
+api_calls = {}          # endpoint -> 次数
+totals = {
+    "db_seconds": 0.0,
+    "db_statements": 0,
+    "db_connections": 0,
+    "api_seconds": 0.0,
+}
+gauges = {}             # 指标名 -> (说明, 取值函数)
+
+
+# ==============================
+# 记录
+# ==============================
+
+@contextmanager
+def track(handler):
+    stats = UpdateStats(handler)
+    token = _current.set(stats)
+    t0 = time.perf_counter()
+    failed = False
+    try:
+        yield stats
+    except BaseException:
+        failed = True
+        raise
+    finally:
+        elapsed = time.perf_counter() - t0
+        _current.reset(token)
+
+        m = handlers.get(handler)
+        if m is None:
+            m = handlers[handler] = HandlerMetrics()
+        m.latency.observe(elapsed)
+        m.statements.observe(stats.statements)
+        m.connections.observe(stats.connections)
+        m.db_seconds += stats.db_seconds
+        m.api_seconds += stats.api_seconds
+        if failed:
+            m.errors += 1
+
+
+def instrumented(callback):
+    """给 PTB handler 回调加上 track(回调名)"""
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        with track(callback.__name__):
+            return await callback(update, context)
+
+    return wrapper
+
+
+def current_handler():
+    """当前更新所在的 handler 名（不在 track() 里时为 None）"""
+    stats = _current.get()
+    return stats.handler if stats is not None else None
+
+
+def record_db(seconds):
+    totals["db_seconds"] += seconds
+    stats = _current.get()
+    if stats is not None:
+        stats.db_seconds += seconds
+
+
+def record_statement():
+    totals["db_statements"] += 1
+    stats = _current.get()
+    if stats is not None:
+        stats.statements += 1
+
+
+def record_connection():
+    totals["db_connections"] += 1
+    stats = _current.get()
+    if stats is not None:
+        stats.connections += 1
+
+
+def record_api(endpoint, seconds):
+    totals["api_seconds"] += seconds
+    api_calls[endpoint] = api_calls.get(endpoint, 0) + 1
+    stats = _current.get()
+    if stats is not None:
+        stats.api_seconds += seconds
+
+
+def register_gauge(name, help_text, fn):
+    gauges[name] = (help_text, fn)
+
+
+# ==============================
+# 输出
+# ==============================
+
+def _histogram_lines(name, label, hist):
+    lines = []
+    cumulative = 0
+    for bound, n in zip(hist.buckets, hist.counts):
+        cumulative += n
+        lines.append(f'{name}_bucket{{{label},le="{bound}"}} {cumulative}')
+    lines.append(f'{name}_bucket{{{label},le="+Inf"}} {hist.count}')
+    lines.append(f"{name}_sum{{{label}}} {hist.sum}")
+    lines.append(f"{name}_count{{{label}}} {hist.count}")
+    return lines
+
+
+def render():
+    """Prometheus 文本格式"""
+    out = []
+
+    for name, attr, help_text in (
+        ("tgbot_handler_seconds", "latency", "Handler latency"),
+        ("tgbot_update_db_statements", "statements", "SQL statements per update"),
+        ("tgbot_update_db_connections", "connections", "Pooled connections borrowed per update"),
+    ):
+        out.append(f"# HELP {name} {help_text}")
+        out.append(f"# TYPE {name} histogram")
+        for handler, m in sorted(handlers.items()):
+            out.extend(_histogram_lines(name, f'handler="{handler}"', getattr(m, attr)))
+
+    for name, attr, help_text in (
+        ("tgbot_handler_db_seconds_total", "db_seconds", "Time spent in the database per handler"),
+        ("tgbot_handler_api_seconds_total", "api_seconds", "Time spent in Bot API calls per handler"),
+        ("tgbot_handler_errors_total", "errors", "Handler calls that raised"),
+    ):
+        out.append(f"# HELP {name} {help_text}")
+        out.append(f"# TYPE {name} counter")
+        for handler, m in sorted(handlers.items()):
+            out.append(f'{name}{{handler="{handler}"}} {getattr(m, attr)}')
+
+    for key, value in totals.items():
+        out.append(f"# TYPE tgbot_{key}_total counter")
+        out.append(f"tgbot_{key}_total {value}")
+
+    out.append("# TYPE tgbot_api_calls_total counter")
+    for endpoint, n in sorted(api_calls.items()):
+        out.append(f'tgbot_api_calls_total{{endpoint="{endpoint}"}} {n}')
+
+    for name, (help_text, fn) in sorted(gauges.items()):
+        out.append(f"# HELP {name} {help_text}")
+        out.append(f"# TYPE {name} gauge")
+        out.append(f"{name} {fn()}")
+
+    return "\n".join(out) + "\n"
+
+
+def summary():
+    """给 /metrics 命令看的简短文本"""
+    def ms(seconds):
+        return "inf" if seconds == float("inf") else f"{seconds * 1000:.0f}"
+
+    lines = ["📊 Handler（次数 | p50/p95/p99 ms ≤ | DB/API ms 平均 | SQL/连接 平均）"]
+    for handler, m in sorted(handlers.items(), key=lambda x: x[1].latency.sum, reverse=True):
+        n = m.latency.count or 1
+        lines.append(
+            f"{handler}: {m.latency.count} | "
+            f"{ms(m.latency.quantile(0.5))}/{ms(m.latency.quantile(0.95))}/{ms(m.latency.quantile(0.99))} | "
+            f"{m.db_seconds / n * 1000:.1f}/{m.api_seconds / n * 1000:.1f} | "
+            f"{m.statements.sum / n:.1f}/{m.connections.sum / n:.1f}"
+            + (f" | ❌{m.errors}" if m.errors else "")
+        )
+
+    lines.append("")
+    lines.append(
+        f"DB: {totals['db_seconds']:.1f}s, {totals['db_statements']} 条语句, "
+        f"{totals['db_connections']} 次借用连接"
+    )
+    lines.append(f"API: {totals['api_seconds']:.1f}s, {sum(api_calls.values())} 次调用")
+    for name, (_, fn) in sorted(gauges.items()):
+        lines.append(f"{name}: {fn()}")
+    return "\n".join(lines)
+
+
+async def serve(host, port):
+    """本地 HTTP：GET /metrics 返回 render()"""
+    async def handle(reader, writer):
+        try:
+            request_line = await reader.readline()
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+
+            parts = request_line.decode(errors="replace").split()
+            if len(parts) >= 2 and parts[1].split("?")[0] == "/metrics":
+                status, body = "200 OK", render().encode()
+            else:
+                status, body = "404 Not Found", b"not found\n"
+
+            writer.write(
+                f"HTTP/1.1 {status}\r\n"
+                "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                "Connection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
@@ -0,0 +1,61 @@
+"""
+数据库结构迁移（与机器人进程分开运行）
+
+  python migrate.py status              当前版本和待执行的迁移
+  python migrate.py up                  执行全部待执行的迁移
+  python migrate.py up --to 4           只迁移到第 4 版
+  python migrate.py up --online         耗时的步骤（旧 history 搬运、daily_rollup 补数据）
+                                        分批执行，每批一个事务，机器人可以继续运行
+
+部署多个 worker 时建议设置 DB_AUTO_MIGRATE=0，先运行本脚本再滚动重启。
+"""
+import sys
+import logging
+import argparse
+
+import database
+
+
+def status(conn):
+    cursor = conn.cursor()
+    current = database.schema_version(cursor)
+    conn.rollback()
+
+    print(f"当前版本: {current} / 最新版本: {database.LATEST_VERSION}")
+    for version, name, _, online_step in database.MIGRATIONS:
+        if version > current:
+            print(f"  待执行 {version} {name}" + ("（可 --online 分批执行）" if online_step else ""))
+    return current
+
+
+def main():
+    parser = argparse.ArgumentParser(description="数据库结构迁移")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("status")
+    p = sub.add_parser("up")
+    p.add_argument("--to", type=int, default=None, help="迁移到指定版本")
+    p.add_argument("--online", action="store_true", help="耗时步骤分批执行")
+    p.add_argument("--batch-size", type=int, default=10000)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+
+    conn = database.get_db_connection()
+    try:
+        current = status(conn)
+        if args.command == "status":
+            return 0 if current >= database.LATEST_VERSION else 1
+
+        applied = database.migrate(conn, target=args.to, online=args.online,
+                                   batch_size=args.batch_size)
+        if not applied:
+            print("已是最新，无需迁移")
+        for version, name, elapsed in applied:
+            print(f"  完成 {version} {name}（{elapsed:.1f}s）")
+        return 0
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
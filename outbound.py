@@ -0,0 +1,201 @@
+import time
+import heapq
+import asyncio
+import logging
+import itertools
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# 优先级：数字越小越先发
+INTERACTIVE = 0
+BULK = 1
+
+# 不需要限速的接口（拉取更新 / 启动设置）
+UNLIMITED = {"getUpdates", "getMe", "setWebhook", "deleteWebhook", "getWebhookInfo",
+             "close", "logOut"}
+# 只占全局额度、不算进群发送频率的接口
+GLOBAL_ONLY = {"getChat", "answerCallbackQuery"}
+
+
+class TokenBucket:
+    def __init__(self, rate, per):
+        self.capacity = rate
+        self.tokens = float(rate)
+        self.fill_rate = rate / per
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.fill_rate)
+        self.updated = now
+
+    def delay(self):
+        """还要等多少秒才有 1 个 token"""
+        self._refill()
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.fill_rate
+
+    def reserve(self):
+        """预订 1 个 token（可以透支），返回需要等待的秒数"""
+        self._refill()
+        self.tokens -= 1
+        return 0 if self.tokens >= 0 else -self.tokens / self.fill_rate
+
+    def take(self):
+        self._refill()
+        self.tokens -= 1
+
+    def full(self):
+        """已经回满：和新建的 bucket 没有区别，可以丢掉"""
+        self._refill()
+        return self.tokens >= self.capacity
+
+
+# ==============================
+# 发送调度（所有 Bot API 请求都经过这里）
+# ==============================
+
+class OutboundLimiter(BaseRateLimiter):
+    """
+    Bot API 出站限速：
+
+    - 全局 token bucket（默认 30/秒），按优先级排队，交互回复优先于批量请求
+      （批量请求传 rate_limit_args={"priority": BULK}）
+    - 每个群一个 token bucket（默认 20/分钟）
+    - 收到 RetryAfter 暂停对应的群（或全局）后自动重试
+    - 已经回满的群 bucket 和过期的暂停记录定期清理，不活跃的群不占内存
+    """
+
+    def __init__(self, global_per_sec=30, group_per_min=20, max_retries=3):
+        self.global_bucket = TokenBucket(global_per_sec, 1)
+        self.group_per_min = group_per_min
+        self.max_retries = max_retries
+        self.group_buckets = {}
+        self.queue = []                 # (priority, seq, future)
+        self.seq = itertools.count()
+        self.wake = None
+        self.dispatcher = None
+        self.paused_until = 0.0
+        self.group_paused_until = {}
+        self.prune_at = 1000
+        self.group_waiting = 0
+        self.sent = 0
+        self.retries = 0
+
+    async def initialize(self):
+        # Bot 和 Application 都可能调用 initialize，已经在运行时不再启动第二个调度任务
+        if self.dispatcher and not self.dispatcher.done():
+            return
+        self.wake = asyncio.Event()
+        self.dispatcher = asyncio.create_task(self._dispatch())
+
+    async def shutdown(self):
+        if self.dispatcher:
+            self.dispatcher.cancel()
+            try:
+                await self.dispatcher
+            except asyncio.CancelledError:
+                pass
+            self.dispatcher = None
+
+    def stats(self):
+        return {
+            "queued": len(self.queue),
+            "group_waiting": self.group_waiting,
+            "sent": self.sent,
+            "retries": self.retries,
+        }
+
+    async def _dispatch(self):
+        while True:
+            while not self.queue:
+                self.wake.clear()
+                await self.wake.wait()
+
+            wait = max(self.global_bucket.delay(), self.paused_until - time.monotonic())
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+
+            _, _, future = heapq.heappop(self.queue)
+            if future.done():
+                continue
+            self.global_bucket.take()
+            future.set_result(None)
+
+    async def _global_slot(self, priority):
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.queue, (priority, next(self.seq), future))
+        self.wake.set()
+        try:
+            await future
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+
+    def _prune_groups(self):
+        now = time.monotonic()
+        for chat_id in [c for c, b in self.group_buckets.items() if b.full()]:
+            del self.group_buckets[chat_id]
+        for chat_id in [c for c, until in self.group_paused_until.items() if until <= now]:
+            del self.group_paused_until[chat_id]
+        self.prune_at = max(1000, len(self.group_buckets) * 2)
+
+    async def _group_slot(self, chat_id):
+        bucket = self.group_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.group_buckets) >= self.prune_at:
+                self._prune_groups()
+            bucket = self.group_buckets[chat_id] = TokenBucket(self.group_per_min, 60)
+
+        wait = max(bucket.reserve(),
+                   self.group_paused_until.get(chat_id, 0) - time.monotonic())
+        if wait > 0:
+            self.group_waiting += 1
+            try:
+                await asyncio.sleep(wait)
+            finally:
+                self.group_waiting -= 1
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        if endpoint in UNLIMITED:
+            return await callback(*args, **kwargs)
+
+        priority = (rate_limit_args or {}).get("priority", INTERACTIVE)
+        chat_id = data.get("chat_id")
+        group = (
+            endpoint not in GLOBAL_ONLY
+            and chat_id is not None
+            and str(chat_id).startswith("-")
+        )
+
+        for attempt in range(self.max_retries + 1):
+            if group:
+                await self._group_slot(chat_id)
+            await self._global_slot(priority)
+
+            t0 = time.perf_counter()
+            try:
+                result = await callback(*args, **kwargs)
+                self.sent += 1
+                return result
+            except RetryAfter as e:
+                if attempt >= self.max_retries:
+                    raise
+                self.retries += 1
+                retry_after = e.retry_after
+                if not isinstance(retry_after, (int, float)):
+                    retry_after = retry_after.total_seconds()
+                until = time.monotonic() + retry_after
+                logger.warning("%s 触发限流，%ss 后重试 chat=%s", endpoint, retry_after, chat_id)
+                if group:
+                    self.group_paused_until[chat_id] = until
+                else:
+                    self.paused_until = until
+                    self.wake.set()
+            finally:
+                metrics.record_api(endpoint, time.perf_counter() - t0)
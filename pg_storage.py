@@ -0,0 +1,420 @@
+import json
+import asyncio
+from decimal import Decimal
+from datetime import datetime, timedelta
+
+from psycopg2.extras import execute_values
+
+from database import init_db, close_pool, run, rollup_period
+from cache import utc_naive, utc_aware
+from ledger import RECENT_KEEP
+from storage import Storage
+
+
+# ==============================
+# 设置
+# ==============================
+
+def ensure_chat_settings(cursor, chat_id):
+    cursor.execute("""
+        INSERT INTO chat_settings (chat_id) VALUES (%s)
+        ON CONFLICT (chat_id) DO NOTHING
+    """, (chat_id,))
+
+
+def load_chat_settings(cursor, chat_id):
+    ensure_chat_settings(cursor, chat_id)
+    cursor.execute("SELECT timezone, work_start FROM chat_settings WHERE chat_id=%s",
+                   (chat_id,))
+    return cursor.fetchone()
+
+
+def set_timezone(cursor, chat_id, tz):
+    cursor.execute("""
+        INSERT INTO chat_settings (chat_id, timezone)
+        VALUES (%s,%s)
+        ON CONFLICT (chat_id)
+        DO UPDATE SET timezone=%s
+        RETURNING timezone, work_start
+    """, (chat_id, tz, tz))
+    return cursor.fetchone()
+
+
+def set_worktime(cursor, chat_id, work_start):
+    cursor.execute("""
+        INSERT INTO chat_settings (chat_id, work_start)
+        VALUES (%s,%s)
+        ON CONFLICT (chat_id)
+        DO UPDATE SET work_start=%s
+        RETURNING timezone, work_start
+    """, (chat_id, work_start, work_start))
+    return cursor.fetchone()
+
+# ==============================
+# 本轮合计
+# ==============================
+
+def load_recent_rows(cursor, chat_id, start_utc, end_utc):
+    cursor.execute("""
+        SELECT id, amount, user_name, timestamp
+        FROM history
+        WHERE chat_id=%s
+        AND timestamp BETWEEN %s AND %s
+        ORDER BY timestamp DESC, id DESC
+        LIMIT %s
+    """, (chat_id, start_utc, end_utc, RECENT_KEEP))
+    return cursor.fetchall()
+
+
+def add_period_total(cursor, chat_id, start_utc, user_name, count, amount):
+    cursor.execute("""
+        INSERT INTO history_period_totals
+            (chat_id, period_start, user_name, entry_count, total)
+        VALUES (%s,%s,COALESCE(%s,''),%s,%s)
+        ON CONFLICT (chat_id, period_start, user_name)
+        DO UPDATE SET
+            entry_count = history_period_totals.entry_count + EXCLUDED.entry_count,
+            total = history_period_totals.total + EXCLUDED.total
+    """, (chat_id, start_utc, user_name, count, amount))
+
+    if count < 0:
+        cursor.execute("""
+            DELETE FROM history_period_totals
+            WHERE chat_id=%s AND period_start=%s
+            AND user_name=COALESCE(%s,'') AND entry_count <= 0
+        """, (chat_id, start_utc, user_name))
+
+
+def rebuild_period_totals(cursor, chat_id, start_utc, end_utc):
+    cursor.execute("""
+        INSERT INTO history_period_marks (chat_id, period_start) VALUES (%s,%s)
+        ON CONFLICT DO NOTHING
+    """, (chat_id, start_utc))
+    cursor.execute("""
+        DELETE FROM history_period_totals
+        WHERE chat_id=%s AND period_start=%s
+    """, (chat_id, start_utc))
+    cursor.execute("""
+        INSERT INTO history_period_totals
+            (chat_id, period_start, user_name, entry_count, total)
+        SELECT %s, %s, COALESCE(user_name,''), COUNT(*), SUM(amount)
+        FROM history
+        WHERE chat_id=%s
+        AND timestamp >= %s AND timestamp < %s
+        GROUP BY COALESCE(user_name,'')
+        RETURNING user_name, entry_count, total
+    """, (chat_id, start_utc, chat_id, start_utc, end_utc))
+    people = cursor.fetchall()
+    # 已经汇总过的轮次（/checktotals fix）同步更新 daily_rollup
+    rollup_period(cursor, chat_id, start_utc)
+    return people
+
+
+def load_period_aggregate(cursor, chat_id, start_utc, end_utc):
+    # 没有物化标记的轮次先按 history 重建一次
+    cursor.execute("SELECT materialize_period(%s,%s,%s)", (chat_id, start_utc, end_utc))
+    cursor.execute("""
+        SELECT user_name, entry_count, total
+        FROM history_period_totals
+        WHERE chat_id=%s AND period_start=%s
+    """, (chat_id, start_utc))
+    people = cursor.fetchall()
+
+    return people, load_recent_rows(cursor, chat_id, start_utc, end_utc)
+
+
+def load_page(cursor, chat_id, start_utc, end_utc, direction, after, size):
+    """keyset 分页：按 (timestamp, id) 取 after 之后（n）或之前（p）的 size 条"""
+    if direction == "n":
+        cursor.execute("""
+            SELECT id, amount, user_name, timestamp
+            FROM history
+            WHERE chat_id=%s
+            AND timestamp BETWEEN %s AND %s
+            AND (timestamp, id) > (%s, %s)
+            ORDER BY timestamp ASC, id ASC
+            LIMIT %s
+        """, (chat_id, start_utc, end_utc, after[0], after[1], size + 1))
+        rows = cursor.fetchall()
+        return rows[:size], len(rows) > size
+
+    cursor.execute("""
+        SELECT id, amount, user_name, timestamp
+        FROM history
+        WHERE chat_id=%s
+        AND timestamp BETWEEN %s AND %s
+        AND (timestamp, id) < (%s, %s)
+        ORDER BY timestamp DESC, id DESC
+        LIMIT %s
+    """, (chat_id, start_utc, end_utc, after[0], after[1], size))
+    return list(reversed(cursor.fetchall())), True
+
+# ==============================
+# 记账 / 撤销 / 重置
+# ==============================
+
+def insert_history_batch(cursor, entries):
+    """entries: (chat_id, start_utc, user_name, amount, timestamp)，一条语句写完"""
+    periods = {(chat_id, start_utc) for chat_id, start_utc, _, _, _ in entries}
+    execute_values(
+        cursor,
+        "SELECT materialize_period(c, s, s + INTERVAL '1 day') FROM (VALUES %s) v(c, s)",
+        list(periods),
+        template="(%s::BIGINT, %s::TIMESTAMPTZ)",
+        page_size=len(periods),
+    )
+
+    # 先取好 id 再按位置分给每一条：多行 INSERT ... RETURNING 不保证按 VALUES 的顺序返回
+    cursor.execute("SELECT nextval('history_id_seq') FROM generate_series(1, %s)", (len(entries),))
+    ids = sorted(r[0] for r in cursor.fetchall())
+
+    returned = execute_values(
+        cursor,
+        "INSERT INTO history (id, chat_id, amount, user_name, timestamp) VALUES %s "
+        "RETURNING id, timestamp",
+        [(row_id, chat_id, amount, user_name, ts)
+         for row_id, (chat_id, _, user_name, amount, ts) in zip(ids, entries)],
+        page_size=len(entries),
+        fetch=True,
+    )
+    timestamps = dict(returned)
+
+    totals = {}
+    for chat_id, start_utc, user_name, amount, _ in entries:
+        t = totals.setdefault((chat_id, start_utc, user_name or ""), [0, Decimal("0")])
+        t[0] += 1
+        t[1] += amount
+
+    execute_values(cursor, """
+        INSERT INTO history_period_totals
+            (chat_id, period_start, user_name, entry_count, total)
+        VALUES %s
+        ON CONFLICT (chat_id, period_start, user_name)
+        DO UPDATE SET
+            entry_count = history_period_totals.entry_count + EXCLUDED.entry_count,
+            total = history_period_totals.total + EXCLUDED.total
+    """, [(*key, count, total) for key, (count, total) in totals.items()],
+        page_size=len(totals))
+
+    return [(row_id, timestamps[row_id]) for row_id in ids]
+
+
+def record_entry(cursor, *args):
+    # 一次往返：权限检查 + 写入 + 合计 + 最近几条
+    cursor.execute("SELECT record_entry(%s,%s,%s,%s,%s,%s,%s,%s)", args)
+    row = cursor.fetchone()
+    if row[0] is None:
+        return None
+
+    result = json.loads(row[0], parse_float=Decimal)
+    people = [(name, count, Decimal(total)) for name, count, total in result["people"]]
+    recent = [
+        (r[0], Decimal(r[1]), r[2], datetime.fromisoformat(r[3]))
+        for r in result["recent"]
+    ]
+    return people, recent
+
+
+def undo_last(cursor, chat_id, start_utc, end_utc):
+    cursor.execute("""
+        SELECT id, amount, user_name, timestamp FROM history
+        WHERE chat_id=%s
+        AND timestamp BETWEEN %s AND %s
+        ORDER BY timestamp DESC, id DESC LIMIT 1
+    """, (chat_id, start_utc, end_utc))
+    row = cursor.fetchone()
+    if row:
+        # 带上 timestamp 只扫描一个分区
+        cursor.execute("DELETE FROM history WHERE id=%s AND timestamp=%s", (row[0], row[3]))
+        add_period_total(cursor, chat_id, start_utc, row[2], -1, -row[1])
+        rollup_period(cursor, chat_id, start_utc)
+    return row
+
+
+def reset_period(cursor, chat_id, start_utc, end_utc):
+    cursor.execute("""
+        DELETE FROM history
+        WHERE chat_id=%s
+        AND timestamp BETWEEN %s AND %s
+    """, (chat_id, start_utc, end_utc))
+    cursor.execute("""
+        DELETE FROM history_period_totals
+        WHERE chat_id=%s AND period_start=%s
+    """, (chat_id, start_utc))
+    rollup_period(cursor, chat_id, start_utc)
+
+# ==============================
+# 操作者 / Owner
+# ==============================
+
+def load_permissions(cursor):
+    cursor.execute("SELECT user_id, expire_date FROM admins")
+    owners = cursor.fetchall()
+    cursor.execute("SELECT member_id, chat_id FROM team_members")
+    members = cursor.fetchall()
+    return owners, members
+
+
+def find_member(cursor, chat_id, username):
+    cursor.execute("""
+        SELECT member_id, username
+        FROM team_members
+        WHERE chat_id=%s AND username=%s
+    """, (chat_id, username))
+    return cursor.fetchone()
+
+
+def add_member(cursor, member_id, chat_id, username):
+    cursor.execute("""
+        INSERT INTO team_members (member_id, chat_id, username)
+        VALUES (%s,%s,%s)
+        ON CONFLICT (member_id, chat_id)
+        DO UPDATE SET username=%s
+    """, (member_id, chat_id, username, username))
+
+
+def remove_member(cursor, member_id, chat_id):
+    cursor.execute("""
+        DELETE FROM team_members
+        WHERE member_id=%s AND chat_id=%s
+    """, (member_id, chat_id))
+
+
+def extend_owner(cursor, user_id, days):
+    cursor.execute("SELECT expire_date FROM admins WHERE user_id=%s FOR UPDATE",
+                   (user_id,))
+    row = cursor.fetchone()
+    expire = utc_naive(row[0]) if row else None
+
+    now = datetime.utcnow()
+    if expire and expire > now:
+        new_expire = expire + timedelta(days=days)
+    else:
+        new_expire = now + timedelta(days=days)
+
+    cursor.execute("""
+        INSERT INTO admins (user_id, expire_date)
+        VALUES (%s,%s)
+        ON CONFLICT (user_id)
+        DO UPDATE SET expire_date=%s
+    """, (user_id, new_expire, new_expire))
+    return new_expire
+
+# ==============================
+# 群名目录 / 清空
+# ==============================
+
+def load_directory(cursor):
+    cursor.execute("SELECT id, name, updated_at FROM chat_directory")
+    return cursor.fetchall()
+
+
+def save_directory(cursor, entries):
+    execute_values(cursor, """
+        INSERT INTO chat_directory (id, name, updated_at)
+        VALUES %s
+        ON CONFLICT (id)
+        DO UPDATE SET name=COALESCE(EXCLUDED.name, chat_directory.name),
+                      updated_at=EXCLUDED.updated_at
+    """, entries)
+
+
+def history_chats(cursor):
+    cursor.execute("SELECT DISTINCT chat_id FROM history ORDER BY chat_id")
+    return [chat_id for (chat_id,) in cursor.fetchall()]
+
+
+def clear_chat(cursor, chat_id):
+    cursor.execute("DELETE FROM history WHERE chat_id=%s", (chat_id,))
+    cursor.execute("DELETE FROM history_period_totals WHERE chat_id=%s", (chat_id,))
+    cursor.execute("DELETE FROM history_period_marks WHERE chat_id=%s", (chat_id,))
+    cursor.execute("DELETE FROM daily_rollup WHERE chat_id=%s", (chat_id,))
+
+
+def clear_all(cursor):
+    # 分区表 TRUNCATE 只改元数据，不逐行删除
+    cursor.execute("TRUNCATE history, history_period_totals, history_period_marks, daily_rollup")
+
+
+class PostgresStorage(Storage):
+    """
+    database.py 连接池上的实现，每个方法一个事务。
+    调用方传入的 naive UTC 时间在这里转成带时区的 UTC 再绑定，
+    否则 Postgres 会按会话的 TimeZone 解释，轮次的 period_start 就对不上。
+    """
+
+    name = "postgres"
+
+    async def init(self):
+        await asyncio.to_thread(init_db)
+
+    async def close(self):
+        await asyncio.to_thread(close_pool)
+
+    async def load_chat_settings(self, chat_id):
+        return await run(load_chat_settings, chat_id)
+
+    async def set_timezone(self, chat_id, tz):
+        return await run(set_timezone, chat_id, tz)
+
+    async def set_worktime(self, chat_id, work_start):
+        return await run(set_worktime, chat_id, work_start)
+
+    async def record_entry(self, chat_id, user_id, is_master, user_name, amount,
+                           start_utc, end_utc, recent):
+        return await run(record_entry, chat_id, user_id, is_master, user_name, amount,
+                         utc_aware(start_utc), utc_aware(end_utc), recent)
+
+    async def insert_history_batch(self, entries):
+        entries = [(chat_id, utc_aware(start_utc), user_name, amount, utc_aware(ts))
+                   for chat_id, start_utc, user_name, amount, ts in entries]
+        return await run(insert_history_batch, entries)
+
+    async def undo_last(self, chat_id, start_utc, end_utc):
+        return await run(undo_last, chat_id, utc_aware(start_utc), utc_aware(end_utc))
+
+    async def reset_period(self, chat_id, start_utc, end_utc):
+        await run(reset_period, chat_id, utc_aware(start_utc), utc_aware(end_utc))
+
+    async def load_period(self, chat_id, start_utc, end_utc):
+        return await run(load_period_aggregate, chat_id, utc_aware(start_utc), utc_aware(end_utc))
+
+    async def load_recent(self, chat_id, start_utc, end_utc):
+        return await run(load_recent_rows, chat_id, utc_aware(start_utc), utc_aware(end_utc))
+
+    async def rebuild_period_totals(self, chat_id, start_utc, end_utc):
+        return await run(rebuild_period_totals, chat_id, utc_aware(start_utc), utc_aware(end_utc))
+
+    async def load_page(self, chat_id, start_utc, end_utc, direction, after, size):
+        return await run(load_page, chat_id, utc_aware(start_utc), utc_aware(end_utc),
+                         direction, (utc_aware(after[0]), after[1]), size)
+
+    async def load_permissions(self):
+        return await run(load_permissions)
+
+    async def find_member(self, chat_id, username):
+        return await run(find_member, chat_id, username)
+
+    async def add_member(self, member_id, chat_id, username):
+        await run(add_member, member_id, chat_id, username)
+
+    async def remove_member(self, member_id, chat_id):
+        await run(remove_member, member_id, chat_id)
+
+    async def extend_owner(self, user_id, days):
+        return await run(extend_owner, user_id, days)
+
+    async def load_directory(self):
+        return await run(load_directory)
+
+    async def save_directory(self, entries):
+        await run(save_directory, [(i, name, utc_aware(at)) for i, name, at in entries])
+
+    async def history_chats(self):
+        return await run(history_chats)
+
+    async def clear_chat(self, chat_id):
+        await run(clear_chat, chat_id)
+
+    async def clear_all(self):
+        await run(clear_all)
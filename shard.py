@@ -0,0 +1,181 @@
+import hmac
+import json
+import asyncio
+import bisect
+import hashlib
+import logging
+
+import httpx
+from telegram import Update
+
+logger = logging.getLogger(__name__)
+
+# Master 专用命令（以及 /clearall 的按钮）都交给这个 worker：
+# 报表、追踪、指标只看一个进程，清空 / 续费后再通知其他 worker
+MASTER_SHARD = 0
+
+MASTER_COMMANDS = {
+    "renew", "续费", "users", "用户列表", "clearall",
+    "checktotals", "核对合计", "metrics", "指标", "trace", "追踪",
+}
+MASTER_CALLBACKS = ("ask", "confirm", "cancel")
+
+# 每个 worker 在环上的虚拟节点数
+RING_REPLICAS = 64
+
+# ingress / 其他 worker 调用 worker 时带上的共享口令
+TOKEN_HEADER = "X-Shard-Token"
+
+
+# ==============================
+# 一致性哈希
+# ==============================
+
+def _hash(key):
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+
+class ShardRing:
+    """
+    chat_id -> worker 下标。worker 数从 N 变成 N+1 时只有约 1/(N+1) 的群换 worker，
+    其余群的内存缓存（本轮合计、渲染好的账单）继续有效。
+    """
+
+    def __init__(self, workers, replicas=RING_REPLICAS):
+        self.workers = workers
+        points = sorted((_hash(f"worker-{i}#{r}"), i)
+                        for i in range(workers) for r in range(replicas))
+        self.keys = [k for k, _ in points]
+        self.owners = [i for _, i in points]
+
+    def worker_for(self, chat_id):
+        i = bisect.bisect(self.keys, _hash(str(chat_id))) % len(self.keys)
+        return self.owners[i]
+
+
+def update_chat_id(update):
+    """原始 Update JSON 里的群 id；没有群（inline 等）时返回 None"""
+    query = update.get("callback_query")
+    if query is not None:
+        return (query.get("message") or {}).get("chat", {}).get("id")
+
+    for key in ("message", "edited_message", "channel_post", "edited_channel_post",
+                "my_chat_member", "chat_member", "chat_join_request"):
+        if key in update:
+            return update[key].get("chat", {}).get("id")
+    return None
+
+
+def is_master_update(update):
+    query = update.get("callback_query")
+    if query is not None:
+        return (query.get("data") or "").startswith(MASTER_CALLBACKS)
+
+    text = (update.get("message") or {}).get("text") or ""
+    if not text.startswith("/"):
+        return False
+    parts = text[1:].split()
+    return bool(parts) and parts[0].partition("@")[0] in MASTER_COMMANDS
+
+
+def route(ring, update):
+    """同一个群总是同一个 worker（保持顺序），Master 命令给 MASTER_SHARD"""
+    if is_master_update(update):
+        return MASTER_SHARD
+    chat_id = update_chat_id(update)
+    if chat_id is None:
+        return MASTER_SHARD
+    return ring.worker_for(chat_id)
+
+# ==============================
+# 本地 HTTP（ingress <-> worker）
+# ==============================
+
+async def read_request(reader):
+    """返回 (method, path, headers, body)；连接关闭时返回 None"""
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    method, path, _ = request_line.decode().split(" ", 2)
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        key, value = line.decode().split(":", 1)
+        headers[key.strip().lower()] = value.strip()
+
+    body = await reader.readexactly(int(headers.get("content-length", 0)))
+    return method, path.split("?")[0], headers, body
+
+
+def write_response(writer, status, body=b""):
+    writer.write(
+        f"HTTP/1.1 {status}\r\n"
+        "Content-Type: text/plain; charset=utf-8\r\n"
+        f"Content-Length: {len(body)}\r\n\r\n".encode() + body
+    )
+
+
+def token_matches(headers, token):
+    return hmac.compare_digest(headers.get(TOKEN_HEADER.lower(), "").encode(), token.encode())
+
+
+async def serve_worker(app, host, port, token, control):
+    """
+    worker 端（两个接口都要求 TOKEN_HEADER 等于 token）：
+      POST /update   body 为 Update JSON 列表，按顺序放进 app.update_queue
+      POST /control  其他 worker 的缓存失效通知，交给 control(message)
+    """
+    async def handle(reader, writer):
+        try:
+            while True:
+                request = await read_request(reader)
+                if request is None:
+                    break
+                method, path, headers, body = request
+
+                if method != "POST" or path not in ("/update", "/control"):
+                    write_response(writer, "404 Not Found", b"not found\n")
+                elif not token_matches(headers, token):
+                    write_response(writer, "403 Forbidden", b"forbidden\n")
+                else:
+                    try:
+                        payload = json.loads(body or (b"[]" if path == "/update" else b"{}"))
+                    except ValueError:
+                        payload = None
+
+                    if payload is None:
+                        write_response(writer, "400 Bad Request", b"bad request\n")
+                    elif path == "/update":
+                        for data in payload:
+                            # 队列满时在这里等待，ingress 的转发随之变慢
+                            await app.update_queue.put(Update.de_json(data, app.bot))
+                        write_response(writer, "200 OK")
+                    else:
+                        await control(payload)
+                        write_response(writer, "200 OK")
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
+
+
+async def broadcast(peers, token, message):
+    """通知所有 worker（包括自己）让本地缓存失效；单进程部署时 peers 为空"""
+    if not peers:
+        return
+
+    async with httpx.AsyncClient(timeout=10, headers={TOKEN_HEADER: token}) as client:
+        async def send(url):
+            try:
+                response = await client.post(f"{url}/control", json=message)
+                response.raise_for_status()
+            except httpx.HTTPError:
+                logger.exception("通知 worker 失败 %s", url)
+
+        await asyncio.gather(*(send(url) for url in peers))
@@ -0,0 +1,469 @@
+import time
+import sqlite3
+import asyncio
+import threading
+from decimal import Decimal
+from datetime import datetime, timedelta, timezone, time as dtime
+
+import metrics
+from cache import utc_naive
+from ledger import RECENT_KEEP
+from storage import Storage
+
+# 结构版本记在 PRAGMA user_version
+SCHEMA_VERSION = 2
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS chat_settings (
+    chat_id INTEGER PRIMARY KEY,
+    timezone INTEGER NOT NULL DEFAULT 0,
+    work_start TEXT NOT NULL DEFAULT '00:00'
+);
+
+-- amount / total 以“分”为单位存整数，SUM 不会有浮点误差
+CREATE TABLE IF NOT EXISTS history (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    chat_id INTEGER NOT NULL,
+    amount INTEGER NOT NULL,
+    user_name TEXT,
+    timestamp TEXT NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_history_chat_time ON history(chat_id, timestamp, id);
+
+CREATE TABLE IF NOT EXISTS history_period_totals (
+    chat_id INTEGER NOT NULL,
+    period_start TEXT NOT NULL,
+    user_name TEXT NOT NULL DEFAULT '',
+    entry_count INTEGER NOT NULL DEFAULT 0,
+    total INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (chat_id, period_start, user_name)
+);
+
+-- 合计已经按 history 物化的轮次（2 版新增）；没有标记的轮次第一次读 / 写时重建
+CREATE TABLE IF NOT EXISTS history_period_marks (
+    chat_id INTEGER NOT NULL,
+    period_start TEXT NOT NULL,
+    PRIMARY KEY (chat_id, period_start)
+);
+
+CREATE TABLE IF NOT EXISTS team_members (
+    member_id INTEGER,
+    chat_id INTEGER,
+    username TEXT,
+    PRIMARY KEY (member_id, chat_id)
+);
+
+CREATE TABLE IF NOT EXISTS admins (
+    user_id INTEGER PRIMARY KEY,
+    expire_date TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS chat_directory (
+    id INTEGER PRIMARY KEY,
+    name TEXT,
+    updated_at TEXT NOT NULL
+);
+"""
+
+# 定长 UTC 文本，按字符串排序 = 按时间排序
+TS_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+
+
+def to_text(dt):
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return dt.strftime(TS_FORMAT)
+
+
+def from_text(text):
+    return datetime.strptime(text, TS_FORMAT).replace(tzinfo=timezone.utc)
+
+
+def to_cents(amount):
+    return int((Decimal(amount) * 100).to_integral_value())
+
+
+def from_cents(cents):
+    return Decimal(cents).scaleb(-2)
+
+
+def history_row(r):
+    return r[0], from_cents(r[1]), r[2], from_text(r[3])
+
+
+def people_row(r):
+    return r[0], r[1], from_cents(r[2])
+
+# ==============================
+# 设置
+# ==============================
+
+def load_chat_settings(conn, chat_id):
+    conn.execute("INSERT OR IGNORE INTO chat_settings (chat_id) VALUES (?)", (chat_id,))
+    tz, work_start = conn.execute(
+        "SELECT timezone, work_start FROM chat_settings WHERE chat_id=?", (chat_id,)
+    ).fetchone()
+    return tz, dtime.fromisoformat(work_start)
+
+
+def set_timezone(conn, chat_id, tz):
+    conn.execute("""
+        INSERT INTO chat_settings (chat_id, timezone) VALUES (?,?)
+        ON CONFLICT (chat_id) DO UPDATE SET timezone=excluded.timezone
+    """, (chat_id, tz))
+    return load_chat_settings(conn, chat_id)
+
+
+def set_worktime(conn, chat_id, work_start):
+    work_start = dtime.fromisoformat(work_start).strftime("%H:%M")
+    conn.execute("""
+        INSERT INTO chat_settings (chat_id, work_start) VALUES (?,?)
+        ON CONFLICT (chat_id) DO UPDATE SET work_start=excluded.work_start
+    """, (chat_id, work_start))
+    return load_chat_settings(conn, chat_id)
+
+# ==============================
+# 本轮合计
+# ==============================
+
+def load_recent_rows(conn, chat_id, start_utc, end_utc, limit=RECENT_KEEP):
+    rows = conn.execute("""
+        SELECT id, amount, user_name, timestamp
+        FROM history
+        WHERE chat_id=?
+        AND timestamp BETWEEN ? AND ?
+        ORDER BY timestamp DESC, id DESC
+        LIMIT ?
+    """, (chat_id, to_text(start_utc), to_text(end_utc), limit)).fetchall()
+    return [history_row(r) for r in rows]
+
+
+def add_period_total(conn, chat_id, start_utc, user_name, count, cents):
+    conn.execute("""
+        INSERT INTO history_period_totals (chat_id, period_start, user_name, entry_count, total)
+        VALUES (?,?,COALESCE(?,''),?,?)
+        ON CONFLICT (chat_id, period_start, user_name) DO UPDATE SET
+            entry_count = entry_count + excluded.entry_count,
+            total = total + excluded.total
+    """, (chat_id, to_text(start_utc), user_name, count, cents))
+
+    if count < 0:
+        conn.execute("""
+            DELETE FROM history_period_totals
+            WHERE chat_id=? AND period_start=?
+            AND user_name=COALESCE(?,'') AND entry_count <= 0
+        """, (chat_id, to_text(start_utc), user_name))
+
+
+def period_people(conn, chat_id, start_utc):
+    rows = conn.execute("""
+        SELECT user_name, entry_count, total
+        FROM history_period_totals
+        WHERE chat_id=? AND period_start=?
+    """, (chat_id, to_text(start_utc))).fetchall()
+    return [people_row(r) for r in rows]
+
+
+def rebuild_period_totals(conn, chat_id, start_utc, end_utc):
+    conn.execute("INSERT OR IGNORE INTO history_period_marks (chat_id, period_start) VALUES (?,?)",
+                 (chat_id, to_text(start_utc)))
+    conn.execute("DELETE FROM history_period_totals WHERE chat_id=? AND period_start=?",
+                 (chat_id, to_text(start_utc)))
+    conn.execute("""
+        INSERT INTO history_period_totals (chat_id, period_start, user_name, entry_count, total)
+        SELECT ?, ?, COALESCE(user_name,''), COUNT(*), SUM(amount)
+        FROM history
+        WHERE chat_id=?
+        AND timestamp >= ? AND timestamp < ?
+        GROUP BY COALESCE(user_name,'')
+    """, (chat_id, to_text(start_utc), chat_id, to_text(start_utc), to_text(end_utc)))
+    return period_people(conn, chat_id, start_utc)
+
+
+def materialize_period(conn, chat_id, start_utc, end_utc):
+    """没有物化标记的轮次按 history 重建一次（与 Postgres 的 materialize_period 相同）"""
+    cursor = conn.execute(
+        "INSERT OR IGNORE INTO history_period_marks (chat_id, period_start) VALUES (?,?)",
+        (chat_id, to_text(start_utc))
+    )
+    if cursor.rowcount == 1:
+        rebuild_period_totals(conn, chat_id, start_utc, end_utc)
+
+
+def load_period_aggregate(conn, chat_id, start_utc, end_utc):
+    materialize_period(conn, chat_id, start_utc, end_utc)
+    return period_people(conn, chat_id, start_utc), load_recent_rows(conn, chat_id, start_utc, end_utc)
+
+
+def load_page(conn, chat_id, start_utc, end_utc, direction, after, size):
+    bounds = (chat_id, to_text(start_utc), to_text(end_utc), to_text(after[0]), after[1])
+    if direction == "n":
+        rows = conn.execute("""
+            SELECT id, amount, user_name, timestamp
+            FROM history
+            WHERE chat_id=?
+            AND timestamp BETWEEN ? AND ?
+            AND (timestamp, id) > (?, ?)
+            ORDER BY timestamp ASC, id ASC
+            LIMIT ?
+        """, bounds + (size + 1,)).fetchall()
+        return [history_row(r) for r in rows[:size]], len(rows) > size
+
+    rows = conn.execute("""
+        SELECT id, amount, user_name, timestamp
+        FROM history
+        WHERE chat_id=?
+        AND timestamp BETWEEN ? AND ?
+        AND (timestamp, id) < (?, ?)
+        ORDER BY timestamp DESC, id DESC
+        LIMIT ?
+    """, bounds + (size,)).fetchall()
+    return [history_row(r) for r in reversed(rows)], True
+
+# ==============================
+# 记账 / 撤销 / 重置
+# ==============================
+
+def insert_history(conn, chat_id, start_utc, user_name, amount, ts):
+    materialize_period(conn, chat_id, start_utc, start_utc + timedelta(days=1))
+    cents = to_cents(amount)
+    cursor = conn.execute(
+        "INSERT INTO history (chat_id, amount, user_name, timestamp) VALUES (?,?,?,?)",
+        (chat_id, cents, user_name, to_text(ts))
+    )
+    add_period_total(conn, chat_id, start_utc, user_name, 1, cents)
+    return cursor.lastrowid, from_text(to_text(ts))
+
+
+def insert_history_batch(conn, entries):
+    return [insert_history(conn, *entry) for entry in entries]
+
+
+def record_entry(conn, chat_id, user_id, is_master, user_name, amount,
+                 start_utc, end_utc, recent):
+    if not is_master:
+        allowed = conn.execute("""
+            SELECT EXISTS (SELECT 1 FROM admins WHERE user_id=? AND expire_date > ?)
+                OR EXISTS (SELECT 1 FROM team_members WHERE member_id=? AND chat_id=?)
+        """, (user_id, to_text(datetime.now(timezone.utc)), user_id, chat_id)).fetchone()[0]
+        if not allowed:
+            return None
+
+    insert_history(conn, chat_id, start_utc, user_name, amount, datetime.now(timezone.utc))
+    return (period_people(conn, chat_id, start_utc),
+            load_recent_rows(conn, chat_id, start_utc, end_utc, recent))
+
+
+def undo_last(conn, chat_id, start_utc, end_utc):
+    rows = load_recent_rows(conn, chat_id, start_utc, end_utc, 1)
+    if not rows:
+        return None
+
+    row = rows[0]
+    conn.execute("DELETE FROM history WHERE id=?", (row[0],))
+    add_period_total(conn, chat_id, start_utc, row[2], -1, -to_cents(row[1]))
+    return row
+
+
+def reset_period(conn, chat_id, start_utc, end_utc):
+    conn.execute("DELETE FROM history WHERE chat_id=? AND timestamp BETWEEN ? AND ?",
+                 (chat_id, to_text(start_utc), to_text(end_utc)))
+    conn.execute("DELETE FROM history_period_totals WHERE chat_id=? AND period_start=?",
+                 (chat_id, to_text(start_utc)))
+
+# ==============================
+# 操作者 / Owner
+# ==============================
+
+def load_permissions(conn):
+    owners = [(user_id, from_text(expire))
+              for user_id, expire in conn.execute("SELECT user_id, expire_date FROM admins")]
+    members = conn.execute("SELECT member_id, chat_id FROM team_members").fetchall()
+    return owners, members
+
+
+def find_member(conn, chat_id, username):
+    return conn.execute(
+        "SELECT member_id, username FROM team_members WHERE chat_id=? AND username=?",
+        (chat_id, username)
+    ).fetchone()
+
+
+def add_member(conn, member_id, chat_id, username):
+    conn.execute("""
+        INSERT INTO team_members (member_id, chat_id, username) VALUES (?,?,?)
+        ON CONFLICT (member_id, chat_id) DO UPDATE SET username=excluded.username
+    """, (member_id, chat_id, username))
+
+
+def remove_member(conn, member_id, chat_id):
+    conn.execute("DELETE FROM team_members WHERE member_id=? AND chat_id=?",
+                 (member_id, chat_id))
+
+
+def extend_owner(conn, user_id, days):
+    row = conn.execute("SELECT expire_date FROM admins WHERE user_id=?", (user_id,)).fetchone()
+    expire = utc_naive(from_text(row[0])) if row else None
+
+    now = datetime.utcnow()
+    if expire and expire > now:
+        new_expire = expire + timedelta(days=days)
+    else:
+        new_expire = now + timedelta(days=days)
+
+    conn.execute("""
+        INSERT INTO admins (user_id, expire_date) VALUES (?,?)
+        ON CONFLICT (user_id) DO UPDATE SET expire_date=excluded.expire_date
+    """, (user_id, to_text(new_expire)))
+    return new_expire
+
+# ==============================
+# 群名目录 / 清空
+# ==============================
+
+def load_directory(conn):
+    return [(id, name, from_text(updated_at)) for id, name, updated_at in
+            conn.execute("SELECT id, name, updated_at FROM chat_directory")]
+
+
+def save_directory(conn, entries):
+    conn.executemany("""
+        INSERT INTO chat_directory (id, name, updated_at) VALUES (?,?,?)
+        ON CONFLICT (id) DO UPDATE SET name=COALESCE(excluded.name, chat_directory.name),
+                                       updated_at=excluded.updated_at
+    """, [(id, name, to_text(updated_at)) for id, name, updated_at in entries])
+
+
+def history_chats(conn):
+    return [chat_id for (chat_id,) in
+            conn.execute("SELECT DISTINCT chat_id FROM history ORDER BY chat_id")]
+
+
+def clear_chat(conn, chat_id):
+    conn.execute("DELETE FROM history WHERE chat_id=?", (chat_id,))
+    conn.execute("DELETE FROM history_period_totals WHERE chat_id=?", (chat_id,))
+    conn.execute("DELETE FROM history_period_marks WHERE chat_id=?", (chat_id,))
+
+
+def clear_all(conn):
+    conn.execute("DELETE FROM history")
+    conn.execute("DELETE FROM history_period_totals")
+    conn.execute("DELETE FROM history_period_marks")
+
+
+class SqliteStorage(Storage):
+    """
+    内嵌 SQLite（WAL 模式）。一个连接 + 锁，每个方法在线程里以
+    BEGIN IMMEDIATE 事务执行；同一进程内的写入天然串行，不需要数据库服务器。
+    """
+
+    name = "sqlite"
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = None
+        self.lock = threading.Lock()
+
+    def _open(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=5000")
+
+        if conn.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+            conn.executescript(SCHEMA)
+            conn.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+        return conn
+
+    def _transaction(self, fn, *args):
+        t0 = time.perf_counter()
+        try:
+            with self.lock:
+                self.conn.execute("BEGIN IMMEDIATE")
+                try:
+                    result = fn(self.conn, *args)
+                except BaseException:
+                    self.conn.execute("ROLLBACK")
+                    raise
+                self.conn.execute("COMMIT")
+                return result
+        finally:
+            metrics.record_db(time.perf_counter() - t0)
+
+    async def _run(self, fn, *args):
+        return await asyncio.to_thread(self._transaction, fn, *args)
+
+    async def init(self):
+        if self.conn is None:
+            self.conn = await asyncio.to_thread(self._open)
+
+    async def close(self):
+        if self.conn is not None:
+            conn, self.conn = self.conn, None
+            await asyncio.to_thread(conn.close)
+
+    async def load_chat_settings(self, chat_id):
+        return await self._run(load_chat_settings, chat_id)
+
+    async def set_timezone(self, chat_id, tz):
+        return await self._run(set_timezone, chat_id, tz)
+
+    async def set_worktime(self, chat_id, work_start):
+        return await self._run(set_worktime, chat_id, work_start)
+
+    async def record_entry(self, chat_id, user_id, is_master, user_name, amount,
+                           start_utc, end_utc, recent):
+        return await self._run(record_entry, chat_id, user_id, is_master, user_name, amount,
+                               start_utc, end_utc, recent)
+
+    async def insert_history_batch(self, entries):
+        return await self._run(insert_history_batch, entries)
+
+    async def undo_last(self, chat_id, start_utc, end_utc):
+        return await self._run(undo_last, chat_id, start_utc, end_utc)
+
+    async def reset_period(self, chat_id, start_utc, end_utc):
+        await self._run(reset_period, chat_id, start_utc, end_utc)
+
+    async def load_period(self, chat_id, start_utc, end_utc):
+        return await self._run(load_period_aggregate, chat_id, start_utc, end_utc)
+
+    async def load_recent(self, chat_id, start_utc, end_utc):
+        return await self._run(load_recent_rows, chat_id, start_utc, end_utc)
+
+    async def rebuild_period_totals(self, chat_id, start_utc, end_utc):
+        return await self._run(rebuild_period_totals, chat_id, start_utc, end_utc)
+
+    async def load_page(self, chat_id, start_utc, end_utc, direction, after, size):
+        return await self._run(load_page, chat_id, start_utc, end_utc, direction, after, size)
+
+    async def load_permissions(self):
+        return await self._run(load_permissions)
+
+    async def find_member(self, chat_id, username):
+        return await self._run(find_member, chat_id, username)
+
+    async def add_member(self, member_id, chat_id, username):
+        await self._run(add_member, member_id, chat_id, username)
+
+    async def remove_member(self, member_id, chat_id):
+        await self._run(remove_member, member_id, chat_id)
+
+    async def extend_owner(self, user_id, days):
+        return await self._run(extend_owner, user_id, days)
+
+    async def load_directory(self):
+        return await self._run(load_directory)
+
+    async def save_directory(self, entries):
+        await self._run(save_directory, entries)
+
+    async def history_chats(self):
+        return await self._run(history_chats)
+
+    async def clear_chat(self, chat_id):
+        await self._run(clear_chat, chat_id)
+
+    async def clear_all(self):
+        await self._run(clear_all)
@@ -0,0 +1,142 @@
+"""
+存储接口：handler 实际用到的读写操作。
+
+- 设置：load_chat_settings / set_timezone / set_worktime
+- 记账：record_entry / insert_history_batch / undo_last / reset_period
+- 本轮查询：load_period / load_recent / rebuild_period_totals / load_page
+- 操作者 / Owner：load_permissions / find_member / add_member / remove_member / extend_owner
+- 群名目录：load_directory / save_directory
+- 清空：history_chats / clear_chat / clear_all
+
+所有方法都是 async。时间一律是 UTC（传入可以是 naive UTC，返回带时区），
+金额用 Decimal。两个实现用 tests/test_storage_conformance.py 检查行为一致。
+
+STORAGE_BACKEND=postgres（默认，pg_storage.py）或 sqlite（sqlite_storage.py，WAL 模式，
+单机部署不需要数据库服务器）。/users /export /history /checktotals 等报表和
+history 分区维护直接使用 Postgres，只在 postgres 后端可用。
+"""
+from abc import ABC, abstractmethod
+
+
+class Storage(ABC):
+    """缺少任何一个方法的后端在创建时就报错（TypeError），而不是在处理请求的中途"""
+
+    name = None
+
+    @abstractmethod
+    async def init(self):
+        """建表 / 检查结构版本"""
+
+    @abstractmethod
+    async def close(self):
+        ...
+
+    # ===== 设置 =====
+
+    @abstractmethod
+    async def load_chat_settings(self, chat_id):
+        """返回 (timezone, work_start)；没有设置时写入默认值"""
+
+    @abstractmethod
+    async def set_timezone(self, chat_id, tz):
+        """返回新的 (timezone, work_start)"""
+
+    @abstractmethod
+    async def set_worktime(self, chat_id, work_start):
+        """work_start: "HH:MM"；返回新的 (timezone, work_start)"""
+
+    # ===== 记账 =====
+
+    @abstractmethod
+    async def record_entry(self, chat_id, user_id, is_master, user_name, amount,
+                           start_utc, end_utc, recent):
+        """
+        权限检查 + 写入 + 更新本轮合计。没有权限返回 None，
+        否则返回 (people, rows)：本轮 [(user_name, count, total)] 和最近 recent 条
+        """
+
+    @abstractmethod
+    async def insert_history_batch(self, entries):
+        """entries: [(chat_id, start_utc, user_name, amount, timestamp)]，按 entries 的顺序返回 [(id, timestamp)]"""
+
+    @abstractmethod
+    async def undo_last(self, chat_id, start_utc, end_utc):
+        """删除本轮最后一条，返回 (id, amount, user_name, timestamp) 或 None"""
+
+    @abstractmethod
+    async def reset_period(self, chat_id, start_utc, end_utc):
+        ...
+
+    # ===== 本轮查询 =====
+
+    @abstractmethod
+    async def load_period(self, chat_id, start_utc, end_utc):
+        """返回 (people, rows)：本轮合计 和 最近 RECENT_KEEP 条（新的在前）"""
+
+    @abstractmethod
+    async def load_recent(self, chat_id, start_utc, end_utc):
+        ...
+
+    @abstractmethod
+    async def rebuild_period_totals(self, chat_id, start_utc, end_utc):
+        """按 history 重建本轮合计，返回 [(user_name, count, total)]"""
+
+    @abstractmethod
+    async def load_page(self, chat_id, start_utc, end_utc, direction, after, size):
+        """keyset 分页：(timestamp, id) 在 after 之后（"n"）或之前（"p"）的 size 条，返回 (rows, 是否还有下一页)"""
+
+    # ===== 操作者 / Owner =====
+
+    @abstractmethod
+    async def load_permissions(self):
+        """返回 (owners [(user_id, expire)], members [(member_id, chat_id)])"""
+
+    @abstractmethod
+    async def find_member(self, chat_id, username):
+        """返回 (member_id, username) 或 None"""
+
+    @abstractmethod
+    async def add_member(self, member_id, chat_id, username):
+        ...
+
+    @abstractmethod
+    async def remove_member(self, member_id, chat_id):
+        ...
+
+    @abstractmethod
+    async def extend_owner(self, user_id, days):
+        """未过期时在原到期时间上延长，否则从现在开始；返回新的到期时间（naive UTC）"""
+
+    # ===== 群名目录 =====
+
+    @abstractmethod
+    async def load_directory(self):
+        """返回 [(id, name, updated_at)]"""
+
+    @abstractmethod
+    async def save_directory(self, entries):
+        """entries: [(id, name, updated_at)]，name 为 None 时保留原名"""
+
+    # ===== 清空 =====
+
+    @abstractmethod
+    async def history_chats(self):
+        """有记录的群 id（升序）"""
+
+    @abstractmethod
+    async def clear_chat(self, chat_id):
+        ...
+
+    @abstractmethod
+    async def clear_all(self):
+        ...
+
+
+def open_storage(backend, sqlite_path=None):
+    if backend == "postgres":
+        from pg_storage import PostgresStorage
+        return PostgresStorage()
+    if backend == "sqlite":
+        from sqlite_storage import SqliteStorage
+        return SqliteStorage(sqlite_path)
+    raise ValueError(f"unknown STORAGE_BACKEND: {backend}")
@@ -0,0 +1,10 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+# main.py 在导入时读取配置；测试不连接数据库，也不访问 Telegram
+os.environ.setdefault("TOKEN", "123:test")
+os.environ.setdefault("MASTER_ID", "1")
+os.environ.setdefault("STORAGE_BACKEND", "sqlite")
+os.environ.setdefault("SQLITE_PATH", ":memory:")
@@ -0,0 +1,106 @@
+import asyncio
+from datetime import datetime, time, timedelta, timezone
+
+from cache import PermissionCache, compute_work_period, utc_aware, utc_naive
+
+NOW = datetime(2024, 5, 1, 12, 0)
+WORK_START = time(12, 0)
+
+
+def loaded(owners=(), members=()):
+    cache = PermissionCache(loader=None)
+    cache.load(owners, members)
+    return cache
+
+
+def test_owner_expires_at_expire_date():
+    cache = loaded(owners=[(1, NOW)])
+    assert cache.is_owner(1, now=NOW - timedelta(seconds=1))
+    assert not cache.is_owner(1, now=NOW)
+    assert not cache.is_owner(1, now=NOW + timedelta(seconds=1))
+    assert not cache.is_owner(2, now=NOW)
+
+
+def test_aware_expire_is_stored_as_naive_utc():
+    cache = loaded(owners=[(1, datetime(2024, 5, 1, 20, 0, tzinfo=timezone(timedelta(hours=8))))])
+    assert cache.owner_expire(1) == NOW
+
+
+def test_members():
+    cache = loaded(members=[(5, -100)])
+    assert cache.is_operator(5, -100)
+    assert not cache.is_operator(5, -200)
+    cache.remove_member(5, -100)
+    assert not cache.is_operator(5, -100)
+
+
+def test_refresh_started_before_write_keeps_write():
+    async def go():
+        release = asyncio.Event()
+
+        async def loader():
+            await release.wait()
+            return [(1, NOW)], [(5, -100)]      # 写入之前读到的快照
+
+        cache = PermissionCache(loader)
+        cache.load([(1, NOW)], [(5, -100)])
+
+        refresh = asyncio.create_task(cache.refresh())
+        await asyncio.sleep(0)
+        cache.set_owner(1, NOW + timedelta(days=30))
+        cache.remove_member(5, -100)
+        release.set()
+        await refresh
+        return cache
+
+    cache = asyncio.run(go())
+    assert cache.owner_expire(1) == NOW + timedelta(days=30)
+    assert not cache.is_operator(5, -100)
+
+
+def test_refresh_without_writes_replaces_snapshot():
+    async def loader():
+        return [(2, NOW)], []
+
+    cache = loaded(owners=[(1, NOW)])
+    cache.loader = loader
+    asyncio.run(cache.refresh())
+    assert cache.owner_expire(1) is None
+    assert cache.owner_expire(2) == NOW
+
+
+def test_before_worktime_belongs_to_previous_day():
+    # UTC+8 当地 2024-05-02 11:59
+    now = datetime(2024, 5, 2, 3, 59)
+    start, end, tz = compute_work_period(8, WORK_START, now)
+    assert start == datetime(2024, 5, 1, 4, 0)
+    assert end == start + timedelta(days=1)
+    assert tz == 8
+
+
+def test_at_worktime_starts_new_period():
+    # UTC+8 当地 2024-05-02 12:00
+    start, end, _ = compute_work_period(8, WORK_START, datetime(2024, 5, 2, 4, 0))
+    assert start == datetime(2024, 5, 2, 4, 0)
+    assert end == datetime(2024, 5, 3, 4, 0)
+
+
+def test_negative_timezone_crosses_utc_date():
+    # UTC-5 当地 2024-05-01 23:30，UTC 已经是 5 月 2 日
+    start, _, _ = compute_work_period(-5, WORK_START, datetime(2024, 5, 2, 4, 30))
+    assert start == datetime(2024, 5, 1, 17, 0)
+
+
+def test_midnight_worktime():
+    start, _, _ = compute_work_period(0, time(0, 0), datetime(2024, 5, 2, 0, 0))
+    assert start == datetime(2024, 5, 2, 0, 0)
+    start, _, _ = compute_work_period(0, time(0, 0), datetime(2024, 5, 1, 23, 59, 59))
+    assert start == datetime(2024, 5, 1, 0, 0)
+
+
+def test_utc_aware():
+    aware = utc_aware(NOW)
+    assert aware.tzinfo is timezone.utc and utc_naive(aware) == NOW
+    local = datetime(2024, 5, 1, 20, 0, tzinfo=timezone(timedelta(hours=8)))
+    assert utc_aware(local) is local
+    assert utc_aware(None) is None
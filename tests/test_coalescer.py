@@ -0,0 +1,114 @@
+import asyncio
+from types import SimpleNamespace
+
+import coalescer
+from coalescer import SummaryCoalescer
+
+
+class FakeBot:
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.calls = []
+        self.next_id = 100
+
+    async def send_message(self, chat_id, text, parse_mode=None):
+        await asyncio.sleep(self.delay)
+        self.next_id += 1
+        self.calls.append(("send", chat_id, self.next_id, text))
+        return SimpleNamespace(message_id=self.next_id)
+
+    async def edit_message_text(self, text, chat_id, message_id, parse_mode=None):
+        await asyncio.sleep(self.delay)
+        self.calls.append(("edit", chat_id, message_id, text))
+
+
+def counter():
+    n = [0]
+
+    async def render():
+        n[0] += 1
+        return f"v{n[0]}"
+    return render
+
+
+def test_debounce_merges_requests():
+    async def go():
+        bot, summaries, render = FakeBot(), SummaryCoalescer(debounce_ms=20), counter()
+        for _ in range(5):
+            await summaries.request(bot, 1, render)
+        await asyncio.sleep(0.1)
+        return bot.calls, summaries
+
+    calls, summaries = asyncio.run(go())
+    assert calls == [("send", 1, 101, "v1")]
+    assert (summaries.requested, summaries.published) == (5, 1)
+    assert summaries.timers == {} and summaries.renders == {} and summaries.locks == {}
+
+
+def test_edit_within_window_then_new_message(monkeypatch):
+    now = [1000.0]
+    # 只替换 coalescer 看到的时钟，事件循环仍用真实时间
+    monkeypatch.setattr(coalescer, "time", SimpleNamespace(monotonic=lambda: now[0]))
+
+    async def go():
+        bot, render = FakeBot(), counter()
+        summaries = SummaryCoalescer(debounce_ms=10, edit_window=60)
+        for advance in (0, 30, 61):
+            now[0] += advance
+            await summaries.request(bot, 1, render)
+            await asyncio.sleep(0.05)
+        return bot.calls
+
+    assert asyncio.run(go()) == [
+        ("send", 1, 101, "v1"),
+        ("edit", 1, 101, "v2"),
+        ("send", 1, 102, "v3"),     # 距离第一条发出已超过 60 秒
+    ]
+
+
+def test_request_during_send_edits_that_message():
+    async def go():
+        bot, render = FakeBot(delay=0.05), counter()
+        summaries = SummaryCoalescer(debounce_ms=10)
+        await summaries.request(bot, 1, render)
+        await asyncio.sleep(0.03)                   # 第一条正在发送
+        await summaries.request(bot, 1, render)
+        await asyncio.sleep(0.2)
+        return bot.calls
+
+    assert asyncio.run(go()) == [("send", 1, 101, "v1"), ("edit", 1, 101, "v2")]
+
+
+def test_close_waits_for_send_in_flight():
+    async def go():
+        bot, render = FakeBot(delay=0.05), counter()
+        summaries = SummaryCoalescer(debounce_ms=10)
+        await summaries.request(bot, 1, render)
+        await summaries.request(bot, 2, render)
+        await asyncio.sleep(0.03)                   # 两个群都在发送
+        await summaries.request(bot, 1, render)     # 还没计时的请求
+        await summaries.close()
+        return bot.calls, summaries
+
+    calls, summaries = asyncio.run(go())
+    assert sorted(c[:2] for c in calls) == [("edit", 1), ("send", 1), ("send", 2)]
+    assert summaries.publishing == {} and summaries.timers == {}
+
+
+def test_quiet_chats_are_pruned(monkeypatch):
+    now = [1000.0]
+    # 只替换 coalescer 看到的时钟，事件循环仍用真实时间
+    monkeypatch.setattr(coalescer, "time", SimpleNamespace(monotonic=lambda: now[0]))
+
+    async def go():
+        bot, render = FakeBot(), counter()
+        summaries = SummaryCoalescer(debounce_ms=0, edit_window=60)
+        summaries.prune_at = 3
+        for chat_id in (1, 2):
+            await summaries.request(bot, chat_id, render)
+        now[0] += 61
+        await summaries.request(bot, 3, render)
+        return summaries
+
+    summaries = asyncio.run(go())
+    assert list(summaries.last) == [3]
@@ -0,0 +1,55 @@
+import asyncio
+from types import SimpleNamespace
+
+from concurrency import ChatOrderedProcessor
+
+
+def update(chat_id):
+    return SimpleNamespace(effective_chat=SimpleNamespace(id=chat_id))
+
+
+async def handler(log, name, delay):
+    log.append(f"{name} start")
+    await asyncio.sleep(delay)
+    log.append(f"{name} end")
+
+
+def test_same_chat_in_order():
+    async def go():
+        processor = ChatOrderedProcessor(workers=4)
+        log = []
+        await asyncio.gather(
+            processor.do_process_update(update(1), handler(log, "a", 0.02)),
+            processor.do_process_update(update(1), handler(log, "b", 0)),
+        )
+        return log, processor.chat_locks
+
+    log, locks = asyncio.run(go())
+    assert log == ["a start", "a end", "b start", "b end"]
+    assert locks == {}
+
+
+def test_different_chats_overlap():
+    async def go():
+        processor = ChatOrderedProcessor(workers=4)
+        log = []
+        await asyncio.gather(
+            processor.do_process_update(update(1), handler(log, "a", 0.02)),
+            processor.do_process_update(update(2), handler(log, "b", 0.02)),
+        )
+        return log
+
+    assert asyncio.run(go())[:2] == ["a start", "b start"]
+
+
+def test_workers_limit():
+    async def go():
+        processor = ChatOrderedProcessor(workers=1)
+        log = []
+        await asyncio.gather(
+            processor.do_process_update(update(1), handler(log, "a", 0.02)),
+            processor.do_process_update(update(2), handler(log, "b", 0)),
+        )
+        return log
+
+    assert asyncio.run(go()) == ["a start", "a end", "b start", "b end"]
@@ -0,0 +1,54 @@
+from dispatcher import CommandDispatcher
+
+
+async def report(update, context):
+    pass
+
+
+async def amount(update, context):
+    pass
+
+
+def make():
+    d = CommandDispatcher()
+    d.command(["/report", "/账单"], report)
+    d.amount(amount)
+    return d
+
+
+def test_command_with_args():
+    assert make().classify("/report 2 3") == (report, ["2", "3"], None)
+
+
+def test_command_alias():
+    assert make().classify("/账单")[0] is report
+
+
+def test_command_mention():
+    d = make()
+    assert d.classify("/report@MyBot", "mybot")[0] is report
+    assert d.classify("/report@OtherBot", "mybot") is None
+
+
+def test_unknown_command():
+    assert make().classify("/nope") is None
+    assert make().classify("/") is None
+
+
+def test_amount():
+    callback, args, match = make().classify("+1,234.50")
+    assert callback is amount and args is None
+    assert match.group(1) == "+" and match.group(2) == "1,234.50"
+    assert make().classify("-12")[2].group(1) == "-"
+
+
+def test_not_an_amount():
+    d = make()
+    assert d.classify("+abc") is None
+    assert d.classify("+1.234") is None
+    assert d.classify("hello") is None
+    assert d.classify("") is None
+
+
+def test_amount_without_callback():
+    assert CommandDispatcher().classify("+100") is None
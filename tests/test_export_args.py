@@ -0,0 +1,37 @@
+from datetime import datetime, time
+
+import pytest
+
+from main import parse_export_args
+
+WORK_START = time(12, 0)
+
+
+def test_current_period():
+    assert parse_export_args([], 8, WORK_START) == (None, None, "csv")
+    assert parse_export_args(None, 8, WORK_START) == (None, None, "csv")
+    assert parse_export_args(["XLSX"], 8, WORK_START) == (None, None, "xlsx")
+
+
+def test_single_day():
+    start, end, out_format = parse_export_args(["2024-05-01"], 8, WORK_START)
+    assert start == datetime(2024, 5, 1, 4, 0)
+    assert end == datetime(2024, 5, 2, 4, 0)
+    assert out_format == "csv"
+
+
+def test_range_and_format():
+    start, end, out_format = parse_export_args(["2024-05-01", "2024-05-31", "xlsx"], -3, WORK_START)
+    assert start == datetime(2024, 5, 1, 15, 0)
+    assert end == datetime(2024, 6, 1, 15, 0)
+    assert out_format == "xlsx"
+
+
+@pytest.mark.parametrize("args", [
+    ["2024-05-31", "2024-05-01"],
+    ["2024-05-01", "2024-05-02", "2024-05-03"],
+    ["yesterday"],
+])
+def test_invalid(args):
+    with pytest.raises(ValueError):
+        parse_export_args(args, 8, WORK_START)
@@ -0,0 +1,48 @@
+from decimal import Decimal
+
+from ledger import PeriodAggregate
+
+
+def test_add():
+    agg = PeriodAggregate(None)
+    agg.add(1, "100", "alice", None)
+    agg.add(2, Decimal("-20.50"), "bob", None)
+    agg.add(3, "5", "alice", None)
+
+    assert agg.total == Decimal("84.50")
+    assert agg.count == 3
+    assert agg.people == {"alice": [2, Decimal("105")], "bob": [1, Decimal("-20.50")]}
+    assert [r[0] for r in agg.last(2)] == [2, 3]
+    assert agg.sorted_people()[0][0] == "alice"
+
+
+def test_undo_last():
+    agg = PeriodAggregate(None)
+    agg.add(1, "100", "alice", None)
+    agg.add(2, "7", "bob", None)
+    agg.remove(2, "7", "bob")
+
+    assert agg.total == Decimal("100")
+    assert agg.count == 1
+    assert "bob" not in agg.people
+    assert [r[0] for r in agg.recent] == [1]
+
+
+def test_undo_older_row():
+    agg = PeriodAggregate(None)
+    for i in range(1, 4):
+        agg.add(i, "10", "alice", None)
+    agg.remove(2, "10", "alice")
+
+    assert agg.total == Decimal("20")
+    assert agg.people == {"alice": [2, Decimal("20")]}
+    assert [r[0] for r in agg.recent] == [1, 3]
+
+
+def test_needs_recent():
+    agg = PeriodAggregate(None)
+    agg.count = 10
+    assert agg.needs_recent(6)
+    for i in range(6):
+        agg.add(i, "1", "alice", None)
+    assert not agg.needs_recent(6)
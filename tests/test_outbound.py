@@ -0,0 +1,67 @@
+import time
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import outbound
+from outbound import TokenBucket
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    # 只替换 outbound 看到的时钟，事件循环仍用真实时间
+    monkeypatch.setattr(outbound, "time", SimpleNamespace(monotonic=lambda: now[0],
+                                                          perf_counter=time.perf_counter))
+    return now
+
+
+def test_starts_full(clock):
+    bucket = TokenBucket(3, 1)
+    for _ in range(3):
+        assert bucket.reserve() == 0
+    assert bucket.delay() == pytest.approx(1 / 3)
+
+
+def test_reserve_overdraws(clock):
+    bucket = TokenBucket(2, 1)
+    bucket.reserve()
+    bucket.reserve()
+    assert bucket.reserve() == pytest.approx(0.5)
+    assert bucket.reserve() == pytest.approx(1.0)
+
+
+def test_refill_is_capped(clock):
+    bucket = TokenBucket(20, 60)
+    for _ in range(20):
+        bucket.take()
+    assert bucket.delay() == pytest.approx(3)
+    clock[0] += 3
+    assert bucket.delay() == 0
+    clock[0] += 3600
+    bucket.delay()
+    assert bucket.tokens == 20
+
+
+def test_full(clock):
+    bucket = TokenBucket(2, 60)
+    assert bucket.full()
+    bucket.take()
+    assert not bucket.full()
+    clock[0] += 30
+    assert bucket.full()
+
+
+def test_idle_group_buckets_are_evicted(clock):
+    async def go():
+        limiter = outbound.OutboundLimiter(group_per_min=20)
+        limiter.prune_at = 2
+        await limiter._group_slot(-1)
+        await limiter._group_slot(-2)
+        clock[0] += 60                      # -1 / -2 都已回满
+        await limiter._group_slot(-3)
+        return limiter
+
+    limiter = asyncio.run(go())
+    assert list(limiter.group_buckets) == [-3]
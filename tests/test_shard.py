@@ -0,0 +1,63 @@
+import asyncio
+from types import SimpleNamespace
+
+import httpx
+
+from shard import ShardRing, route, serve_worker, broadcast, MASTER_SHARD, TOKEN_HEADER
+
+CHATS = [-1000000000000 - i for i in range(2000)]
+
+
+def test_same_chat_same_worker():
+    a, b = ShardRing(4), ShardRing(4)
+    assert [a.worker_for(c) for c in CHATS] == [b.worker_for(c) for c in CHATS]
+
+
+def test_all_workers_used():
+    ring = ShardRing(4)
+    assert {ring.worker_for(c) for c in CHATS} == {0, 1, 2, 3}
+
+
+def test_adding_a_worker_moves_few_chats():
+    before, after = ShardRing(4), ShardRing(5)
+    moved = [c for c in CHATS if before.worker_for(c) != after.worker_for(c)]
+    # 理想情况约 1/5；换走的群只会去新的 worker
+    assert len(moved) < len(CHATS) * 0.35
+    assert all(after.worker_for(c) == 4 for c in moved)
+
+
+def test_route_master_command():
+    ring = ShardRing(4)
+    chat = next(c for c in CHATS if ring.worker_for(c) != MASTER_SHARD)
+    message = {"message": {"chat": {"id": chat}, "text": "/users@MyBot 2"}}
+    assert route(ring, message) == MASTER_SHARD
+    message["message"]["text"] = "+100"
+    assert route(ring, message) == ring.worker_for(chat)
+
+
+def test_worker_rejects_bad_token_and_body():
+    async def go():
+        received = []
+
+        async def control(message):
+            received.append(message)
+
+        app = SimpleNamespace(update_queue=asyncio.Queue(), bot=None)
+        server = await serve_worker(app, "127.0.0.1", 0, "secret", control)
+        url = "http://127.0.0.1:%d" % server.sockets[0].getsockname()[1]
+        statuses = []
+        async with httpx.AsyncClient() as client:
+            for headers, body in (({}, b"{}"),
+                                  ({TOKEN_HEADER: "wrong"}, b"{}"),
+                                  ({TOKEN_HEADER: "secret"}, b"{not json"),
+                                  ({TOKEN_HEADER: "secret"}, b'{"invalidate": 1}')):
+                response = await client.post(f"{url}/control", content=body, headers=headers)
+                statuses.append(response.status_code)
+        await broadcast([url], "secret", {"invalidate": None})
+        server.close()
+        await server.wait_closed()
+        return statuses, received
+
+    statuses, received = asyncio.run(go())
+    assert statuses == [403, 403, 400, 200]
+    assert received == [{"invalidate": 1}, {"invalidate": None}]
@@ -0,0 +1,259 @@
+"""
+存储后端一致性检查：同一组操作在每个后端上必须返回相同形状和相同结果。
+
+sqlite 使用临时文件；设置 DATABASE_URL 时也检查 postgres。
+只使用专用的负数 chat_id / user_id，结束时清理；clear_all 只在 sqlite 临时库上检查。
+检查按顺序进行，后面的检查依赖前面写入的数据。
+"""
+import os
+import asyncio
+from decimal import Decimal
+from datetime import datetime, timedelta, time as dtime
+
+import pytest
+
+from cache import utc_naive
+from storage import open_storage
+
+CHAT = -930000000001
+OTHER_CHAT = -930000000002
+MEMBER = -930000001
+STRANGER = -930000002
+OWNER = -930000003
+EPOCH = datetime(1970, 1, 1)
+
+BACKENDS = [
+    "sqlite",
+    pytest.param("postgres", marks=pytest.mark.skipif(
+        not os.getenv("DATABASE_URL"), reason="DATABASE_URL not set")),
+]
+
+
+def period():
+    start = datetime.utcnow().replace(microsecond=0) - timedelta(hours=1)
+    return start, start + timedelta(days=1)
+
+
+def naive(dt):
+    return utc_naive(dt) if dt.tzinfo else dt
+
+# ==============================
+# 检查项
+# ==============================
+
+async def check_settings(s):
+    assert await s.load_chat_settings(CHAT) == (0, dtime(0, 0))
+    assert await s.set_timezone(CHAT, 8) == (8, dtime(0, 0))
+    assert await s.set_worktime(CHAT, "14:00") == (8, dtime(14, 0))
+    assert await s.load_chat_settings(CHAT) == (8, dtime(14, 0))
+
+
+async def check_members(s):
+    assert await s.find_member(CHAT, "conformance") is None
+    await s.add_member(MEMBER, CHAT, "conformance")
+    await s.add_member(MEMBER, CHAT, "conformance2")
+    assert tuple(await s.find_member(CHAT, "conformance2")) == (MEMBER, "conformance2")
+
+    _, members = await s.load_permissions()
+    assert (MEMBER, CHAT) in [tuple(m) for m in members]
+
+
+async def check_record_entry(s):
+    start, end = period()
+    assert await s.record_entry(CHAT, STRANGER, False, "x", Decimal("1"), start, end, 6) is None
+
+    people, recent = await s.record_entry(CHAT, MEMBER, False, "alice", Decimal("12.50"),
+                                          start, end, 6)
+    assert [tuple(p) for p in people] == [("alice", 1, Decimal("12.50"))], people
+    assert len(recent) == 1
+    row_id, amount, name, ts = recent[0]
+    assert (amount, name) == (Decimal("12.50"), "alice")
+    assert ts.tzinfo is not None and abs(naive(ts) - datetime.utcnow()) < timedelta(minutes=1)
+
+    people, recent = await s.record_entry(CHAT, STRANGER, True, "bob", Decimal("-2.25"),
+                                          start, end, 6)
+    assert sorted(tuple(p) for p in people) == [("alice", 1, Decimal("12.50")),
+                                                ("bob", 1, Decimal("-2.25"))]
+    assert [r[2] for r in recent] == ["bob", "alice"]
+    assert recent[0][0] > row_id
+
+
+async def check_batch_and_period(s):
+    start, end = period()
+    now = datetime.utcnow()
+    entries = [(CHAT, start, "carol", Decimal(n), now + timedelta(seconds=n)) for n in (1, 2, 3)]
+    rows = await s.insert_history_batch(entries)
+    assert len(rows) == 3
+    assert all(ts.tzinfo is not None for _, ts in rows)
+
+    people, recent = await s.load_period(CHAT, start, end)
+    totals = {p[0]: (p[1], Decimal(p[2])) for p in people}
+    assert totals["carol"] == (3, Decimal("6")), totals
+    assert totals["alice"] == (1, Decimal("12.50"))
+    assert [r[2] for r in recent[:3]] == ["carol"] * 3
+    assert [r[1] for r in recent[:3]] == [Decimal("3"), Decimal("2"), Decimal("1")]
+    assert len(await s.load_recent(CHAT, start, end)) == 5
+
+    rebuilt = await s.rebuild_period_totals(CHAT, start, end)
+    assert sorted(tuple(p) for p in rebuilt) == sorted(tuple(p) for p in people)
+
+
+async def check_pages(s):
+    start, end = period()
+    first, has_next = await s.load_page(CHAT, start, end, "n", (EPOCH, 0), 2)
+    assert len(first) == 2 and has_next
+    second, has_next = await s.load_page(CHAT, start, end, "n", (first[-1][3], first[-1][0]), 2)
+    assert len(second) == 2 and has_next
+    last, has_next = await s.load_page(CHAT, start, end, "n", (second[-1][3], second[-1][0]), 2)
+    assert len(last) == 1 and not has_next
+
+    back, has_next = await s.load_page(CHAT, start, end, "p", (second[0][3], second[0][0]), 2)
+    assert [r[0] for r in back] == [r[0] for r in first] and has_next
+
+    ids = [r[0] for r in first + second + last]
+    assert len(set(ids)) == 5
+
+
+async def check_undo_and_reset(s):
+    start, end = period()
+    _, recent = await s.load_period(CHAT, start, end)
+    row = await s.undo_last(CHAT, start, end)
+    assert row[0] == recent[0][0] and Decimal(row[1]) == Decimal("3")
+
+    people, _ = await s.load_period(CHAT, start, end)
+    assert {p[0]: p[1] for p in people}["carol"] == 2
+
+    await s.reset_period(CHAT, start, end)
+    assert [list(x) for x in await s.load_period(CHAT, start, end)] == [[], []]
+    assert await s.undo_last(CHAT, start, end) is None
+
+
+async def check_owner(s):
+    first = await s.extend_owner(OWNER, 3)
+    assert first.tzinfo is None
+    assert abs(first - (datetime.utcnow() + timedelta(days=3))) < timedelta(minutes=1)
+    second = await s.extend_owner(OWNER, 2)
+    assert abs(second - (first + timedelta(days=2))) < timedelta(seconds=1)
+
+    owners, _ = await s.load_permissions()
+    expire = dict((o[0], o[1]) for o in owners)[OWNER]
+    assert abs(utc_naive(expire) - second) < timedelta(seconds=1)
+
+
+async def check_directory(s):
+    now = datetime.utcnow().replace(microsecond=0)
+    await s.save_directory([(CHAT, "Conformance", now)])
+    await s.save_directory([(CHAT, None, now + timedelta(seconds=1))])
+    entries = {e[0]: e for e in await s.load_directory()}
+    assert entries[CHAT][1] == "Conformance"
+    assert naive(entries[CHAT][2]) == now + timedelta(seconds=1)
+
+
+async def check_clear_chat(s):
+    start, end = period()
+    await s.record_entry(CHAT, MEMBER, True, "alice", Decimal("1"), start, end, 6)
+    await s.record_entry(OTHER_CHAT, MEMBER, True, "alice", Decimal("1"), start, end, 6)
+    chats = await s.history_chats()
+    assert CHAT in chats and OTHER_CHAT in chats and chats == sorted(chats)
+
+    await s.clear_chat(CHAT)
+    chats = await s.history_chats()
+    assert CHAT not in chats and OTHER_CHAT in chats
+    assert [list(x) for x in await s.load_period(CHAT, start, end)] == [[], []]
+
+
+async def check_clear_all(s):
+    await s.clear_all()
+    assert await s.history_chats() == []
+
+
+async def cleanup(s):
+    for chat_id in (CHAT, OTHER_CHAT):
+        await s.clear_chat(chat_id)
+    await s.remove_member(MEMBER, CHAT)
+    assert await s.find_member(CHAT, "conformance2") is None
+
+    if s.name == "postgres":
+        import database
+        await database.execute("DELETE FROM admins WHERE user_id=%s", (OWNER,))
+        await database.execute("DELETE FROM chat_settings WHERE chat_id IN (%s,%s)",
+                               (CHAT, OTHER_CHAT))
+        await database.execute("DELETE FROM chat_directory WHERE id=%s", (CHAT,))
+
+
+# ==============================
+# 后端
+# ==============================
+
+@pytest.fixture(scope="module")
+def loop():
+    # 整个模块共用一个事件循环：连接池 / 锁不跨循环使用
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+@pytest.fixture(scope="module", params=BACKENDS)
+def backend(request, loop, tmp_path_factory):
+    if request.param == "sqlite":
+        s = open_storage("sqlite", str(tmp_path_factory.mktemp("conformance") / "conformance.db"))
+    else:
+        s = open_storage(request.param)
+    loop.run_until_complete(s.init())
+    yield s, loop.run_until_complete
+    try:
+        loop.run_until_complete(cleanup(s))
+    finally:
+        loop.run_until_complete(s.close())
+
+
+def test_settings(backend):
+    s, wait = backend
+    wait(check_settings(s))
+
+
+def test_members(backend):
+    s, wait = backend
+    wait(check_members(s))
+
+
+def test_record_entry(backend):
+    s, wait = backend
+    wait(check_record_entry(s))
+
+
+def test_batch_and_period(backend):
+    s, wait = backend
+    wait(check_batch_and_period(s))
+
+
+def test_pages(backend):
+    s, wait = backend
+    wait(check_pages(s))
+
+
+def test_undo_and_reset(backend):
+    s, wait = backend
+    wait(check_undo_and_reset(s))
+
+
+def test_owner(backend):
+    s, wait = backend
+    wait(check_owner(s))
+
+
+def test_directory(backend):
+    s, wait = backend
+    wait(check_directory(s))
+
+
+def test_clear_chat(backend):
+    s, wait = backend
+    wait(check_clear_chat(s))
+
+
+def test_clear_all(backend):
+    s, wait = backend
+    if s.name != "sqlite":
+        pytest.skip("clear_all 只在 sqlite 临时库上检查")
+    wait(check_clear_all(s))
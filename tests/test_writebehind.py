@@ -0,0 +1,116 @@
+import asyncio
+
+import pytest
+
+from writebehind import WriteBehindQueue
+
+
+class FakeFlush:
+    def __init__(self, error=None):
+        self.batches = []
+        self.release = asyncio.Event()
+        self.release.set()
+        self.error = error
+
+    async def __call__(self, entries):
+        self.batches.append(list(entries))
+        await self.release.wait()
+        if self.error:
+            raise self.error
+        return [f"row-{entry}" for entry in entries]
+
+
+def test_batches_within_window():
+    async def go():
+        flush = FakeFlush()
+        queue = WriteBehindQueue(flush, window_ms=20)
+        queue.start()
+        results = await asyncio.gather(*(queue.submit(i) for i in range(3)))
+        await queue.stop()
+        return flush.batches, results, queue
+
+    batches, results, queue = asyncio.run(go())
+    assert batches == [[0, 1, 2]]
+    assert results == ["row-0", "row-1", "row-2"]
+    assert (queue.batches, queue.rows) == (1, 3)
+
+
+def test_max_batch():
+    async def go():
+        flush = FakeFlush()
+        queue = WriteBehindQueue(flush, window_ms=20, max_batch=2)
+        queue.start()
+        await asyncio.gather(*(queue.submit(i) for i in range(3)))
+        await queue.stop()
+        return flush.batches
+
+    assert asyncio.run(go()) == [[0, 1], [2]]
+
+
+def test_submit_resolves_after_flush():
+    async def go():
+        flush = FakeFlush()
+        flush.release.clear()
+        queue = WriteBehindQueue(flush, window_ms=1)
+        queue.start()
+
+        task = asyncio.create_task(queue.submit("a"))
+        await asyncio.sleep(0.05)
+        assert flush.batches == [["a"]]
+        assert not task.done()
+
+        flush.release.set()
+        result = await task
+        await queue.stop()
+        return result
+
+    assert asyncio.run(go()) == "row-a"
+
+
+def test_error_reaches_every_caller():
+    async def go():
+        queue = WriteBehindQueue(FakeFlush(error=ValueError("db down")), window_ms=20)
+        queue.start()
+        results = await asyncio.gather(*(queue.submit(i) for i in range(3)),
+                                       return_exceptions=True)
+        await queue.stop()
+        return results
+
+    results = asyncio.run(go())
+    assert all(isinstance(r, ValueError) and str(r) == "db down" for r in results)
+
+
+def test_stop_drains_queue():
+    async def go():
+        flush = FakeFlush()
+        queue = WriteBehindQueue(flush, window_ms=20, max_batch=2)
+        queue.start()
+        tasks = [asyncio.create_task(queue.submit(i)) for i in range(5)]
+        await asyncio.sleep(0)
+        await queue.stop()
+        return flush.batches, [t.result() for t in tasks]
+
+    batches, results = asyncio.run(go())
+    assert [entry for batch in batches for entry in batch] == [0, 1, 2, 3, 4]
+    assert results == [f"row-{i}" for i in range(5)]
+
+
+def test_stop_after_worker_died():
+    async def go():
+        flush = FakeFlush()
+        flush.release.clear()
+        queue = WriteBehindQueue(flush, window_ms=1)
+        queue.start()
+        first = asyncio.create_task(queue.submit("a"))
+        await asyncio.sleep(0.05)
+        second = asyncio.create_task(queue.submit("b"))
+        await asyncio.sleep(0)
+
+        queue.task.cancel()                     # 写入任务在 flush 中途退出
+        await asyncio.wait_for(queue.stop(), timeout=1)
+        return first, second
+
+    first, second = asyncio.run(go())
+    assert first.cancelled()
+    with pytest.raises(RuntimeError):
+        second.result()
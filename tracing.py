@@ -0,0 +1,148 @@
+"""
+SQL 语句追踪（数据库游标每执行一条语句调用一次 record()）：
+
+- 按归一化后的语句（字面量 / 参数换成 ?、空白合并）累计次数、总耗时、最大耗时
+- 超过 slow_ms 的语句写慢查询日志：耗时、参数个数、来源 handler、语句
+- explain(handler, n) 预约 n 次 EXPLAIN ANALYZE：该 handler 接下来执行的语句
+  会在 SAVEPOINT 里再跑一次 EXPLAIN ANALYZE 然后回滚，不影响原来的事务
+
+enabled = False 时游标只做计数，不计时也不记录。
+"""
+import os
+import re
+import time
+import functools
+import logging
+import threading
+from collections import deque
+
+import metrics
+
+logger = logging.getLogger("slow_query")
+
+enabled = os.getenv("DB_TRACE", "1") == "1"
+# 慢查询阈值（毫秒）
+slow_ms = float(os.getenv("DB_SLOW_QUERY_MS", "500"))
+
+_NORMALIZE = [
+    (re.compile(r"--[^\n]*"), ""),
+    (re.compile(r"'(?:[^']|'')*'"), "?"),
+    (re.compile(r"%\(\w+\)s|%s"), "?"),
+    (re.compile(r"\b\d+(?:\.\d+)?\b"), "?"),
+    (re.compile(r"\s+"), " "),
+]
+
+# 只有这些语句能 EXPLAIN
+EXPLAINABLE = {"SELECT", "INSERT", "UPDATE", "DELETE", "WITH"}
+
+_lock = threading.Lock()
+_local = threading.local()
+
+statements = {}                 # (handler, 归一化语句) -> [次数, 总秒数, 最大秒数, 参数个数]
+slow = deque(maxlen=50)         # (time, handler, 毫秒, 参数个数, 语句)
+plans = deque(maxlen=10)        # (time, handler, 语句, 计划文本)
+_armed = {}                     # handler -> 还要采样几次
+
+
+def normalize(query):
+    if isinstance(query, bytes):
+        query = query.decode(errors="replace")
+    elif not isinstance(query, str):
+        # psycopg2.sql.Composed 等
+        query = str(query)
+    return _normalize_text(query)
+
+
+# SQL 基本都是代码里的常量字符串，归一化结果缓存起来
+@functools.lru_cache(maxsize=1024)
+def _normalize_text(query):
+    for pattern, replacement in _NORMALIZE:
+        query = pattern.sub(replacement, query)
+    return query.strip()
+
+
+def param_count(params):
+    if params is None:
+        return 0
+    try:
+        return len(params)
+    except TypeError:
+        return 1
+
+
+def record(cursor, query, params, seconds, failed=False):
+    # EXPLAIN 采样自己执行的语句不记录
+    if getattr(_local, "explaining", False):
+        return
+
+    handler = metrics.current_handler() or "-"
+    text = normalize(query)
+    nparams = param_count(params)
+
+    with _lock:
+        entry = statements.get((handler, text))
+        if entry is None:
+            entry = statements[(handler, text)] = [0, 0.0, 0.0, nparams]
+        entry[0] += 1
+        entry[1] += seconds
+        entry[2] = max(entry[2], seconds)
+
+        if seconds * 1000 >= slow_ms:
+            slow.append((time.time(), handler, seconds * 1000, nparams, text))
+            logger.warning("slow query %.1f ms handler=%s params=%d%s: %s",
+                           seconds * 1000, handler, nparams, " (failed)" if failed else "", text)
+
+        # 失败的语句所在事务已中止，没法再 EXPLAIN；服务端游标也不能再执行别的语句
+        sample = (not failed and not cursor.name and _armed.get(handler, 0) > 0
+                  and text.split(" ", 1)[0].upper() in EXPLAINABLE)
+        if sample:
+            _armed[handler] -= 1
+            if not _armed[handler]:
+                del _armed[handler]
+
+    if sample:
+        _explain(cursor, query, params, handler, text)
+
+
+def _explain(cursor, query, params, handler, text):
+    _local.explaining = True
+    try:
+        with cursor.connection.cursor() as c:
+            c.execute("SAVEPOINT trace_explain")
+            try:
+                c.execute(b"EXPLAIN (ANALYZE, BUFFERS) " + c.mogrify(query, params))
+                plan = "\n".join(row[0] for row in c.fetchall())
+            finally:
+                c.execute("ROLLBACK TO SAVEPOINT trace_explain")
+        plans.append((time.time(), handler, text, plan))
+        logger.info("EXPLAIN ANALYZE handler=%s: %s\n%s", handler, text, plan)
+    except Exception:
+        logger.exception("EXPLAIN ANALYZE 失败: %s", text)
+    finally:
+        _local.explaining = False
+
+
+def explain(handler, n=1):
+    """预约：handler 接下来的 n 条语句各采样一次 EXPLAIN ANALYZE"""
+    with _lock:
+        _armed[handler] = _armed.get(handler, 0) + n
+
+
+def armed():
+    with _lock:
+        return dict(_armed)
+
+
+def top(n=10):
+    """按总耗时排序的前 n 条语句"""
+    with _lock:
+        items = sorted(statements.items(), key=lambda x: x[1][1], reverse=True)
+    return items[:n]
+
+
+def reset():
+    with _lock:
+        statements.clear()
+        slow.clear()
+        plans.clear()
+        _armed.clear()
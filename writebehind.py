@@ -0,0 +1,87 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+# ==============================
+# 批量写入（group commit）
+# ==============================
+
+class WriteBehindQueue:
+    """
+    把多个群的写入攒 window_ms 毫秒，再用 flush(entries) 一次写入、一次提交。
+
+    submit() 要等到所在批次提交成功才返回，所以回复用户时数据已经落盘。
+    队列先进先出、同一时间只有一个批次在写，同一个群的顺序不会乱。
+    """
+
+    def __init__(self, flush, window_ms=5, max_batch=500):
+        self.flush = flush
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self.queue = asyncio.Queue()
+        self.task = None
+        self.batches = 0
+        self.rows = 0
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._worker())
+
+    async def stop(self):
+        if self.task is None:
+            return
+        # 先写完队列里剩下的；写入任务已经退出时没有人处理队列，不能一直等
+        if not self.task.done():
+            joined = asyncio.ensure_future(self.queue.join())
+            await asyncio.wait({joined, self.task}, return_when=asyncio.FIRST_COMPLETED)
+            joined.cancel()
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            logger.exception("批量写入任务异常退出")
+        self.task = None
+
+        # 还在队列里的写入不会再执行
+        while not self.queue.empty():
+            _, future = self.queue.get_nowait()
+            if not future.done():
+                future.set_exception(RuntimeError("write queue stopped"))
+            self.queue.task_done()
+
+    async def submit(self, entry):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((entry, future))
+        return await future
+
+    async def _worker(self):
+        while True:
+            batch = [await self.queue.get()]
+            try:
+                await asyncio.sleep(self.window)
+                while len(batch) < self.max_batch and not self.queue.empty():
+                    batch.append(self.queue.get_nowait())
+
+                results = await self.flush([entry for entry, _ in batch])
+            except Exception as e:
+                logger.exception("批量写入失败 (%d 条)", len(batch))
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+            else:
+                self.batches += 1
+                self.rows += len(batch)
+                for (_, future), result in zip(batch, results):
+                    if not future.done():
+                        future.set_result(result)
+            finally:
+                # 被取消（停止）时这一批的结果未知，不让调用方一直等
+                for _, future in batch:
+                    if not future.done():
+                        future.cancel()
+                for _ in batch:
+                    self.queue.task_done()